@@ -0,0 +1,78 @@
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from imagededup.methods import PHash
+from dedupe_images import encode_files, find_image_folders, list_images, load_thumbnail, phash_batch
+
+
+def time_encode_images(folders, workers):
+    """
+    PHash.encode_images on each folder, the way dedupe_images.py hashed images before it had its own pool.
+    """
+    phasher = PHash(verbose=False)
+    started = time.perf_counter()
+    encodings = {}
+    for folder in folders:
+        for filename, image_hash in phasher.encode_images(image_dir=folder, num_enc_workers=workers).items():
+            encodings[os.path.join(folder, filename)] = image_hash
+    return encodings, time.perf_counter() - started
+
+
+def time_backend(folders, workers, backend):
+    """
+    encode_files with a backend on each folder, through one pool of `workers` processes as run_dedupe does.
+    """
+    paths = [[path for _, path, _ in list_images(folder)] for folder in folders]
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(encode_files, paths, [backend] * len(paths)))
+    elapsed = time.perf_counter() - started
+    encodings = {path: image_hash for folder_paths, folder_hashes in zip(paths, hashes)
+                 for path, image_hash in zip(folder_paths, folder_hashes) if image_hash}
+    return encodings, elapsed
+
+
+def time_numpy_steps(folders):
+    """
+    Seconds the numpy backend spends loading thumbnails and hashing them, in this process.
+    """
+    paths = [path for folder in folders for _, path, _ in list_images(folder)]
+    started = time.perf_counter()
+    thumbnails = [thumbnail for thumbnail in map(load_thumbnail, paths) if thumbnail is not None]
+    loaded = time.perf_counter()
+    phash_batch(thumbnails)
+    return loaded - started, time.perf_counter() - loaded, len(thumbnails)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the ways dedupe_images.py can hash a downloads tree')
+    parser.add_argument('parent_directory', nargs='?',
+                        default='C:\\Users\\joshu\\Documents\\MYCOVISION\\googleimagesdownloader\\downloads')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes hashing images (default: one per cpu)')
+    args = parser.parse_args()
+    folders = find_image_folders(args.parent_directory)
+    # encode_images logs a start and an end line per folder
+    logging.getLogger('imagededup.methods.hashing').setLevel(logging.WARNING)
+
+    reference, reference_time = time_encode_images(folders, args.workers)
+    images = len(reference)
+    print(f"{len(folders)} folders, {images} images, {args.workers} workers")
+    print(f"{'method':<26}{'seconds':>10}{'images/s':>12}{'speedup':>10}{'different hashes':>19}")
+    print(f"{'PHash.encode_images':<26}{reference_time:>10.2f}{images / reference_time:>12.1f}{1:>10.2f}{0:>19}")
+    for backend in ('imagededup', 'numpy'):
+        encodings, elapsed = time_backend(folders, args.workers, backend)
+        different = sum(encodings.get(path) != image_hash for path, image_hash in reference.items())
+        different += len(encodings.keys() - reference.keys())
+        print(f"{'--backend ' + backend:<26}{elapsed:>10.2f}{images / elapsed:>12.1f}"
+              f"{reference_time / elapsed:>10.2f}{different:>19}")
+
+    load_time, hash_time, loaded = time_numpy_steps(folders)
+    print(f"numpy backend in one process: {load_time:.2f} s decoding and downscaling, "
+          f"{hash_time * 1000:.1f} ms hashing {loaded} thumbnails")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,368 @@
+import argparse
+import collections
+import csv
+import hashlib
+import json
 import os
+import stat
+import tempfile
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import combinations, islice
+import numpy as np
 from imagededup.methods import PHash
 from imagededup.utils import plot_duplicates
+from imagededup.utils.general_utils import get_files_to_remove
+from imagededup.utils.image_utils import IMG_FORMATS
+from PIL import Image
+from scipy.fftpack import dct
 import shutil
-def find_image_folders(parent_directory):
+
+# needs python 3.9 or later: run_dedupe cancels the queued folders with ProcessPoolExecutor.shutdown(cancel_futures)
+
+HASH_CACHE_NAME = '.phash_cache.json'  # kept at the top of the downloads tree
+MAX_DISTANCE = 10  # images whose hashes differ in at most this many bits are duplicates, as in PHash.find_duplicates
+FOLDERS_PER_WORKER = 2  # folders being hashed or waiting to be deduplicated, per worker process
+PROGRESS_INTERVAL = 5  # seconds between two progress lines
+READ_SIZE = 1 << 20  # bytes read at a time when digesting a file
+BACKENDS = ('imagededup', 'numpy')  # ways encode_files can hash images, see phash_batch for how they compare
+
+
+def list_images(image_directory):
     """
-    Find all folders containing images in the parent directory.
+    (filename, path, os.stat result) of the files PHash.encode_images would encode in a directory, sorted by name.
+    """
+    images = []
+    for filename in sorted(os.listdir(image_directory)):
+        if filename.startswith('.'):
+            continue
+        path = os.path.join(image_directory, filename)
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        if not stat.S_ISDIR(info.st_mode):
+            images.append((filename, path, info))
+    return images
+
+
+def load_thumbnail(path):
+    """
+    The 32x32 grayscale pixels PHash hashes for an image, taken the way imagededup's load_image takes them, None for
+    the files it would not encode.
+    """
+    try:
+        with Image.open(path) as image:
+            if image.format not in IMG_FORMATS:
+                return None
+            if image.mode != 'RGB':
+                image = image.convert('RGBA').convert('RGB')
+            return np.asarray(image.resize((32, 32), Image.LANCZOS).convert('L'), dtype=np.uint8)
+    except Exception:
+        return None
+
+
+def phash_batch(thumbnails):
+    """
+    PHash of a stack of load_thumbnail results, as the hex strings PHash.encode_image returns, with two scipy calls
+    over the whole stack instead of two per image.
+
+    These are the dct calls PHash makes, down the columns and then along the rows, so the coefficients and the
+    hashes are bit for bit the same, flat and symmetric images included, where many coefficients are exactly zero.
+    """
+    pixels = np.asarray(thumbnails, dtype=np.float64)
+    coefficients = dct(dct(pixels, axis=1), axis=2)[:, :8, :8].reshape(len(pixels), 64)
+    # PHash: the bits of the top left 8x8 coefficients at or above their median, leaving out the DC term
+    medians = np.median(coefficients[:, 1:], axis=1)
+    bits = np.packbits(coefficients >= medians[:, None], axis=1)
+    return [row.tobytes().hex() for row in bits]
+
+
+_phasher = None
+
+
+def encode_files(paths, backend='imagededup'):
+    """
+    PHash of each of the paths, None for the files that do not decode. Runs in the worker processes of run_dedupe.
+
+    The imagededup backend encodes the images one at a time with PHash.encode_image, the numpy backend loads all of
+    them and hashes the batch with phash_batch.
+    """
+    if backend == 'numpy':
+        thumbnails = [load_thumbnail(path) for path in paths]
+        loaded = [thumbnail for thumbnail in thumbnails if thumbnail is not None]
+        hashes = iter(phash_batch(loaded) if loaded else [])
+        return [next(hashes) if thumbnail is not None else None for thumbnail in thumbnails]
+    global _phasher
+    if _phasher is None:
+        _phasher = PHash(verbose=False)
+    return [_phasher.encode_image(image_file=path) for path in paths]
+
+
+class HashCache:
+    """
+    Perceptual hashes of the images under a downloads tree, stored in one JSON file at its top.
+
+    Entries are keyed by the path relative to the top and remember the size and mtime the hash was computed for, so
+    an image is only encoded again when it changes. Entries for files not seen since the cache was loaded are pruned
+    when it is saved.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, HASH_CACHE_NAME)
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(self.path) as cache_file:
+                self.entries = json.load(cache_file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def _key(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def lookup(self, image_directory, cached=None):
+        """
+        The encodings of the images of a directory the cache has a hash for at their current size and mtime, and the
+        list_images entries of the ones it has not. (path, os.stat result, hash) of the cached ones is appended to
+        `cached` when given.
+        """
+        encodings = {}
+        missing = []
+        for filename, path, info in list_images(image_directory):
+            key = self._key(path)
+            self.seen.add(key)
+            entry = self.entries.get(key)
+            if entry and entry[0] == info.st_size and entry[1] == info.st_mtime_ns:
+                self.hits += 1
+                if cached is not None:
+                    cached.append((path, info, entry[2]))
+                if entry[2]:
+                    encodings[filename] = entry[2]
+            else:
+                missing.append((filename, path, info))
+        return encodings, missing
+
+    def add(self, path, info, image_hash):
+        # files that do not decode are cached as None, like encode_images they are left out of the encodings
+        self.misses += 1
+        self.entries[self._key(path)] = [info.st_size, info.st_mtime_ns, image_hash]
+
+    def encode_folder(self, phasher, image_directory):
+        """
+        Same result as phasher.encode_images(image_dir=image_directory), encoding only the files the cache has no
+        hash for at their current size and mtime.
+        """
+        encodings, missing = self.lookup(image_directory)
+        for filename, path, info in missing:
+            image_hash = phasher.encode_image(image_file=path)
+            self.add(path, info, image_hash)
+            if image_hash:
+                encodings[filename] = image_hash
+        return encodings
+
+    def forget(self, path):
+        key = self._key(path)
+        self.entries.pop(key, None)
+        self.seen.discard(key)
+
+    def save(self):
+        """
+        Drop the entries of files not seen and write the cache under a temporary name first, so an interrupted save
+        leaves the previous one in place.
+        """
+        self.entries = {key: entry for key, entry in self.entries.items() if key in self.seen}
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.', suffix='.part')
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(self.entries, cache_file, separators=(',', ':'))
+        os.replace(temp_path, self.path)
+
+
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as image_file:
+        for chunk in iter(lambda: image_file.read(READ_SIZE), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+class ContentIndex:
+    """
+    The files seen so far grouped by size and, for the sizes shared by several of them, by a digest of their content,
+    so a file byte-identical to an earlier one takes its perceptual hash instead of being decoded again.
+
+    A file is only read when another one of the same size was seen, most of them never are.
+    """
+
+    def __init__(self):
+        self.sizes = {}  # size -> files of that size not digested yet, emptied when a file of that size needs a hash
+        self.digests = {}  # digest -> first file seen with it
+        self.hashes = {}  # file -> its perceptual hash, once known
+        self.reads = 0
+        self.copies = 0
+
+    def add(self, path, size, image_hash):
+        """
+        Remember a file whose hash is already known, it is only read if a file of the same size needs a hash.
+        """
+        self.sizes.setdefault(size, []).append(path)
+        self.hashes[path] = image_hash
+
+    def original(self, path, size):
+        """
+        The file seen before `path` with the same content, None when there is none. `path` is remembered either way.
+        """
+        pending = self.sizes.get(size)
+        if pending is None:
+            self.sizes[size] = [path]
+            return None
+        # files removed since they were seen are skipped, their hash is only needed for content still around
+        for other in pending:
+            try:
+                self.reads += 1
+                self.digests.setdefault(file_digest(other), other)
+            except OSError:
+                pass
+        pending.clear()
+        try:
+            self.reads += 1
+            digest = file_digest(path)
+        except OSError:
+            return None
+        original = self.digests.setdefault(digest, path)
+        if original == path:
+            return None
+        self.copies += 1
+        return original
+
+
+if hasattr(int, 'bit_count'):  # python 3.10+, 3.9 counts the ones of the binary string
+    def hamming_distance(hash1, hash2):
+        return (hash1 ^ hash2).bit_count()
+else:
+    def hamming_distance(hash1, hash2):
+        return bin(hash1 ^ hash2).count('1')
+
+
+class HashIndex:
+    """
+    Multi-index hashing over 64-bit perceptual hashes, for finding every hash within a Hamming distance of another
+    one without comparing it to all of them.
+
+    The hashes are split into four 16-bit blocks with a table per block. Two hashes at most t bits apart differ in at
+    most t // 4 bits in one of their blocks, so a query only compares against the hashes found under the keys that
+    close to its own blocks: 137 keys per block for the default threshold of 10.
+    """
+
+    BLOCKS = 4
+    BLOCK_BITS = 16
+
+    def __init__(self):
+        self.values = {}  # hash -> values inserted with it
+        self.tables = [{} for _ in range(self.BLOCKS)]  # block -> hashes having it
+        self.masks = {}  # radius -> the 16-bit masks with at most that many bits set
+        self.size = 0
+
+    def _blocks(self, image_hash):
+        mask = (1 << self.BLOCK_BITS) - 1
+        return [(image_hash >> (i * self.BLOCK_BITS)) & mask for i in range(self.BLOCKS)]
+
+    def _masks(self, radius):
+        if radius not in self.masks:
+            self.masks[radius] = [sum(1 << bit for bit in bits) for r in range(radius + 1)
+                                  for bits in combinations(range(self.BLOCK_BITS), r)]
+        return self.masks[radius]
+
+    def insert(self, image_hash, value):
+        self.size += 1
+        if image_hash in self.values:
+            self.values[image_hash].append(value)
+            return
+        self.values[image_hash] = [value]
+        for table, block in zip(self.tables, self._blocks(image_hash)):
+            table.setdefault(block, []).append(image_hash)
+
+    def query(self, image_hash, threshold):
+        """
+        (value, distance) of everything inserted with a hash at most `threshold` bits away from `image_hash`.
+        """
+        masks = self._masks(min(threshold // self.BLOCKS, self.BLOCK_BITS))
+        candidates = set()
+        for table, block in zip(self.tables, self._blocks(image_hash)):
+            for mask in masks:
+                hashes = table.get(block ^ mask)
+                if hashes:
+                    candidates.update(hashes)
+        found = []
+        for candidate in candidates:
+            distance = hamming_distance(image_hash, candidate)
+            if distance <= threshold:
+                found.extend((value, distance) for value in self.values[candidate])
+        return found
+
+
+def iter_image_folders(parent_directory):
+    """
+    Yield the folders containing images in the parent directory as the walk finds them.
     """
-    image_folders = []
     for foldername, subfolders, filenames in os.walk(parent_directory):
         for filename in filenames:
             if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                image_folders.append(foldername)
+                yield foldername
                 break  # no need to continue checking other files in this folder
-    return image_folders
 
 
-def find_and_remove_duplicates(image_directory):
+def find_image_folders(parent_directory):
     """
-    Find duplicate images in a given directory and remove them.
+    Find all folders containing images in the parent directory.
+    """
+    return list(iter_image_folders(parent_directory))
+
+
+def find_and_remove_duplicates(image_directory, cache=None, index=None, collisions=None, threshold=MAX_DISTANCE,
+                               encodings=None):
+    """
+    Find duplicate images in a given directory and remove them, keeping the first of each group. Hashes are the
+    encodings given, or come from the cache when one is given.
+
+    With an index, the images are looked up in it and the ones kept are inserted as (folder, filename), so it ends up
+    holding every image of the folders processed so far. Matches in other folders are not removed but appended to
+    `collisions` as (earlier image path, image path, distance).
     """
     phasher = PHash()
 
     # Generate encodings for all images in the image directory
-    encodings = phasher.encode_images(image_dir=image_directory)
+    if encodings is None and cache is not None:
+        encodings = cache.encode_folder(phasher, image_directory)
+    elif encodings is None:
+        encodings = phasher.encode_images(image_dir=image_directory)
 
     # Find duplicates using the generated encodings
-    duplicates = phasher.find_duplicates(encoding_map=encodings)
+    duplicates = {}
+    if index is None:
+        results = phasher.find_duplicates(encoding_map=encodings, max_distance_threshold=threshold)
+        to_remove = get_files_to_remove(results)
+        for original, matches in results.items():
+            if original not in to_remove:
+                duplicates[original] = [match for match in matches if match in to_remove]
+    else:
+        for filename in sorted(encodings):
+            image_hash = int(encodings[filename], 16)
+            matches = index.query(image_hash, threshold)
+            same_folder = [(distance, name) for (folder, name), distance in matches if folder == image_directory]
+            if same_folder:
+                duplicates.setdefault(min(same_folder)[1], []).append(filename)
+                continue
+            if collisions is not None:
+                collisions.extend((os.path.join(*other), os.path.join(image_directory, filename), distance)
+                                  for other, distance in matches)
+            index.insert(image_hash, (image_directory, filename))
 
     # Remove duplicates for a file that has duplicates
+    if not any(duplicates.values()):  # No duplicates were found
+        print("No duplicates found in this directory.")
     for original, duplicate_list in duplicates.items():
         if duplicate_list:  # Check if current file has duplicates
             print(f"Found duplicates for file: {original}")
@@ -35,24 +370,144 @@ def find_and_remove_duplicates(image_directory):
                 duplicate_file_path = os.path.join(image_directory, duplicate)
                 try:
                     os.remove(duplicate_file_path)
+                    if cache is not None:
+                        cache.forget(duplicate_file_path)
                     print(f"Deleted: {duplicate}")
                 except Exception as e:
                     print(f"Error deleting file {duplicate}: {str(e)}")
-    else:  # No duplicates were found
-        print("No duplicates found in this directory.")
 
 
-def main():
-    parent_directory = 'C:\\Users\\joshu\\Documents\\MYCOVISION\\googleimagesdownloader\\downloads'
+def run_dedupe(parent_directory, cache=None, index=None, collisions=None, threshold=MAX_DISTANCE, workers=1,
+               contents=None, backend='imagededup'):
+    """
+    find_and_remove_duplicates on every image folder of the parent directory, with the images hashed by `workers`
+    processes.
 
-    # Find all image folders
-    image_folders = find_image_folders(parent_directory)
+    Folders are streamed from the walk to the workers, at most FOLDERS_PER_WORKER per worker ahead of the one being
+    deduplicated, and deduplicated in walk order in this process, so the result is the same as one folder after the
+    other in a single process. Progress is printed every PROGRESS_INTERVAL seconds.
 
-    # Find and remove duplicates in each folder
-    for image_folder in image_folders:
-        print(f'Processing folder: {image_folder}')
-        find_and_remove_duplicates(image_folder)
+    With a ContentIndex, the images byte-identical to one seen before, in any folder, are not sent to the workers and
+    get the hash of that one, which is the hash they would have been given. `backend` is passed on to encode_files.
+    """
+    folders = iter_image_folders(parent_directory)
+    pending = collections.deque()
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def submit(image_folder):
+        if cache is not None:
+            cached = [] if contents is not None else None
+            encodings, missing = cache.lookup(image_folder, cached)
+            for path, info, image_hash in cached or ():
+                contents.add(path, info.st_size, image_hash)
+        else:
+            encodings, missing = {}, list_images(image_folder)
+        copies = []
+        if contents is not None:
+            unique = []
+            for filename, path, info in missing:
+                original = contents.original(path, info.st_size)
+                if original is None:
+                    unique.append((filename, path, info))
+                else:
+                    copies.append((filename, path, info, original))
+            missing = unique
+        paths = [path for _, path, _ in missing]
+        if executor is not None:
+            future = executor.submit(encode_files, paths, backend)
+        else:
+            future = Future()
+            future.set_result(encode_files(paths, backend))
+        pending.append((image_folder, encodings, missing, copies, future))
+
+    def add(encodings, filename, path, info, image_hash):
+        if cache is not None:
+            cache.add(path, info, image_hash)
+        if contents is not None:
+            contents.hashes[path] = image_hash
+        if image_hash:
+            encodings[filename] = image_hash
+
+    started = last_report = time.time()
+    done = images = 0
+    try:
+        for image_folder in islice(folders, max(workers, 1) * FOLDERS_PER_WORKER):
+            submit(image_folder)
+        while pending:
+            image_folder, encodings, missing, copies, future = pending.popleft()
+            for (filename, path, info), image_hash in zip(missing, future.result()):
+                add(encodings, filename, path, info, image_hash)
+            # originals were submitted no later than their copies, so their hash is known by now
+            for filename, path, info, original in copies:
+                add(encodings, filename, path, info, contents.hashes[original])
+            for next_folder in islice(folders, 1):
+                submit(next_folder)
+
+            print(f'Processing folder: {image_folder}')
+            find_and_remove_duplicates(image_folder, cache, index, collisions, threshold,
+                                       dict(sorted(encodings.items())))
+            done += 1
+            images += len(encodings)
+            if time.time() - last_report >= PROGRESS_INTERVAL or not pending:
+                last_report = time.time()
+                elapsed = max(last_report - started, 1e-6)
+                print(f"{done} folders, {images} images in {elapsed:.1f} s: {done / elapsed:.1f} folders/s, "
+                      f"{images / elapsed:.1f} images/s")
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Remove near-duplicate images from every folder of a downloads tree')
+    parser.add_argument('parent_directory', nargs='?',
+                        default='C:\\Users\\joshu\\Documents\\MYCOVISION\\googleimagesdownloader\\downloads')
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f'hash every image again instead of using {HASH_CACHE_NAME} at the top of the tree')
+    parser.add_argument('--threshold', type=int, default=MAX_DISTANCE,
+                        help=f'maximum number of differing hash bits between duplicates (default: {MAX_DISTANCE})')
+    parser.add_argument('--collisions', help='csv file listing the images that look the same as one in another folder')
+    parser.add_argument('--no-exact', action='store_true',
+                        help='decode every image instead of reusing the hash of a byte-identical one')
+    parser.add_argument('--backend', choices=BACKENDS, default='imagededup',
+                        help='imagededup encodes one image at a time, numpy hashes the images of a folder at once; '
+                             'benchmark_hashing.py compares them (default: imagededup)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes hashing images (default: one per cpu)')
+    args = parser.parse_args()
+    parent_directory = args.parent_directory
+    cache = None if args.no_cache else HashCache(parent_directory)
+    # one index over the whole tree, so the same photo filed under two species is caught too
+    index = HashIndex()
+    collisions = []
+    contents = None if args.no_exact else ContentIndex()
+    started = time.time()
+
+    # Find and remove duplicates in each image folder
+    finished = False
+    try:
+        run_dedupe(parent_directory, cache, index, collisions, args.threshold, args.workers, contents,
+                   args.backend)
+        finished = True
+    finally:
+        if cache is not None:
+            # only prune after every folder was visited, an interrupted run keeps the hashes it did not get to
+            if not finished:
+                cache.seen.update(cache.entries)
+            cache.save()
+            print(f"Hashed {cache.misses} images, {cache.hits} came from the cache")
+    if contents is not None:
+        print(f"{contents.copies} images were byte-identical to another one and not decoded, "
+              f"{contents.reads} files read to find them")
+    print(f"{len(collisions)} images look the same as one in another folder")
+    if args.collisions:
+        with open(args.collisions, 'w', newline='') as report:
+            writer = csv.writer(report)
+            writer.writerow(['image', 'duplicate', 'distance'])
+            for kept, other, distance in collisions:
+                writer.writerow([os.path.relpath(kept, parent_directory), os.path.relpath(other, parent_directory),
+                                 distance])
+    print(f"Done in {time.time() - started:.1f} s")
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,325 @@
+"""End-to-end benchmark of download_executor against a local stand-in for Google and the image hosts.
+
+The stand-in server runs in its own process and serves
+    /search?q=...           a search results page with an AF_initDataCallback data pack
+    /_/.../batchexecute     the follow-up result pages asked for with pagination_backend http
+    /img/...                synthetic JPEGs with a configurable latency, failure rate and size distribution
+
+Search pages are synthetic, or replayed from a directory recorded with --record. Image urls in recorded pages are
+rewritten to the stand-in, so a replay never leaves the machine.
+
+Reported: images/sec, p50/p99 latency per image fetch, peak RSS of the downloader process, errors and the
+downloader's own stage timings.
+
+Usage:
+    python benchmarks/bench_e2e.py                                    # 4 synthetic keywords, 50 images each
+    python benchmarks/bench_e2e.py --keywords 8 --limit 200 --concurrency 16 --latency-ms 80 --failure-rate 0.1
+    python benchmarks/bench_e2e.py --record recorded --queries 'agaricus campestris,amanita muscaria'
+    python benchmarks/bench_e2e.py --fixtures recorded --limit 150
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, here)
+
+from google_images_download import google_images_download
+import fixtures
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+PAGE_SIZE = 100  # results per search page and per batchexecute page
+
+
+def slug(query):
+    return re.sub(r'[^a-z0-9]+', '_', query.lower()).strip('_')
+
+
+def jpeg(width, height, size):
+    """A JPEG header with the given dimensions, padded to `size` bytes."""
+    header = (b'\xff\xd8' + b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00' +
+              b'\xff\xc0' + struct.pack('>HBHHB', 11, 8, height, width, 1) + b'\x01\x11\x00')
+    return header + b'\x00' * max(0, size - len(header) - 2) + b'\xff\xd9'
+
+
+def ajax_chunk(pack):
+    payload = json.dumps([["wrb.fr", google_images_download.PAGINATION_RPC_ID, json.dumps(pack), None, None, None,
+                           "generic"]])
+    return ")]}'\n\n%d\n%s\n" % (len(payload), payload)
+
+
+class Recorded(object):
+    """Search pages and batchexecute chunks recorded with --record, their image urls pointed at the stand-in."""
+
+    def __init__(self, directory, base):
+        self.pages = {}
+        self.batches = {}  # cursor sent by the client -> chunk answering it
+        parser = google_images_download.googleimagesdownload()
+        n = 0
+        for path in sorted(glob.glob(os.path.join(directory, '*.html'))):
+            name = os.path.basename(path)[:-len('.html')]
+            with open(path, 'rb') as page_file:
+                page = page_file.read().decode('utf-8')
+            images, cursor = parser._image_objects_and_cursor(parser._extract_data_pack_bytes(page.encode('utf-8')))
+            page, n = self._rewrite(page, images, base, n)
+            self.pages[name] = page.encode('utf-8')
+            batch_paths = sorted(glob.glob(os.path.join(directory, name + '.batch-*.txt')),
+                                 key=lambda p: int(p.rsplit('-', 1)[1].split('.')[0]))
+            for batch_path in batch_paths:
+                if not cursor:
+                    break
+                with open(batch_path, 'rb') as batch_file:
+                    chunk = batch_file.read().decode('utf-8')
+                images, next_cursor = parser._image_objects_and_cursor(parser._extract_data_pack_ajax(chunk))
+                chunk, n = self._rewrite(chunk, images, base, n)
+                self.batches[json.dumps(cursor)] = chunk.encode('utf-8')
+                cursor = next_cursor
+
+    @staticmethod
+    def _rewrite(text, images, base, n):
+        for obj in images:
+            url = obj[1][3][0]
+            local = "%s/img/rec/%d.jpg" % (base, n)
+            n += 1
+            escaped = json.dumps(url)[1:-1]
+            text = text.replace(escaped, local)
+            text = text.replace(json.dumps(escaped)[1:-1], local)  # urls inside a json string
+        return text, n
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+    recorded = None
+
+    def reply(self, status, body=b'', content_type="text/html; charset=UTF-8"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def base(self):
+        return "http://%s:%d" % self.server.server_address[:2]
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        if parts.path == '/search':
+            query = parse_qs(parts.query).get('q', [''])[0]
+            if self.recorded is not None:
+                page = self.recorded.pages.get(slug(query))
+                return self.reply(200 if page else 404, page or b'')
+            return self.reply(200, fixtures.search_page(
+                n_images=PAGE_SIZE, n_tabs=10, filler_kb=self.config['filler_kb'],
+                image_base="%s/img/%s/" % (self.base(), slug(query)), cursor="1",
+                seed=zlib.crc32(query.encode('utf-8'))))
+        if parts.path.startswith('/img/'):
+            return self.image(parts.path)
+        self.reply(404)
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode('utf-8'))
+        rpc = json.loads(form["f.req"][0])[0][0]
+        empty, cursor, query = json.loads(rpc[1])
+        if self.recorded is not None:
+            chunk = self.recorded.batches.get(json.dumps(cursor))
+            return self.reply(200 if chunk else 404, chunk or b'')
+        page = int(cursor)
+        first = page * PAGE_SIZE
+        urls = ["%s/img/%s/%d/agaricus_%d.jpg" % (self.base(), slug(query), n, n) for n in
+                range(first, first + PAGE_SIZE)]
+        next_cursor = str(page + 1) if page + 1 < self.config['pages'] else None
+        self.reply(200, ajax_chunk(fixtures.data_pack(urls, next_cursor, page)).encode('utf-8'))
+
+    def image(self, path):
+        config = self.config
+        rng = random.Random("%d:%s" % (config['seed'], path))
+        time.sleep(rng.lognormvariate(0, config['latency_sigma']) * config['latency_ms'] / 1000.0)
+        if rng.random() < config['failure_rate']:
+            return self.reply(503, b'unavailable')
+        size = int(rng.lognormvariate(0, config['size_sigma']) * config['size_kb'] * 1024)
+        self.reply(200, jpeg(rng.randint(300, 4000), rng.randint(300, 4000), size), "image/jpeg")
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        pass  # clients drop connections on purpose, e.g. when hedged downloads are cancelled
+
+
+def serve(config, fixtures_dir, ready):
+    server = StandInServer(("127.0.0.1", 0), StandInHandler)
+    StandInHandler.config = config
+    if fixtures_dir:
+        StandInHandler.recorded = Recorded(fixtures_dir, "http://127.0.0.1:%d" % server.server_port)
+    ready.put(server.server_port)
+    server.serve_forever()
+
+
+class LocalDownloader(google_images_download.googleimagesdownload):
+    """Searches the stand-in instead of google and keeps the duration of every image fetch."""
+
+    def __init__(self, base):
+        google_images_download.googleimagesdownload.__init__(self)
+        self.base = base
+        self.fetch_times = []
+        self._times_lock = threading.Lock()
+
+    def build_search_url(self, search_term, params, url, similar_images, specific_site, safe_search):
+        return self.base + '/search?q=' + quote(search_term.encode('utf-8')) + '&tbm=isch' + params
+
+    def fetch_image(self, *args, **kwargs):
+        start = time.perf_counter()
+        fetched = google_images_download.googleimagesdownload.fetch_image(self, *args, **kwargs)
+        with self._times_lock:
+            self.fetch_times.append(time.perf_counter() - start)
+        return fetched
+
+
+class RecordingDownloader(google_images_download.googleimagesdownload):
+    """Saves the body of every search request: <query>.html, then <query>.batch-<n>.txt for each follow-up page."""
+
+    def __init__(self, directory):
+        google_images_download.googleimagesdownload.__init__(self)
+        self.directory = directory
+        self.name = None
+        self.requests = 0
+
+    def _search_request(self, url, headers, data=None):
+        body = google_images_download.googleimagesdownload._search_request(self, url, headers, data)
+        if self.requests == 0:
+            path = os.path.join(self.directory, self.name + '.html')
+        else:
+            path = os.path.join(self.directory, "%s.batch-%d.txt" % (self.name, self.requests))
+        self.requests += 1
+        with open(path, 'wb') as output_file:
+            output_file.write(body)
+        return body
+
+
+def record(directory, queries, limit):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    recorder = RecordingDownloader(directory)
+    arguments = dict((arg, None) for arg in google_images_download.args_list)
+    arguments['pagination_backend'] = 'http'
+    for query in queries:
+        recorder.name = slug(query)
+        recorder.requests = 0
+        url = recorder.build_search_url(query, '', None, None, None, None)
+        images, tabs = recorder.search(url, limit, arguments)
+        print("%-40s %4d results, %d requests saved" % (query[:40], len(images), recorder.requests))
+        time.sleep(2)
+    recorder.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024.0 / (1024.0 if sys.platform == 'darwin' else 1.0)  # bytes on macOS, KB elsewhere
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keywords', help='number of synthetic keywords', type=int, default=4)
+    parser.add_argument('--limit', help='images per keyword', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--keyword-workers', type=int, default=1)
+    parser.add_argument('--hedge', type=int, default=0)
+    parser.add_argument('--latency-ms', help='median time to first byte of an image', type=float, default=20)
+    parser.add_argument('--latency-sigma', help='log-normal spread of the latency', type=float, default=0.75)
+    parser.add_argument('--failure-rate', help='fraction of images answered with 503', type=float, default=0.05)
+    parser.add_argument('--size-kb', help='median image size', type=float, default=120)
+    parser.add_argument('--size-sigma', help='log-normal spread of the image size', type=float, default=0.6)
+    parser.add_argument('--pages', help='result pages per synthetic query', type=int, default=5)
+    parser.add_argument('--filler-kb', help='unrelated script in each synthetic page', type=int, default=400)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fixtures', help='replay the search pages recorded in this directory', type=str)
+    parser.add_argument('--record', help='record real search responses into this directory and exit', type=str)
+    parser.add_argument('--queries', help='comma separated queries to record or replay', type=str)
+    parser.add_argument('--keep', help='keep the downloaded images in this directory', type=str)
+    args = parser.parse_args()
+
+    if args.record:
+        if not args.queries:
+            parser.error('--record needs --queries')
+        record(args.record, [q.strip() for q in args.queries.split(',')], args.limit)
+        return
+
+    if args.fixtures:
+        queries = ([q.strip() for q in args.queries.split(',')] if args.queries else
+                   [os.path.basename(p)[:-len('.html')].replace('_', ' ')
+                    for p in sorted(glob.glob(os.path.join(args.fixtures, '*.html')))])
+    else:
+        queries = ["agaricus species %d" % n for n in range(args.keywords)]
+
+    config = {'latency_ms': args.latency_ms, 'latency_sigma': args.latency_sigma, 'failure_rate': args.failure_rate,
+              'size_kb': args.size_kb, 'size_sigma': args.size_sigma, 'pages': args.pages,
+              'filler_kb': args.filler_kb, 'seed': args.seed}
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(config, args.fixtures, ready), daemon=True)
+    server.start()
+    port = ready.get(timeout=60)
+
+    output = args.keep or tempfile.mkdtemp(prefix='bench_e2e_')
+    downloader = LocalDownloader("http://127.0.0.1:%d" % port)
+    arguments = {'keywords': ','.join(queries), 'limit': args.limit, 'output_directory': output,
+                 'silent_mode': True, 'concurrency': args.concurrency, 'keyword_workers': args.keyword_workers,
+                 'hedge': args.hedge or None, 'pagination_backend': 'http'}
+    try:
+        start = time.perf_counter()
+        paths, errors = downloader.download_executor(arguments)
+        elapsed = time.perf_counter() - start
+    finally:
+        downloader.close()
+        server.terminate()
+        if not args.keep:
+            shutil.rmtree(output, ignore_errors=True)
+
+    images = sum(len(keyword_paths) for keyword_paths in paths.values())
+    summary = downloader.metrics.summary()
+    rss = peak_rss_mb()
+    print("keywords %d, images %d, errors %d, %.2f s" % (len(queries), images, errors, elapsed))
+    print("images/sec          %10.1f" % (images / elapsed if elapsed else 0))
+    print("fetch latency p50   %10.1f ms" % (percentile(downloader.fetch_times, 0.5) * 1000))
+    print("fetch latency p99   %10.1f ms" % (percentile(downloader.fetch_times, 0.99) * 1000))
+    print("bytes               %10d" % summary['bytes'])
+    print("peak RSS            %10s" % ("%.1f MB" % rss if rss is not None else "n/a"))
+    print("connection reuse    %10.1f %%" % (downloader.pool.reuse_ratio() * 100))
+    for stage, timing in sorted(summary['stages'].items()):
+        print("stage %-13s %10.2f s in %d calls" % (stage, timing['seconds'], timing['count']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Compare parse time and peak memory of the two search page parsers.
+
+    old: str(bytes) -> _extract_data_pack (unicode_escape) -> _image_objects_from_pack
+    new: bytes -> _extract_data_pack_bytes -> _image_objects_from_pack
+
+Usage:
+    python benchmarks/bench_parse.py                      # synthetic pages
+    python benchmarks/bench_parse.py --pages 'saved/*.html'   # pages saved from a browser or by bench_e2e --record
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, here)
+
+from google_images_download import google_images_download
+import fixtures
+
+
+def old_parse(response, page):
+    return response._image_objects_from_pack(response._extract_data_pack(str(page)))
+
+
+def new_parse(response, page):
+    return response._image_objects_from_pack(response._extract_data_pack_bytes(page))
+
+
+def measure(parse, response, page, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        images = parse(response, page)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    parse(response, page)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return images, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', help='glob of saved search result pages', type=str)
+    parser.add_argument('--repeat', help='timing runs per page (best is reported)', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.pages:
+        pages = []
+        for path in sorted(glob.glob(args.pages)):
+            with open(path, 'rb') as page_file:
+                pages.append((os.path.basename(path), page_file.read()))
+    else:
+        pages = [("synthetic %d images" % n, fixtures.search_page(n_images=n)) for n in (100, 400)]
+
+    response = google_images_download.googleimagesdownload()
+    print("%-24s %9s %10s %10s %8s %12s %12s" % ("page", "KB", "old ms", "new ms", "speedup", "old peak KB",
+                                                 "new peak KB"))
+    for name, page in pages:
+        old_images, old_time, old_peak = measure(old_parse, response, page, args.repeat)
+        new_images, new_time, new_peak = measure(new_parse, response, page, args.repeat)
+        if len(old_images) != len(new_images):
+            print("warning: %s parsed to %d images with the old parser and %d with the new one"
+                  % (name, len(old_images), len(new_images)))
+        print("%-24s %9d %10.2f %10.2f %7.1fx %12d %12d" % (
+            name[:24], len(page) // 1024, old_time * 1000, new_time * 1000, old_time / new_time, old_peak // 1024,
+            new_peak // 1024))
+
+
+if __name__ == '__main__':
+    main()
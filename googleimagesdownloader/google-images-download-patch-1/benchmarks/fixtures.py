@@ -0,0 +1,58 @@
+"""Synthetic Google Images result pages, laid out the way googleimagesdownload parses them.
+
+Used by the benchmarks when no recorded pages are given. The data pack puts the result grid at
+[56][-1][0][-1][-1][0] like the live pages do, and the related keyword tabs are "dtviD" anchors.
+"""
+import json
+import random
+
+FILLER_LINE = "var _g={'kEI':'x5Y3ZeK',\"kBL\":\"aGx2\"};(function(){var a=window.performance;a&&a.mark(\"gws\");})();\n"
+
+
+def image_object(n, image_url, width=800, height=600):
+    info = [None] * 18
+    info[2] = "https://source%d.example/mushrooms/%d.html" % (n % 50, n)
+    info[3] = "Agaricus campestris – field mushroom \"%d\"" % n
+    info[17] = "source%d.example" % (n % 50)
+    data = [None] * 26
+    data[1] = "id%d" % n
+    data[2] = ["https://encrypted-tbn0.gstatic.com/images?q=tbn:%d" % n, 150, 150]
+    data[3] = [image_url, width, height]
+    data[25] = {"2003": info}
+    return [[{"444383007": [1, data]}]]
+
+
+def data_pack(image_urls, cursor=None, seed=0):
+    rng = random.Random(seed)
+    grid = []
+    for n, url in enumerate(image_urls):
+        grid.append(image_object(n, url, rng.randint(200, 4000), rng.randint(200, 4000)))
+        if n % 20 == 10:
+            grid.append([[{"1": None}]])  # ads and carousels come through empty
+    pack = [None] * 57
+    pack[56] = [[[[[grid, cursor]]]]]
+    return pack
+
+
+def tab_anchors(names):
+    anchors = []
+    for n, name in enumerate(names):
+        anchors.append('<a class="dtviD" data-n="%d" href="/search?q=agaricus&amp;tbm=isch&amp;chips=q:agaricus,'
+                       'g_1:%s:AbC%d&amp;usg=AI4_-kQ%d"><span>%s</span></a>' % (n, name.replace(' ', '+'), n, n, name))
+    return ''.join(anchors)
+
+
+def search_page(n_images=100, n_tabs=20, filler_kb=400, image_base="https://images.example/", cursor=None,
+                seed=0):
+    """Bytes of a search results page with `n_images` results, `n_tabs` related keywords and roughly `filler_kb`
+    kilobytes of unrelated script."""
+    image_urls = ["%s%d/agaricus_%d.jpg" % (image_base, n, n) for n in range(n_images)]
+    names = ["related keyword %d" % n for n in range(n_tabs)]
+    filler = FILLER_LINE * (filler_kb * 1024 // len(FILLER_LINE))
+    pack = json.dumps(data_pack(image_urls, cursor, seed), ensure_ascii=False, separators=(',', ':'))
+    page = ('<!doctype html><html><head><script nonce="n">' + filler + '</script></head><body>'
+            '<div class="IUOThf">' + tab_anchors(names) + '</div>'
+            "<script nonce=\"n\">AF_initDataCallback({key: 'ds:0', hash: '1', data:[[]], sideChannel: {}});</script>"
+            "<script nonce=\"n\">AF_initDataCallback({key: 'ds:1', hash: '2', data:" + pack +
+            ", sideChannel: {}});</script></body></html>")
+    return page.encode('utf-8')
@@ -14,7 +14,7 @@ if cur_version >= version:  # If the Current Version of Python is 3.0 or above
     import urllib.request
     from urllib.request import Request, urlopen
     from urllib.request import URLError, HTTPError
-    from urllib.parse import quote
+    from urllib.parse import quote, urljoin, urlsplit, parse_qs
     import http.client
     from http.client import IncompleteRead, BadStatusLine
 
@@ -24,19 +24,35 @@ else:  # If the Current Version of Python is 2.x
     from urllib2 import Request, urlopen
     from urllib2 import URLError, HTTPError
     from urllib import quote
+    from urlparse import urljoin, urlsplit, parse_qs
     import httplib
     from httplib import IncompleteRead, BadStatusLine
 
     httplib._MAXHEADERS = 1000
 import time  # Importing the time library to check the time of code execution
 import os
+import random
 import argparse
 import ssl
 import datetime
 import json
 import re
+import struct
 import codecs
 import socket
+import collections
+import contextlib
+import errno
+import hashlib
+import itertools
+import logging
+import math
+import multiprocessing
+import shutil
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 args_list = ["keywords", "keywords_from_file", "prefix_keywords", "suffix_keywords",
              "limit", "format", "color", "color_type", "usage_rights", "size",
@@ -45,7 +61,89 @@ args_list = ["keywords", "keywords_from_file", "prefix_keywords", "suffix_keywor
              "print_urls", "print_size", "print_paths", "metadata", "extract_metadata", "socket_timeout",
              "thumbnail", "thumbnail_only", "language", "prefix", "chromedriver", "browser", "related_images", "safe_search",
              "no_numbering",
-             "offset", "no_download", "save_source", "silent_mode", "ignore_urls"]
+             "offset", "no_download", "save_source", "silent_mode", "ignore_urls", "concurrency", "max_bytes",
+             "content_store", "manifest", "search_cache", "search_cache_ttl", "search_cache_size",
+             "pagination_backend", "keyword_workers",
+             "search_rate", "search_burst", "host_health", "host_failure_limit", "hedge",
+             "min_width", "min_height", "max_width", "max_height", "allowed_formats", "min_aspect_ratio",
+             "max_aspect_ratio", "metrics_file", "prometheus_file", "local_thumbnails", "thumbnail_size",
+             "process_workers", "normalize", "normalize_size", "reject_duplicates", "duplicate_distance"]
+
+CHUNK_SIZE = 64 * 1024  # bytes read from the network per write to disk
+HEDGE_MAX_IN_FLIGHT = 64  # upper bound on limit + hedge fetches running at once
+PROBE_BYTES = 32 * 1024  # read to find the dimensions of a candidate the search results give none for
+MANIFEST_RETRY_AFTER = 86400  # seconds before a URL whose download failed is tried again
+MANIFEST_MAX_ATTEMPTS = 3  # failed downloads of a URL after which it is skipped for good
+THUMBNAIL_SIZE = 256  # longest side in pixels of the thumbnails made by local_thumbnails
+NORMALIZE_QUALITY = 90  # JPEG quality of normalized images
+DUPLICATE_DISTANCE = 10  # images whose perceptual hashes differ in at most this many bits are near-duplicates
+PHASH_FORMATS = ('JPEG', 'PNG', 'BMP', 'MPO', 'PPM', 'TIFF', 'GIF', 'WEBP')  # what imagededup's PHash decodes
+PHASH_CACHE_NAME = '.phash_cache.json'  # written by dedupe_images.py at the top of the downloads tree
+IMAGE_FORMATS = ('jpg', 'gif', 'png', 'bmp', 'svg', 'webp', 'ico')
+
+# Messages printed for every image go through this logger, unless silent_mode is set. It has no handler of its own:
+# the application configures logging, main() sends it to stdout.
+log = logging.getLogger("google_images_download")
+log.addHandler(logging.NullHandler())
+
+# HTTP pagination in download_paginated_page, experimental. The rpc id, the request payload and where the next cursor
+# sits in the answer are not documented and were not checked against google; adjust them here
+PAGINATION_PATH = "/_/VisualFrontendUi/data/batchexecute"
+PAGINATION_RPC_ID = "HoAMBc"
+PAGINATION_MAX_PAGES = 50
+
+# Search requests google answered with one of these, or redirected to a /sorry/ page, are retried after a backoff
+THROTTLE_CODES = (429, 503)
+SEARCH_ATTEMPTS = 5
+
+# Scrolling in download_extended_page
+SCROLL_PAUSE = 0.2  # seconds between two PAGE_DOWN presses
+SCROLL_IDLE_TIMEOUT = 3  # seconds without a new batch before the page counts as exhausted
+SCROLL_MAX_PRESSES = 110
+
+# Keeps the body of every batchexecute response (XHR or fetch) in window.__gidBatches. Installed before the page
+# loads where the browser supports it, and again after loading otherwise; the second install is a no-op.
+BATCH_CAPTURE_SCRIPT = """
+(function() {
+    if (window.__gidBatches) {
+        return;
+    }
+    window.__gidBatches = [];
+    var open = XMLHttpRequest.prototype.open;
+    var send = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.open = function(method, url) {
+        this.__gidUrl = String(url);
+        return open.apply(this, arguments);
+    };
+    XMLHttpRequest.prototype.send = function() {
+        if (this.__gidUrl && this.__gidUrl.indexOf('/batchexecute') !== -1) {
+            this.addEventListener('load', function() {
+                window.__gidBatches.push(this.responseText);
+            });
+        }
+        return send.apply(this, arguments);
+    };
+    if (window.fetch) {
+        var fetch = window.fetch;
+        window.fetch = function(input) {
+            var url = typeof input === 'string' ? input : (input && input.url) || '';
+            var promise = fetch.apply(this, arguments);
+            if (url.indexOf('/batchexecute') !== -1) {
+                promise.then(function(response) {
+                    return response.clone().text();
+                }).then(function(text) {
+                    window.__gidBatches.push(text);
+                }, function() {});
+            }
+            return promise;
+        };
+    }
+})();
+"""
+
+# href of every related keyword tab on a results page, see get_all_tabs
+TAB_PATTERN = re.compile(r'class="dtviD".*?href="(.*?)">', re.S)
+TAB_PATTERN_BYTES = re.compile(br'class="dtviD".*?href="(.*?)">', re.S)
 
 
 def user_input():
@@ -170,6 +268,84 @@ def user_input():
         parser.add_argument('-is', '--save_source',
                             help="creates a text file containing a list of downloaded images along with source page url",
                             type=str, required=False)
+        parser.add_argument('-cc', '--concurrency', help='number of images to download in parallel', type=int,
+                            required=False)
+        parser.add_argument('-mb', '--max_bytes', help='skip images larger than this many bytes', type=int,
+                            required=False)
+        parser.add_argument('-cs', '--content_store',
+                            help='directory where each unique image is stored once and hard linked into the keyword '
+                                 'directories', type=str, required=False)
+        parser.add_argument('-mf', '--manifest',
+                            help='sqlite file recording every image url tried, urls already in it are skipped',
+                            type=str, required=False)
+        parser.add_argument('-sc', '--search_cache', help='directory where parsed search results are cached',
+                            type=str, required=False)
+        parser.add_argument('-sct', '--search_cache_ttl',
+                            help='seconds a cached search result stays valid (default: one day)', type=float,
+                            required=False)
+        parser.add_argument('-scs', '--search_cache_size',
+                            help='maximum number of cached search results (default: 10000)', type=int,
+                            required=False)
+        parser.add_argument('-pb', '--pagination_backend',
+                            help='how to get more than 100 results: scroll a browser (default) or request the pages '
+                                 'over http (experimental)',
+                            type=str, required=False, choices=['browser', 'http'])
+        parser.add_argument('-kw', '--keyword_workers', help='number of keywords searched and downloaded at once',
+                            type=int, required=False)
+        parser.add_argument('-sr', '--search_rate', help='maximum number of search requests per second',
+                            type=float, required=False)
+        parser.add_argument('-sb', '--search_burst',
+                            help='number of search requests that can go out at once before search_rate applies',
+                            type=int, required=False)
+        parser.add_argument('-hh', '--host_health',
+                            help='json file keeping the download record of every image host across runs', type=str,
+                            required=False)
+        parser.add_argument('-hfl', '--host_failure_limit',
+                            help='skip a host for a while after this many failures in a row (default: 5)', type=int,
+                            required=False)
+        parser.add_argument('-hg', '--hedge',
+                            help='keep this many downloads in flight beyond what is still needed and cancel the rest '
+                                 'once the limit is reached', type=int, required=False)
+        parser.add_argument('-mnw', '--min_width', help='skip images narrower than this many pixels', type=int,
+                            required=False)
+        parser.add_argument('-mnh', '--min_height', help='skip images lower than this many pixels', type=int,
+                            required=False)
+        parser.add_argument('-mxw', '--max_width', help='skip images wider than this many pixels', type=int,
+                            required=False)
+        parser.add_argument('-mxh', '--max_height', help='skip images higher than this many pixels', type=int,
+                            required=False)
+        parser.add_argument('-af', '--allowed_formats', help='comma separated image formats to download, e.g. jpg,png',
+                            type=str, required=False)
+        parser.add_argument('-mnar', '--min_aspect_ratio', help='skip images whose width / height is below this',
+                            type=float, required=False)
+        parser.add_argument('-mxar', '--max_aspect_ratio', help='skip images whose width / height is above this',
+                            type=float, required=False)
+        parser.add_argument('-mtf', '--metrics_file', help='json file the timings and counters of the run are written to',
+                            type=str, required=False)
+        parser.add_argument('-pmf', '--prometheus_file',
+                            help='file the timings and counters of the run are written to in the prometheus text format',
+                            type=str, required=False)
+        parser.add_argument('-lth', '--local_thumbnails', default=False,
+                            help="Makes the thumbnails from the downloaded images instead of downloading them, "
+                                 "needs Pillow", action="store_true")
+        parser.add_argument('-ths', '--thumbnail_size',
+                            help='longest side in pixels of the local thumbnails (default: 256)', type=int,
+                            required=False)
+        parser.add_argument('-pw', '--process_workers',
+                            help='number of processes making local thumbnails and normalizing images (default: one '
+                                 'per cpu)', type=int, required=False)
+        parser.add_argument('-nz', '--normalize', default=False,
+                            help="Converts the downloaded images to JPEG without metadata and drops the ones that do "
+                                 "not decode, needs Pillow", action="store_true")
+        parser.add_argument('-nzs', '--normalize_size',
+                            help='scale normalized images down to fit in this many pixels on their longest side',
+                            type=int, required=False)
+        parser.add_argument('-rd', '--reject_duplicates', default=False,
+                            help="Drops downloads that look the same as an image already in the keyword directory, "
+                                 "they do not count towards the limit, needs Pillow", action="store_true")
+        parser.add_argument('-dd', '--duplicate_distance',
+                            help='maximum number of differing perceptual hash bits between near-duplicates '
+                                 '(default: 10)', type=int, required=False)
 
         args = parser.parse_args()
         arguments = vars(args)
@@ -178,9 +354,1067 @@ def user_input():
     return records
 
 
-class googleimagesdownload:
+# Send the logger's messages to stdout as plain lines, for the command line
+def configure_log():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+
+
+class Metrics(object):
+    """Counters and timings of a downloader, per keyword directory and in total.
+
+    Stages are search (requests to google, including any backoff, or the whole browser session), parse (data pack to
+    image objects), fetch (image download to a temporary file), hash (perceptual hash of the download, with
+    reject_duplicates) and write (moving it into place). Stage times are
+    summed over threads, so with concurrency they add up to more than the wall time; `seconds` of a keyword is its
+    wall time. Measurements made on a thread are counted for the keyword set with keyword_timer on that thread unless
+    a keyword is given.
+    """
+    stages = ('search', 'parse', 'fetch', 'hash', 'write')
+
     def __init__(self):
+        self.started = time.time()
+        self.keywords = collections.OrderedDict()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _entry(self, keyword):
+        if keyword is None:
+            keyword = getattr(self._local, 'keyword', '')
+        entry = self.keywords.get(keyword)
+        if entry is None:
+            entry = self.keywords[keyword] = {
+                'seconds': 0.0, 'images': 0, 'bytes': 0, 'duplicates': 0, 'errors': {},
+                'stages': dict((stage, {'count': 0, 'seconds': 0.0}) for stage in self.stages)}
+        return entry
+
+    @contextlib.contextmanager
+    def keyword_timer(self, keyword):
+        previous = getattr(self._local, 'keyword', '')
+        self._local.keyword = keyword
+        started = time.time()
+        try:
+            yield
+        finally:
+            self._local.keyword = previous
+            with self._lock:
+                self._entry(keyword)['seconds'] += time.time() - started
+
+    @contextlib.contextmanager
+    def timer(self, stage, keyword=None):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - started, keyword)
+
+    def add_time(self, stage, seconds, keyword=None):
+        with self._lock:
+            timing = self._entry(keyword)['stages'][stage]
+            timing['count'] += 1
+            timing['seconds'] += seconds
+
+    def add_image(self, size, keyword=None):
+        with self._lock:
+            entry = self._entry(keyword)
+            entry['images'] += 1
+            entry['bytes'] += size
+
+    def add_duplicate(self, keyword=None):
+        with self._lock:
+            self._entry(keyword)['duplicates'] += 1
+
+    def add_error(self, error_class, keyword=None):
+        with self._lock:
+            errors = self._entry(keyword)['errors']
+            errors[error_class] = errors.get(error_class, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            keywords = json.loads(json.dumps(self.keywords))
+        elapsed = time.time() - self.started
+        total = {'seconds': elapsed, 'images': 0, 'bytes': 0, 'duplicates': 0, 'errors': {},
+                 'stages': dict((stage, {'count': 0, 'seconds': 0.0}) for stage in self.stages)}
+        for entry in keywords.values():
+            entry['images_per_second'] = entry['images'] / entry['seconds'] if entry['seconds'] else 0.0
+            total['images'] += entry['images']
+            total['bytes'] += entry['bytes']
+            total['duplicates'] += entry['duplicates']
+            for error_class, count in entry['errors'].items():
+                total['errors'][error_class] = total['errors'].get(error_class, 0) + count
+            for stage, timing in entry['stages'].items():
+                total['stages'][stage]['count'] += timing['count']
+                total['stages'][stage]['seconds'] += timing['seconds']
+        total['images_per_second'] = total['images'] / elapsed if elapsed else 0.0
+        total['keywords'] = keywords
+        return total
+
+    def write_json(self, path):
+        self._write(path, json.dumps(self.summary(), indent=4, sort_keys=True))
+
+    def write_prometheus(self, path):
+        summary = self.summary()
+        label = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP " + name + " " + help)
+            lines.append("# TYPE " + name + " " + kind)
+            for labels, value in samples:
+                labels = ','.join(key + '="' + label(value_) + '"' for key, value_ in labels)
+                lines.append(name + ('{' + labels + '}' if labels else '') + " " + repr(float(value)))
+
+        keywords = summary['keywords']
+        metric("gid_images_total", "counter", "Images downloaded.",
+               [((('keyword', k),), e['images']) for k, e in keywords.items()])
+        metric("gid_bytes_total", "counter", "Bytes of the images downloaded.",
+               [((('keyword', k),), e['bytes']) for k, e in keywords.items()])
+        metric("gid_duplicates_total", "counter", "Downloads dropped as near-duplicates.",
+               [((('keyword', k),), e['duplicates']) for k, e in keywords.items()])
+        metric("gid_errors_total", "counter", "Failed downloads by exception class.",
+               [((('keyword', k), ('error', c)), n) for k, e in keywords.items() for c, n in e['errors'].items()])
+        metric("gid_stage_seconds_total", "counter", "Time spent per stage, summed over threads.",
+               [((('keyword', k), ('stage', st)), t['seconds']) for k, e in keywords.items()
+                for st, t in e['stages'].items()])
+        metric("gid_stage_calls_total", "counter", "Number of times each stage ran.",
+               [((('keyword', k), ('stage', st)), t['count']) for k, e in keywords.items()
+                for st, t in e['stages'].items()])
+        metric("gid_keyword_seconds", "gauge", "Wall time of each keyword.",
+               [((('keyword', k),), e['seconds']) for k, e in keywords.items()])
+        metric("gid_images_per_second", "gauge", "Images downloaded per second over the whole run.",
+               [((), summary['images_per_second'])])
+        self._write(path, '\n'.join(lines) + '\n')
+
+    # written under a temporary name first, so readers never see half a file
+    @staticmethod
+    def _write(path, text):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+        with os.fdopen(fd, 'w') as output_file:
+            output_file.write(text)
+        os.replace(temp_path, path)
+
+
+class BrowserUnavailable(Exception):
+    """Raised when no browser session can be started for a search of more than 100 images."""
+
+
+class FetchCancelled(Exception):
+    """Raised while streaming an image whose fetch was cancelled; `size` is the number of bytes already read."""
+
+    def __init__(self, size):
+        Exception.__init__(self, "cancelled after " + str(size) + " bytes")
+        self.size = size
+
+
+# Format, width and height read from the first bytes of a JPEG, PNG, GIF, WebP or BMP file, None when the data
+# does not start like one of them or ends before the dimensions
+def image_header_info(data):
+    data = bytearray(data)
+    try:
+        if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR':
+            width, height = struct.unpack('>II', bytes(data[16:24]))
+            return 'png', width, height
+        if data[:6] in (b'GIF87a', b'GIF89a'):
+            width, height = struct.unpack('<HH', bytes(data[6:10]))
+            return 'gif', width, height
+        if data[:2] == b'BM':
+            width, height = struct.unpack('<ii', bytes(data[18:26]))
+            return 'bmp', width, abs(height)
+        if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+            chunk = data[12:16]
+            if chunk == b'VP8 ':
+                width, height = struct.unpack('<HH', bytes(data[26:30]))
+                return 'webp', width & 0x3fff, height & 0x3fff
+            if chunk == b'VP8L':
+                bits = struct.unpack('<I', bytes(data[21:25]))[0]
+                return 'webp', (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+            if chunk == b'VP8X':
+                width = data[24] | data[25] << 8 | data[26] << 16
+                height = data[27] | data[28] << 8 | data[29] << 16
+                return 'webp', width + 1, height + 1
+            return None
+        if data[:2] == b'\xff\xd8':
+            # walk the segments up to the first start of frame
+            i = 2
+            while i + 9 <= len(data):
+                if data[i] != 0xFF:
+                    return None
+                marker = data[i + 1]
+                if marker == 0xFF:  # fill byte
+                    i += 1
+                elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack('>HH', bytes(data[i + 5:i + 9]))
+                    return 'jpg', width, height
+                elif marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                    i += 2
+                else:
+                    i += 2 + struct.unpack('>H', bytes(data[i + 2:i + 4]))[0]
+    except struct.error:
         pass
+    return None
+
+
+# Write a copy of the image at `source` scaled down to fit in `max_side` x `max_side` pixels to `target`, in the
+# same format. Runs in a worker process of googleimagesdownload.get_process_pool; needs Pillow.
+def make_thumbnail(source, target, max_side):
+    from PIL import Image
+
+    image = Image.open(source)
+    image_format = image.format
+    image.thumbnail((max_side, max_side))
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+        image = image.convert('RGB')
+    directory = os.path.dirname(os.path.abspath(target))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as output_file:
+            image.save(output_file, format=image_format)
+        os.replace(temp_path, target)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return target
+
+
+# Decode the image at `source` and write it next to it as a JPEG with the same name, without its metadata and scaled
+# down to fit in `max_side` x `max_side` pixels when given. Transparency is flattened onto white and the EXIF
+# orientation is applied first. Raises when the image does not decode, truncated files included; `source` is left
+# alone unless it already has the JPEG name. Returns the path, size, width and height of the JPEG. Runs in a worker
+# process of googleimagesdownload.get_process_pool; needs Pillow.
+def normalize_image(source, max_side=None):
+    from PIL import Image, ImageOps
+
+    image = Image.open(source)
+    image.load()
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        flat = Image.new('RGB', image.size, (255, 255, 255))
+        flat.paste(image, mask=image.split()[3])
+        image = flat
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    target = os.path.splitext(source)[0] + '.jpg'
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(source)), prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as output_file:
+            image.save(output_file, format='JPEG', quality=NORMALIZE_QUALITY)
+        os.replace(temp_path, target)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return target, os.path.getsize(target), image.size[0], image.size[1]
+
+
+# Row k of the cosines of an unnormalized 32-point DCT-II, for the first 8 frequencies
+PHASH_COSINES = [[math.cos(math.pi * k * (2 * n + 1) / 64) for n in range(32)] for k in range(8)]
+
+
+# 64-bit perceptual hash of the image at `path` as an int, None when it does not decode. Gives the same bits as
+# imagededup's PHash, which dedupe_images.py uses: the image at 32 x 32 in grayscale, the top left 8 x 8 of its DCT,
+# one bit per coefficient set when it is at least the median of all of them but the first. The coefficients are
+# rounded first: flat and symmetric images have coefficients that are exactly zero, or equal to the median, which
+# the sums below only get to within rounding noise. Needs Pillow.
+def image_phash(path):
+    from PIL import Image
+
+    try:
+        image = Image.open(path)
+        if image.format not in PHASH_FORMATS:
+            return None
+        if image.mode != 'RGB':
+            image = image.convert('RGBA').convert('RGB')
+        pixels = bytearray(image.resize((32, 32), Image.LANCZOS).convert('L').tobytes())
+    except Exception:
+        return None
+    # the DCT along the rows, then down the first 8 columns of the result
+    rows = [[2 * sum(c * x for c, x in zip(cosines, pixels[i:i + 32])) for cosines in PHASH_COSINES]
+            for i in range(0, 1024, 32)]
+    coefficients = [round(2 * sum(c * row[u] for c, row in zip(cosines, rows)), 6) for cosines in PHASH_COSINES
+                    for u in range(8)]
+    median = sorted(coefficients[1:])[31]
+    image_hash = 0
+    for coefficient in coefficients:
+        image_hash = image_hash << 1 | (coefficient >= median)
+    return image_hash
+
+
+class NearDuplicateIndex(object):
+    """Perceptual hashes of the images in one keyword directory, for dropping downloads that look the same as one of
+    them. A directory holds a few hundred images, so a match is a scan of the list.
+
+    The first match or add hashes the images already in the directory, taking the hashes dedupe_images.py cached
+    for the files that have not changed since. That runs under timer(), when given, so it shows up in the metrics.
+    """
+
+    def __init__(self, directory, cached=None, timer=None):
+        self.directory = directory
+        self.cached = cached or {}  # filename -> [size, mtime_ns, hex hash]
+        self.timer = timer or contextlib.nullcontext
+        self.hashes = None  # [(hash, filename)]
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self.hashes is not None:
+            return
+        self.hashes = []
+        try:
+            filenames = sorted(os.listdir(self.directory))
+        except OSError:
+            filenames = []
+        with self.timer():
+            for filename in filenames:
+                path = os.path.join(self.directory, filename)
+                if filename.startswith('.') or not os.path.isfile(path):
+                    continue
+                try:
+                    info = os.stat(path)
+                except OSError:  # removed since it was listed
+                    continue
+                entry = self.cached.get(filename)
+                if entry and entry[0] == info.st_size and entry[1] == info.st_mtime_ns:
+                    image_hash = int(entry[2], 16) if entry[2] else None
+                else:
+                    image_hash = image_phash(path)
+                if image_hash is not None:
+                    self.hashes.append((image_hash, filename))
+
+    # The image at most `distance` bits away from `image_hash`, None when there is none
+    def match(self, image_hash, distance):
+        with self._lock:
+            self._load()
+            for other, filename in self.hashes:
+                if bin(image_hash ^ other).count('1') <= distance:
+                    return filename
+        return None
+
+    def add(self, image_hash, filename):
+        with self._lock:
+            self._load()
+            self.hashes.append((image_hash, filename))
+
+
+class PooledResponse(object):
+    """Response from ConnectionPool.urlopen. Closing it hands the connection back to the pool when the body was
+    read to the end, otherwise the connection is dropped."""
+
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    # whatever part of the next `amt` bytes is available, without waiting for all of them
+    def read1(self, amt=-1):
+        return self._response.read1(amt)
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def close(self):
+        if self._conn is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool._release(self._key, self._conn)
+        else:
+            self._response.close()
+            self._conn.close()
+        self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP(S) connections kept per (scheme, host, port) and shared between threads.
+
+    urlopen behaves like urllib's for the callers in this module: redirects are followed, HTTP error statuses raise
+    HTTPError and connection failures raise URLError. Requests that have to go through a proxy are handed to urllib.
+    """
+    redirect_codes = (301, 302, 303, 307, 308)
+
+    def __init__(self, max_per_host=10, max_redirects=5):
+        self.max_per_host = max_per_host
+        self.max_redirects = max_redirects
+        self.requests = 0
+        self.connections_opened = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def reuse_ratio(self):
+        if not self.requests:
+            return 0.0
+        return 1.0 - float(self.connections_opened) / self.requests
+
+    def stats(self):
+        return {'requests': self.requests, 'connections_opened': self.connections_opened,
+                'reuse_ratio': self.reuse_ratio()}
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def urlopen(self, url, headers=None, timeout=None, data=None):
+        headers = headers or {}
+        scheme = urlsplit(url).scheme
+        if scheme not in ('http', 'https') or scheme in urllib.request.getproxies():
+            return urlopen(Request(url, data=data, headers=headers), None,
+                           timeout if timeout is not None else socket.getdefaulttimeout())
+        method = 'POST' if data is not None else 'GET'
+        for _ in range(self.max_redirects + 1):
+            response = self._request(url, method, data, headers, timeout)
+            location = response.getheader('Location')
+            if response.status in self.redirect_codes and location:
+                response.read()  # drain the body so the connection can be reused
+                response.close()
+                if response.status == 303 or (response.status in (301, 302) and method == 'POST'):
+                    method, data = 'GET', None
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                response.close()
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            return response
+        response.close()
+        raise HTTPError(url, response.status, "Too many redirects", response.headers, None)
+
+    def _request(self, url, method, body, headers, timeout):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        conn, reused = self._acquire(key, timeout)
+        try:
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+            except (ConnectionError, BadStatusLine):
+                if not reused:
+                    raise
+                # the server closed the idle connection in the meantime, retry once on a fresh one
+                conn.close()
+                conn, reused = self._acquire(key, timeout, fresh=True)
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+        except OSError as e:
+            conn.close()
+            raise URLError(e)
+        except Exception:
+            conn.close()
+            raise
+        return PooledResponse(self, key, conn, response, url)
+
+    def _acquire(self, key, timeout, fresh=False):
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        with self._lock:
+            self.requests += 1
+            idle = self._idle.get(key)
+            if idle and not fresh:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            self.connections_opened += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        return conn, False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+
+class UrlManifest(object):
+    """SQLite record of every image URL the downloader has tried, with the outcome.
+
+    URLs in the manifest are skipped by later keywords and later runs, so an interrupted crawl picks up where it
+    stopped and repeated passes only fetch images they have not seen before. Every record is committed right away.
+
+    URLs are skipped whatever keyword directory they were recorded for: with one manifest shared by several keywords,
+    an image is only downloaded for the first keyword whose results had it. A failed URL is tried again once
+    `retry_after` seconds have passed since its last attempt, until it failed `max_attempts` times.
+    """
+
+    def __init__(self, path, retry_after=MANIFEST_RETRY_AFTER, max_attempts=MANIFEST_MAX_ATTEMPTS):
+        self.path = path
+        self.retry_after = retry_after
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS images (url TEXT PRIMARY KEY, species TEXT, status TEXT, '
+                         'bytes INTEGER, width INTEGER, height INTEGER, path TEXT, updated REAL, '
+                         'attempts INTEGER NOT NULL DEFAULT 1)')
+        # manifests written before failed urls were retried have no attempts column
+        if 'attempts' not in [row[1] for row in self._db.execute('PRAGMA table_info(images)')]:
+            self._db.execute('ALTER TABLE images ADD COLUMN attempts INTEGER NOT NULL DEFAULT 1')
+        self._db.commit()
+
+    # the subset of `urls` that is already in the manifest, leaving out failed ones that are due for another try
+    def known(self, urls):
+        urls = list(urls)
+        found = set()
+        retry_before = time.time() - self.retry_after
+        with self._lock:
+            for i in range(0, len(urls), 500):
+                batch = urls[i:i + 500]
+                rows = self._db.execute('SELECT url FROM images WHERE url IN (' + ','.join('?' * len(batch)) + ') '
+                                        'AND (status != \'fail\' OR attempts >= ? OR updated > ?)',
+                                        batch + [self.max_attempts, retry_before])
+                found.update(row[0] for row in rows)
+        return found
+
+    def record(self, url, species, status, bytes=None, width=None, height=None, path=None):
+        with self._lock:
+            row = self._db.execute('SELECT attempts FROM images WHERE url = ?', (url,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO images (url, species, status, bytes, width, height, path, '
+                             'updated, attempts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (url, species, status, bytes, width, height, path, time.time(),
+                              row[0] + 1 if row else 1))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SearchCache(object):
+    """Parsed search results (image objects and related tabs) kept on disk, one JSON file per search URL.
+
+    Entries expire `ttl` seconds after they were stored. Beyond `max_entries` the least recently used entries are
+    removed; the modification time of a file is its last use.
+    """
+
+    def __init__(self, directory, ttl=86400, max_entries=10000):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        entries = [entry for entry in os.listdir(directory) if entry.endswith('.json')]
+        entries.sort(key=lambda entry: os.path.getmtime(os.path.join(directory, entry)))
+        self._lru = collections.OrderedDict((entry, None) for entry in entries)
+
+    def _file_name(self, key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+
+    # (image objects, tabs) stored for `key`, or None
+    def get(self, key):
+        file_name = self._file_name(key)
+        path = os.path.join(self.directory, file_name)
+        with self._lock:
+            try:
+                with open(path) as cache_file:
+                    entry = json.load(cache_file)
+            except (IOError, ValueError):
+                entry = None
+            if entry is None or entry['key'] != key or time.time() - entry['time'] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            os.utime(path, None)
+            self._lru[file_name] = None
+            self._lru.move_to_end(file_name)
+        return entry['images'], entry['tabs']
+
+    def put(self, key, images, tabs):
+        file_name = self._file_name(key)
+        path = os.path.join(self.directory, file_name)
+        with self._lock:
+            with open(path + '.tmp', 'w') as cache_file:
+                json.dump({'key': key, 'time': time.time(), 'images': images, 'tabs': tabs}, cache_file)
+            os.replace(path + '.tmp', path)
+            self._lru[file_name] = None
+            self._lru.move_to_end(file_name)
+            while len(self._lru) > self.max_entries:
+                evicted, _ = self._lru.popitem(last=False)
+                try:
+                    os.remove(os.path.join(self.directory, evicted))
+                except OSError:
+                    pass
+
+
+class RateLimiter(object):
+    """Token bucket pacing search requests, shared by every keyword worker of a downloader.
+
+    `rate` tokens per second are added up to `burst`; without a rate requests are not paced. After google throttles
+    a request, backoff() holds every request back for an exponentially growing, jittered time until one succeeds.
+    `waited` is the total time requests spent in wait(), `throttled` the number of backoffs.
+    """
+
+    def __init__(self, rate=None, burst=1, base_backoff=2.0, max_backoff=300.0):
+        self.rate = rate
+        self.burst = burst
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.requests = 0
+        self.waited = 0.0
+        self.throttled = 0
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._blocked_until = 0.0
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def configure(self, rate, burst=None):
+        with self._lock:
+            self.rate = rate
+            self.burst = burst or 1
+            self._tokens = min(self._tokens, float(self.burst))
+
+    # Block until the next request may go out; returns the time waited
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            delay = 0.0
+            if self.rate:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._tokens -= 1  # may go negative: the token is reserved and the caller waits for it
+                if self._tokens < 0:
+                    delay = -self._tokens / self.rate
+            self._updated = now
+            delay = max(delay, self._blocked_until - now)
+            self.requests += 1
+            self.waited += delay
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    # Hold back all requests after a throttled one; returns the backoff in seconds
+    def backoff(self, retry_after=None):
+        with self._lock:
+            self._failures += 1
+            self.throttled += 1
+            delay = min(self.max_backoff, self.base_backoff * 2 ** (self._failures - 1))
+            delay = random.uniform(delay / 2, delay)
+            if retry_after:
+                delay = max(delay, min(self.max_backoff, retry_after))
+            self._blocked_until = max(self._blocked_until, time.time() + delay)
+        return delay
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+
+
+class HostHealth(object):
+    """Download record of every image host, optionally kept in a JSON file across runs.
+
+    Per host it keeps the number of attempts and successes, the latest latencies and the time of the last failure.
+    Hosts whose median latency is `slow_latency` seconds or more are ranked after the others, hosts that mostly fail
+    after those. A circuit breaker skips a host for `cooldown` seconds after
+    `failure_limit` failures in a row; the breaker state is not persisted. The ignore_urls blocklist is kept here as
+    one compiled pattern.
+    """
+    latency_samples = 20
+    min_attempts = 3  # before a host can be ranked as bad
+    slow_latency = 5.0  # seconds, half the default socket_timeout
+
+    def __init__(self, path=None, failure_limit=5, cooldown=600):
+        self.path = None
+        self.failure_limit = failure_limit
+        self.cooldown = cooldown
+        self.hosts = {}
+        self.skipped = 0
+        self._streaks = {}
+        self._open = {}
+        self._blocklists = {}
+        self._lock = threading.Lock()
+        if path:
+            self.load(path)
+
+    @staticmethod
+    def host(url):
+        return urlsplit(url).netloc.lower()
+
+    # Merge the record saved at `path` and save there from now on
+    def load(self, path):
+        if path == self.path:
+            return
+        try:
+            with open(path) as health_file:
+                saved = json.load(health_file)
+        except (IOError, OSError, ValueError):
+            saved = {}
+        with self._lock:
+            self.path = path
+            for host, entry in saved.items():
+                self.hosts.setdefault(host, entry)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self.hosts)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+        with os.fdopen(fd, 'w') as health_file:
+            health_file.write(data)
+        os.replace(temp_path, self.path)
+
+    def record(self, url, ok, latency=None):
+        host = self.host(url)
+        with self._lock:
+            entry = self.hosts.setdefault(host, {'attempts': 0, 'successes': 0, 'latencies': [],
+                                                 'last_failure': None})
+            entry['attempts'] += 1
+            if ok:
+                entry['successes'] += 1
+                entry['latencies'] = (entry['latencies'] + [round(latency, 3)])[-self.latency_samples:]
+                self._streaks[host] = 0
+            else:
+                entry['last_failure'] = time.time()
+                self._streaks[host] = self._streaks.get(host, 0) + 1
+                if self._streaks[host] >= self.failure_limit:
+                    self._open[host] = time.time()
+
+    # True while the circuit breaker skips the url's host. After the cooldown one more attempt is let through;
+    # if it fails too the breaker opens again.
+    def is_open(self, url):
+        host = self.host(url)
+        with self._lock:
+            opened = self._open.get(host)
+            if opened is None:
+                return False
+            if time.time() - opened >= self.cooldown:
+                del self._open[host]
+                self._streaks[host] = self.failure_limit - 1
+                return False
+            self.skipped += 1
+            return True
+
+    def success_rate(self, host):
+        entry = self.hosts.get(host)
+        if not entry or not entry['attempts']:
+            return None
+        return entry['successes'] / float(entry['attempts'])
+
+    def median_latency(self, host):
+        entry = self.hosts.get(host)
+        if not entry or not entry['latencies']:
+            return None
+        latencies = sorted(entry['latencies'])
+        return latencies[len(latencies) // 2]
+
+    # 0 for hosts to try in search order, 1 for slow hosts, 2 for hosts that mostly failed before, 3 while the breaker
+    # is open
+    def rank(self, url):
+        host = self.host(url)
+        with self._lock:
+            if host in self._open:
+                return 3
+            entry = self.hosts.get(host)
+            if entry and entry['attempts'] >= self.min_attempts and entry['successes'] * 2 < entry['attempts']:
+                return 2
+            latency = self.median_latency(host)
+            if latency is not None and latency >= self.slow_latency:
+                return 1
+        return 0
+
+    # True when the url contains one of the comma separated ignore_urls
+    def is_blocked(self, url, ignore_urls):
+        with self._lock:
+            pattern = self._blocklists.get(ignore_urls)
+            if pattern is None:
+                pattern = re.compile('|'.join(re.escape(part) for part in ignore_urls.split(',')))
+                self._blocklists[ignore_urls] = pattern
+        return pattern.search(url) is not None
+
+
+class BrowserPool(object):
+    """Headless browser sessions kept open and reused across keywords, with image loading turned off.
+
+    At most `size` sessions exist at once; acquire blocks until one is free.
+    """
+
+    def __init__(self, chromedriver=None, browser=None, size=1):
+        self.chromedriver = chromedriver
+        self.browser = browser
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._available = threading.Semaphore(size)
+
+    def acquire(self):
+        self._available.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self._launch()
+        except Exception:
+            self._available.release()
+            raise
+
+    # allow up to `size` sessions at once
+    def grow(self, size):
+        with self._lock:
+            extra, self.size = max(0, size - self.size), max(size, self.size)
+        for _ in range(extra):
+            self._available.release()
+
+    def release(self, driver):
+        with self._lock:
+            self._idle.append(driver)
+        self._available.release()
+
+    # give back a session that is in an unknown state
+    def discard(self, driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        self._available.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for driver in idle:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
+    def _launch(self):
+        from selenium import webdriver
+        if self.browser == 'Firefox':
+            options = webdriver.FirefoxOptions()
+            options.set_preference('permissions.default.image', 2)
+            driver = webdriver.Firefox(options=options)
+        else:
+            options = webdriver.ChromeOptions()
+            options.add_argument('--no-sandbox')
+            options.add_argument("--headless")
+            options.add_argument('--blink-settings=imagesEnabled=false')
+            options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+            if int(selenium.__version__.split('.')[0]) >= 4:
+                from selenium.webdriver.chrome.service import Service
+                service = Service(self.chromedriver) if self.chromedriver else Service()
+                driver = webdriver.Chrome(service=service, options=options)
+            else:
+                driver = webdriver.Chrome(self.chromedriver, chrome_options=options)
+            driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {'source': BATCH_CAPTURE_SCRIPT})
+        driver.set_window_size(1024, 768)
+        return driver
+
+
+class googleimagesdownload:
+    def __init__(self):
+        self.pool = ConnectionPool()
+        self.store_stats = {'blobs': 0, 'bytes_stored': 0, 'duplicates': 0, 'bytes_saved': 0}
+        self._store_lock = threading.Lock()
+        self._manifests = {}
+        self._resources_lock = threading.Lock()
+        self.search_caches = {}
+        self.browser_pools = {}
+        self.rate_limiter = RateLimiter()
+        self.metrics = Metrics()
+        self.hedge_stats = {'cancelled': 0, 'wasted_bytes': 0, 'time_saved': 0.0}
+        self._hedge_lock = threading.Lock()
+        self.host_health = HostHealth()
+        self.process_pool = None
+        self._background = []
+        self._batches = itertools.count()
+        self._abandoned = 0
+        self._abandoned_done = threading.Condition(self._resources_lock)
+        self.duplicate_indexes = {}
+        self._phash_caches = {}
+
+    # Wait for abandoned fetches, then close pooled connections, browsers, worker processes and open manifests. The
+    # instance can still be used afterwards.
+    def close(self):
+        self.wait_abandoned()
+        self.pool.close()
+        self.drain_background()
+        with self._resources_lock:
+            process_pool, self.process_pool = self.process_pool, None
+        if process_pool is not None:
+            process_pool.shutdown()
+        self.host_health.save()
+        with self._resources_lock:
+            browser_pools, self.browser_pools = self.browser_pools, {}
+        for browser_pool in browser_pools.values():
+            browser_pool.close()
+        with self._resources_lock:
+            manifests, self._manifests = self._manifests, {}
+        for manifest in manifests.values():
+            manifest.close()
+
+    # The UrlManifest stored at `path`, opened once per instance
+    def open_manifest(self, path):
+        with self._resources_lock:
+            if path not in self._manifests:
+                self._manifests[path] = UrlManifest(path)
+            return self._manifests[path]
+
+    # The BrowserPool for a chromedriver path and browser, created once per instance
+    def get_browser_pool(self, chromedriver, browser):
+        with self._resources_lock:
+            if (chromedriver, browser) not in self.browser_pools:
+                self.browser_pools[(chromedriver, browser)] = BrowserPool(chromedriver, browser)
+            return self.browser_pools[(chromedriver, browser)]
+
+    # The worker processes image work is handed to, started once per instance. They are spawned rather than forked
+    # since other threads may be holding locks at the time.
+    def get_process_pool(self, workers=None):
+        with self._resources_lock:
+            if self.process_pool is None:
+                self.process_pool = ProcessPoolExecutor(max_workers=workers or None,
+                                                        mp_context=multiprocessing.get_context('spawn'))
+            return self.process_pool
+
+    # Run fn(*args) in the worker processes as part of `batch`, a number from self._batches. `message` is logged
+    # once it is done and done(result, error) is called, if given, from the thread draining it.
+    def submit_background(self, arguments, batch, message, done, fn, *args):
+        future = self.get_process_pool(arguments['process_workers']).submit(fn, *args)
+        with self._resources_lock:
+            self._background.append((batch, future, message, done, arguments['silent_mode']))
+
+    # Wait for the work handed to the worker processes, in the order it was handed over, for `batch` or for all of
+    # them, including work handed over by the done callbacks meanwhile; returns the number of failures
+    def drain_background(self, batch=None):
+        failures = 0
+        while True:
+            with self._resources_lock:
+                background = [job for job in self._background if batch is None or job[0] == batch]
+                self._background = [job for job in self._background if job not in background]
+            if not background:
+                return failures
+            for _, future, message, done, silent_mode in background:
+                result = error = None
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    failures += 1
+                    log.warning("Failed " + message + "... Error: " + str(e))
+                else:
+                    if not silent_mode:
+                        log.info("Completed " + message)
+                if done is not None:
+                    done(result, error)
+
+    # Callback for an image handed to normalize_image: the JPEG takes the place of the download in the keyword's
+    # items, paths and manifest record, or the image is deleted and dropped from them when it did not decode.
+    # thumbnail(path), if given, is called with the JPEG once it is in place.
+    def _normalized(self, object, source, items, paths, manifest, dir_name, thumbnail=None):
+        def done(result, error):
+            if error is None:
+                path, size, width, height = result
+                if path != source:
+                    os.remove(source)
+                paths[paths.index(source)] = path
+                object['image_filename'] = os.path.basename(path)
+                object['image_format'] = 'jpg'
+                if manifest is not None:
+                    manifest.record(object['image_link'], dir_name, "success", size, width, height, path)
+                if thumbnail is not None:
+                    thumbnail(path)
+            else:
+                try:
+                    os.remove(source)
+                except OSError:
+                    pass
+                paths.remove(source)
+                items.remove(object)
+                self.metrics.add_error(error.__class__.__name__, dir_name)
+                if manifest is not None:
+                    manifest.record(object['image_link'], dir_name, "fail")
+        return done
+
+    # The NearDuplicateIndex of a keyword directory, created once per instance
+    def duplicate_index(self, main_directory, dir_name):
+        directory = os.path.join(main_directory, dir_name)
+        with self._resources_lock:
+            if directory not in self.duplicate_indexes:
+                if main_directory not in self._phash_caches:
+                    try:
+                        with open(os.path.join(main_directory, PHASH_CACHE_NAME)) as cache_file:
+                            self._phash_caches[main_directory] = json.load(cache_file)
+                    except (OSError, ValueError):
+                        self._phash_caches[main_directory] = {}
+                prefix = dir_name.replace(os.sep, '/') + '/'
+                cached = dict((key[len(prefix):], entry) for key, entry in self._phash_caches[main_directory].items()
+                              if key.startswith(prefix) and '/' not in key[len(prefix):])
+                self.duplicate_indexes[directory] = NearDuplicateIndex(
+                    directory, cached, lambda: self.metrics.timer('hash', dir_name))
+            return self.duplicate_indexes[directory]
+
+    # The SearchCache configured by the arguments, opened once per instance and directory
+    def open_search_cache(self, arguments):
+        with self._resources_lock:
+            directory = arguments['search_cache']
+            if directory not in self.search_caches:
+                self.search_caches[directory] = SearchCache(
+                    directory,
+                    float(arguments['search_cache_ttl']) if arguments['search_cache_ttl'] else 86400,
+                    int(arguments['search_cache_size']) if arguments['search_cache_size'] else 10000)
+            return self.search_caches[directory]
+
+    # Image objects and related tabs for a search url, served from the search cache when it has a fresh copy
+    def search(self, url, limit, arguments):
+        cache = self.open_search_cache(arguments) if arguments['search_cache'] else None
+        # pages loaded in the browser hold more results than plain ones, so they are cached separately
+        key = url if limit < 101 else url + '#extended'
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
+        if limit < 101:
+            images, tabs = self.download_page(url, arguments['silent_mode'])  # download page
+        elif arguments['pagination_backend'] == 'http':
+            images, tabs = self.download_paginated_page(url, limit, arguments['silent_mode'])
+        else:
+            images, tabs = self.download_extended_page(url, arguments['chromedriver'], arguments['browser'], limit,
+                                                       arguments['silent_mode'])
+        if cache is not None and images:
+            cache.put(key, images, tabs)
+        return images, tabs
 
     def _extract_data_pack(self, page):
         start_line = page.find("AF_initDataCallback({key: \\'ds:1\\'") - 10
@@ -189,6 +1423,13 @@ class googleimagesdownload:
         object_raw = str(page[start_object:end_object])
         return bytes(object_raw, "utf-8").decode("unicode_escape")
 
+    # Same as _extract_data_pack, but works on the raw bytes of the page and only decodes the data pack itself
+    def _extract_data_pack_bytes(self, page):
+        start_line = page.find(b"AF_initDataCallback({key: 'ds:1'")
+        start_object = page.find(b'[', start_line + 1)
+        end_object = page.rfind(b']', 0, page.find(b'</script>', start_object + 1)) + 1
+        return str(memoryview(page)[start_object:end_object], 'utf-8')
+
     def _extract_data_pack_extended(self, page):
         start_line = page.find("AF_initDataCallback({key: 'ds:1'") - 10
         start_object = page.find('[', start_line + 1)
@@ -201,9 +1442,16 @@ class googleimagesdownload:
 
     @staticmethod
     def _image_objects_from_pack(data):
+        return googleimagesdownload._image_objects_and_cursor(data)[0]
+
+    # Image objects and the token that asks for the next page of results, which sits next to the result grid
+    @staticmethod
+    def _image_objects_and_cursor(data):
         image_data = json.loads(data)
         # NOTE: google sometimes changes their format, breaking this. set a breakpoint here to find the correct index
-        grid = image_data[56][-1][0][-1][-1][0]
+        results = image_data[56][-1][0][-1][-1]
+        grid = results[0]
+        cursor = results[1] if len(results) > 1 else None
         image_objects = []
         for item in grid:
             obj = list(item[0][0].values())[0]
@@ -211,10 +1459,40 @@ class googleimagesdownload:
             if not obj or not obj[1]:
                 continue
             image_objects.append(obj)
-        return image_objects
+        return image_objects, cursor
+
+    # Body of a search request sent through the rate limiter. Throttled requests are retried after a backoff, which
+    # is logged unless silent_mode; once the attempts run out the last HTTPError is raised
+    def _search_request(self, url, headers, data=None, silent_mode=False):
+        with self.metrics.timer('search'):
+            return self._search_request_with_retries(url, headers, data, silent_mode)
+
+    def _search_request_with_retries(self, url, headers, data, silent_mode):
+        for attempt in range(SEARCH_ATTEMPTS):
+            self.rate_limiter.wait()
+            retry_after = None
+            try:
+                resp = self.pool.urlopen(url, headers, data=data)
+            except HTTPError as e:
+                if e.code not in THROTTLE_CODES or attempt == SEARCH_ATTEMPTS - 1:
+                    raise
+                if e.headers is not None and str(e.headers.get('Retry-After', '')).isdigit():
+                    retry_after = int(e.headers.get('Retry-After'))
+            else:
+                if '/sorry/' not in resp.geturl():
+                    body = resp.read()
+                    resp.close()
+                    self.rate_limiter.success()
+                    return body
+                resp.close()
+                if attempt == SEARCH_ATTEMPTS - 1:
+                    raise HTTPError(url, 429, "Redirected to " + resp.geturl(), None, None)
+            delay = self.rate_limiter.backoff(retry_after)
+            if not silent_mode:
+                log.warning("Google is throttling searches, backing off for %.1f seconds", delay)
 
     # Downloading entire Web Document (Raw Page Content)
-    def download_page(self, url):
+    def download_page(self, url, silent_mode=False):
         version = (3, 0)
         cur_version = sys.version_info
         headers = {}
@@ -222,13 +1500,11 @@ class googleimagesdownload:
             'User-Agent'] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.104 Safari/537.36"
         if cur_version >= version:  # If the Current Version of Python is 3.0 or above
             try:
-                req = urllib.request.Request(url, headers=headers)
-                resp = urllib.request.urlopen(req)
-                respData = str(resp.read())
-            except:
+                respData = self._search_request(url, headers, silent_mode=silent_mode)
+            except Exception as e:
                 print("Could not open URL. Please check your internet connection and/or ssl settings \n"
-                      "If you are using proxy, make sure your proxy settings is configured correctly")
-                sys.exit()
+                      "If you are using proxy, make sure your proxy settings is configured correctly (%s)" % e)
+                return [], {}
         else:  # If the Current Version of Python is 2.x
             try:
                 req = urllib2.Request(url, headers=headers)
@@ -244,106 +1520,158 @@ class googleimagesdownload:
                 sys.exit()
                 return "Page Not found"
         try:
+            if cur_version >= version:
+                return self.parse_page(respData)
             return self._image_objects_from_pack(self._extract_data_pack(respData)), self.get_all_tabs(respData)
         except Exception as e:
             print(e)
             print('Image objects data unpacking failed. Please leave a comment with the above error at https://github.com/Joeclinton1/google-images-download/pull/26')
-            sys.exit()
+            return [], {}
+
+    # Download Page for more than 100 images without a browser: ask for the follow-up pages the way the page
+    # itself does when scrolled, over the pooled connection. Experimental, see PAGINATION_RPC_ID; a page without
+    # results or without a cursor for the next one is logged as a warning.
+    def download_paginated_page(self, url, limit, silent_mode=False):
+        headers = {'User-Agent': "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                                 "Chrome/88.0.4324.104 Safari/537.36"}
+        try:
+            page = self._search_request(url, headers, silent_mode=silent_mode)
+            with self.metrics.timer('parse'):
+                images, cursor = self._image_objects_and_cursor(self._extract_data_pack_bytes(page))
+        except Exception as e:
+            print("Could not open URL. Please check your internet connection and/or ssl settings \n"
+                  "If you are using proxy, make sure your proxy settings is configured correctly (%s)" % e)
+            return [], {}
+        with self.metrics.timer('parse'):
+            tabs = self.get_all_tabs(page)
+
+        query = parse_qs(urlsplit(url).query).get('q', [''])[0]
+        batch_url = urljoin(url, PAGINATION_PATH) + "?rpcids=" + PAGINATION_RPC_ID + "&source-path=%2Fsearch&rt=c"
+        headers['Content-Type'] = "application/x-www-form-urlencoded;charset=UTF-8"
+        seen = set()
+        pages = 0
+        if not cursor and len(images) < limit:
+            log.warning("No cursor for more results in the first page of " + url + ", stopping at " +
+                        str(len(images)) + " images")
+        while len(images) < limit and cursor and pages < PAGINATION_MAX_PAGES:
+            key = json.dumps(cursor)
+            if key in seen:
+                break
+            seen.add(key)
+            pages += 1
+            request = [[[PAGINATION_RPC_ID, json.dumps([None, cursor, query]), None, "generic"]]]
+            data = ("f.req=" + quote(json.dumps(request, separators=(',', ':')))).encode('utf-8')
+            try:
+                chunk = self._search_request(batch_url, headers, data, silent_mode).decode('utf-8')
+                with self.metrics.timer('parse'):
+                    more, cursor = self._image_objects_and_cursor(self._extract_data_pack_ajax(chunk))
+            except Exception as e:
+                log.warning("Could not load more results after %d images (%s)" % (len(images), e))
+                break
+            if not more:
+                log.warning("Page %d of more results for %s had no images, stopping at %d images" %
+                            (pages, url, len(images)))
+                break
+            images += more
+            if not cursor and len(images) < limit:
+                log.warning("Page %d of more results for %s had no cursor, stopping at %d images" %
+                            (pages, url, len(images)))
+        return images, tabs
+
+    # Image objects and related tabs from the raw bytes of a search results page
+    def parse_page(self, page):
+        with self.metrics.timer('parse'):
+            images = self._image_objects_from_pack(self._extract_data_pack_bytes(page))
+            return images, self.get_all_tabs(page)
 
     # Download Page for more than 100 images
-    def download_extended_page(self, url, chromedriver, browser):
-        from selenium import webdriver
-        from selenium.webdriver.common.keys import Keys
+    def download_extended_page(self, url, chromedriver, browser, limit=None, silent_mode=False):
         if sys.version_info[0] < 3:
             reload(sys)
             sys.setdefaultencoding('utf8')
-        options = webdriver.ChromeOptions()
-        options.add_argument('--no-sandbox')
-        options.add_argument("--headless")
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.common.keys import Keys
 
-        if browser == 'Firefox':
-            browser = webdriver.Firefox()
-        else:
-            try:
-                browser = webdriver.Chrome(chromedriver, chrome_options=options)
-            except Exception as e:
-                print("Looks like we cannot locate the path the 'chromedriver' (use the '--chromedriver' "
-                      "argument to specify the path to the executable.) or google chrome browser is not "
-                      "installed on your machine (exception: %s)" % e)
-                sys.exit()
-        browser.set_window_size(1024, 768)
-
-        # Open the link
-        browser.get(url)
-        browser.execute_script("""
-            (function(XHR){
-                "use strict";
-                var open = XHR.prototype.open;
-                var send = XHR.prototype.send;
-                var data = [];
-                XHR.prototype.open = function(method, url, async, user, pass) {
-                    this._url = url;
-                    open.call(this, method, url, async, user, pass);
-                }
-                XHR.prototype.send = function(data) {
-                    var self = this;
-                    var url = this._url;
-                    function stateChanged() {
-                        if (self.readyState == 4) {
-                            console.log("data available for: " + url)
-                            XHR.prototype._data.push(self.response);
-                        }
-                    }
-                    if (url.includes("/batchexecute?")) {
-                        this.addEventListener("readystatechange", stateChanged, false);
-                    }
-                    send.call(this, data);
-                };
-                XHR.prototype._data = [];
-            })(XMLHttpRequest);
-        """)
-
-        time.sleep(1)
-
-        # Bypass "Before you continue" if it appears
+        pool = self.get_browser_pool(chromedriver, browser)
         try:
-            browser.find_element_by_css_selector("[aria-label='Accept all']").click()
-            time.sleep(1)
-        except selenium.common.exceptions.NoSuchElementException:
-            pass
-
-        print("Getting you a lot of images. This may take a few moments...")
-
-        element = browser.find_element_by_tag_name("body")
-        # Scroll down
-        for i in range(50):
-            element.send_keys(Keys.PAGE_DOWN)
-            time.sleep(0.3)
+            driver = pool.acquire()
+        except Exception as e:
+            raise BrowserUnavailable("Looks like we cannot locate the path the 'chromedriver' (use the "
+                                     "'--chromedriver' argument to specify the path to the executable.) or google "
+                                     "chrome browser is not installed on your machine (exception: %s)" % e)
 
+        search_started = time.time()
         try:
-            browser.find_element_by_xpath('//input[@value="Show more results"]').click()
-            for i in range(50):
-                element.send_keys(Keys.PAGE_DOWN)
-                time.sleep(0.3)  # bot id protection
-        except:
-            for i in range(10):
-                element.send_keys(Keys.PAGE_DOWN)
-                time.sleep(0.3)  # bot id protection
-
-        print("Reached end of Page.")
-        time.sleep(0.5)
-
-        source = browser.page_source  # page source
-        images = self._image_objects_from_pack(self._extract_data_pack_extended(source))
-
-        ajax_data = browser.execute_script("return XMLHttpRequest.prototype._data") # I think this is broken
-        for chunk in ajax_data if ajax_data else []:
-            images += self._image_objects_from_pack(self._extract_data_pack_ajax(chunk))
-
-        # close the browser
-        browser.close()
+            # Open the link
+            for attempt in range(SEARCH_ATTEMPTS):
+                self.rate_limiter.wait()
+                driver.get(url)
+                if '/sorry/' not in driver.current_url:
+                    self.rate_limiter.success()
+                    break
+                if attempt == SEARCH_ATTEMPTS - 1:
+                    log.warning("Google keeps throttling searches, giving up on %s", url)
+                    pool.release(driver)
+                    return [], {}
+                delay = self.rate_limiter.backoff()
+                if not silent_mode:
+                    log.warning("Google is throttling searches, backing off for %.1f seconds", delay)
+            # only needed when the browser could not install the script before the page loaded
+            driver.execute_script(BATCH_CAPTURE_SCRIPT)
 
-        return images, self.get_all_tabs(source)
+            # Bypass "Before you continue" if it appears
+            try:
+                driver.find_element(By.CSS_SELECTOR, "[aria-label='Accept all']").click()
+                time.sleep(1)
+            except selenium.common.exceptions.NoSuchElementException:
+                pass
+
+            print("Getting you a lot of images. This may take a few moments...")
+
+            source = driver.page_source  # page source
+            with self.metrics.timer('parse'):
+                images = self._image_objects_from_pack(self._extract_data_pack_extended(source))
+            target = limit or 0
+
+            # Scroll until enough image objects arrived and no more batches are coming in, or the page is exhausted
+            element = driver.find_element(By.TAG_NAME, "body")
+            last_batch = time.time()
+            show_more_clicked = False
+            for _ in range(SCROLL_MAX_PRESSES):
+                element.send_keys(Keys.PAGE_DOWN)
+                time.sleep(SCROLL_PAUSE)  # bot id protection
+                batches = driver.execute_script("return (window.__gidBatches || []).splice(0)")
+                for chunk in batches or []:
+                    try:
+                        with self.metrics.timer('parse'):
+                            images += self._image_objects_from_pack(self._extract_data_pack_ajax(chunk))
+                    except Exception:
+                        pass  # not every batchexecute response carries images
+                if batches:
+                    last_batch = time.time()
+                    continue
+                if len(images) >= target:
+                    break
+                if time.time() - last_batch > SCROLL_IDLE_TIMEOUT:
+                    if show_more_clicked:
+                        break
+                    show_more_clicked = True
+                    last_batch = time.time()
+                    try:
+                        driver.find_element(By.XPATH, '//input[@value="Show more results"]').click()
+                    except selenium.common.exceptions.WebDriverException:
+                        break
+
+            print("Reached end of Page.")
+        except Exception:
+            pool.discard(driver)
+            raise
+        finally:
+            self.metrics.add_time('search', time.time() - search_started)
+        pool.release(driver)
+
+        with self.metrics.timer('parse'):
+            return images, self.get_all_tabs(source)
 
     # Correcting the escape characters for python2
     def replace_with_byte(self, match):
@@ -382,20 +1710,33 @@ class googleimagesdownload:
 
             return url_item, updated_item_name, end_content
 
-    # Getting all links with the help of '_images_get_next_image'
+    # Getting all related keyword tabs in a single pass over the page, which can be str or bytes.
+    # Gives the same result as repeatedly calling get_next_tab on the rest of the page, except that the name is read
+    # from the href only: get_next_tab starts it at the first ':' after class="dtviD", which is inside another
+    # attribute when one between the class and the href holds a ':', and ends it at the next '&usg=' in the page,
+    # which is in a later anchor when the href has none.
     def get_all_tabs(self, page):
         tabs = {}
-        while True:
-            item, item_name, end_content = self.get_next_tab(page)
-            if item == "no_tabs":
-                break
+        pattern = TAB_PATTERN_BYTES if isinstance(page, bytes) else TAB_PATTERN
+        for match in pattern.finditer(page):
+            href = match.group(1)
+            if isinstance(href, bytes):
+                href = href.decode('utf-8', 'replace')
+            href = href.replace('&amp;', '&')
+
+            name_start = href.find(':') + 1
+            name_end = href.find('&usg=', name_start)
+            url_item_name = href[name_start:] if name_end == -1 else href[name_start:name_end]
+            chars = url_item_name.find(',g_1:')
+            chars_end = url_item_name.find(":", chars + 6)
+            if chars_end == -1:
+                item_name = (url_item_name[chars + 5:]).replace("+", " ")
             else:
-                if len(item_name) > 100 or item_name == "background-color":
-                    break
-                else:
-                    tabs[item_name] = item  # Append all the links in the list named 'Links'
-                    time.sleep(0.1)  # Timer could be used to slow down the request for image downloads
-                    page = page[end_content:]
+                item_name = (url_item_name[chars + 5:chars_end]).replace("+", " ")
+
+            if len(item_name) > 100 or item_name == "background-color":
+                break
+            tabs[item_name] = "https://www.google.com" + href  # Append all the links in the list named 'Links'
         return tabs
 
     # Format the object in readable format
@@ -421,7 +1762,7 @@ class googleimagesdownload:
         return formatted_object
 
     # function to download single image
-    def single_image(self, image_url):
+    def single_image(self, image_url, max_bytes=None, silent_mode=False):
         main_directory = "downloads"
         extensions = (".jpg", ".gif", ".png", ".bmp", ".svg", ".webp", ".ico")
         url = image_url
@@ -431,12 +1772,17 @@ class googleimagesdownload:
             if e.errno != 17:
                 raise
             pass
-        req = Request(url, headers={
-            "User-Agent": "Mozilla/5.0 (X11; Linux i686) AppleWebKit/537.17 (KHTML, like Gecko) Chrome/24.0.1312.27 Safari/537.17"})
-
-        response = urlopen(req, None, 10)
-        data = response.read()
-        response.close()
+        response = self.pool.urlopen(url, {
+            "User-Agent": "Mozilla/5.0 (X11; Linux i686) AppleWebKit/537.17 (KHTML, like Gecko) Chrome/24.0.1312.27 Safari/537.17"},
+            10)
+        try:
+            temp_path = self._stream_to_temp_file(response, main_directory, max_bytes)
+        finally:
+            response.close()
+        if temp_path is None:
+            if not silent_mode:
+                log.info("Image is larger than %s bytes. Skipping...", max_bytes)
+            return
 
         image_name = str(url[(url.rfind('/')) + 1:])
         if '?' in image_name:
@@ -449,14 +1795,12 @@ class googleimagesdownload:
             image_name = image_name + ".jpg"
 
         try:
-            output_file = open(file_name, 'wb')
-            output_file.write(data)
-            output_file.close()
-        except IOError as e:
-            raise e
+            os.replace(temp_path, file_name)
         except OSError as e:
+            os.remove(temp_path)
             raise e
-        print("completed ====> " + image_name.encode('raw_unicode_escape').decode('utf-8'))
+        if not silent_mode:
+            log.info("completed ====> " + image_name.encode('raw_unicode_escape').decode('utf-8'))
         return
 
     def similar_images(self, similar_images):
@@ -469,16 +1813,13 @@ class googleimagesdownload:
                 headers[
                     'User-Agent'] = "Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36"
 
-                req1 = urllib.request.Request(searchUrl, headers=headers)
-                resp1 = urllib.request.urlopen(req1)
-                content = str(resp1.read())
+                content = str(self._search_request(searchUrl, headers))
                 l1 = content.find('AMhZZ')
                 l2 = content.find('&', l1)
                 urll = content[l1:l2]
 
                 newurl = "https://www.google.com/search?tbs=sbi:" + urll + "&site=search&sa=X"
-                req2 = urllib.request.Request(newurl, headers=headers)
-                resp2 = urllib.request.urlopen(req2)
+                self._search_request(newurl, headers)
                 l3 = content.find('/search?sa=X&amp;q=')
                 l4 = content.find(';', l3 + 19)
                 urll2 = content[l3 + 19:l4]
@@ -662,14 +2003,14 @@ class googleimagesdownload:
 
     # Download Image thumbnails
     def download_image_thumbnail(self, image_url, main_directory, dir_name, return_image_name, print_urls,
-                                 socket_timeout, print_size, no_download, save_source, img_src, ignore_urls):
-        if print_urls or no_download:
-            print("Image URL: " + image_url)
+                                 socket_timeout, print_size, no_download, save_source, img_src, ignore_urls,
+                                 silent_mode=False):
+        if not silent_mode:
+            if print_urls or no_download:
+                log.info("Image URL: %s", image_url)
         if no_download:
             return "success", "Printed url without downloading"
         try:
-            req = Request(image_url, headers={
-                "User-Agent": "Mozilla/5.0 (X11; Linux i686) AppleWebKit/537.17 (KHTML, like Gecko) Chrome/24.0.1312.27 Safari/537.17"})
             try:
                 # timeout time to download an image
                 if socket_timeout:
@@ -677,7 +2018,9 @@ class googleimagesdownload:
                 else:
                     timeout = 10
 
-                response = urlopen(req, None, timeout)
+                response = self.pool.urlopen(image_url, {
+                    "User-Agent": "Mozilla/5.0 (X11; Linux i686) AppleWebKit/537.17 (KHTML, like Gecko) Chrome/24.0.1312.27 Safari/537.17"},
+                    timeout)
                 data = response.read()
                 response.close()
 
@@ -703,8 +2046,8 @@ class googleimagesdownload:
                 download_message = "Completed Image Thumbnail ====> " + return_image_name
 
                 # image size parameter
-                if print_size:
-                    print("Image Size: " + str(self.file_size(path)))
+                if print_size and not silent_mode:
+                    log.info("Image Size: %s", self.file_size(path))
 
             except UnicodeEncodeError as e:
                 download_status = 'fail'
@@ -727,23 +2070,89 @@ class googleimagesdownload:
             download_message = "IOError on an image...trying next one..." + " Error: " + str(e)
         return download_status, download_message
 
-    # Download Images
-    def download_image(self, image_url, image_format, main_directory, dir_name, count, print_urls, socket_timeout,
-                       prefix, print_size, no_numbering, no_download, save_source, img_src, silent_mode, thumbnail_only,
-                       format, ignore_urls):
+    # Copy a response body in chunks to a temporary file in `directory`. Returns the temporary path, or None when the
+    # body turned out to be larger than max_bytes, in which case the partial file is removed.
+    # The bytes are also fed to `hasher` when one is given.
+    def _stream_to_temp_file(self, response, directory, max_bytes, hasher=None, cancelled=None):
+        fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.part', dir=directory or '.')
+        size = 0
+        # a cancellable download must not block until a whole chunk arrived
+        read = response.read if cancelled is None else getattr(response, 'read1', response.read)
+        try:
+            with os.fdopen(fd, 'wb') as output_file:
+                while True:
+                    if cancelled is not None and cancelled.is_set():
+                        raise FetchCancelled(size)
+                    chunk = read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if max_bytes and size > max_bytes:
+                        break
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    output_file.write(chunk)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        if max_bytes and size > max_bytes:
+            os.remove(temp_path)
+            return None
+        return temp_path
+
+    # Move a downloaded file into the content-addressed store, or drop it when the store already holds the same bytes.
+    # Returns the path of the blob.
+    def _store_blob(self, temp_path, digest, content_store):
+        blob_directory = os.path.join(content_store, digest[:2])
+        blob_path = os.path.join(blob_directory, digest)
+        size = os.path.getsize(temp_path)
+        with self._store_lock:
+            if not os.path.exists(blob_directory):
+                os.makedirs(blob_directory)
+            if os.path.exists(blob_path):
+                os.remove(temp_path)
+                self.store_stats['duplicates'] += 1
+                self.store_stats['bytes_saved'] += size
+            else:
+                try:
+                    os.replace(temp_path, blob_path)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    shutil.move(temp_path, blob_path)
+                self.store_stats['blobs'] += 1
+                self.store_stats['bytes_stored'] += size
+        return blob_path
+
+    # Hard link a blob from the content-addressed store to `path`, copying it when linking is not possible
+    def _link_blob(self, blob_path, path):
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            os.link(blob_path, path)
+        except OSError:
+            shutil.copyfile(blob_path, path)
+
+    # Checks and network fetch of an image, everything download_image does before writing to disk
+    # The body is streamed to a temporary file in the keyword directory; its path is returned in place of the data.
+    # With a content_store the file is moved into the store instead and the blob path is returned. The last item
+    # tells which of the two the path is.
+    def fetch_image(self, image_url, main_directory, dir_name, print_urls, socket_timeout, no_download, silent_mode,
+                    thumbnail_only, ignore_urls, max_bytes=None, content_store=None, cancelled=None):
         if not silent_mode:
             if print_urls or no_download:
-                print("Image URL: " + image_url)
+                log.info("Image URL: %s", image_url)
         if ignore_urls:
-            if any(url in image_url for url in ignore_urls.split(',')):
-                return "fail", "Image ignored due to 'ignore url' parameter", None, image_url
+            if self.host_health.is_blocked(image_url, ignore_urls):
+                return "fail", "Image ignored due to 'ignore url' parameter", None, None, False
         if thumbnail_only:
-            return "success", "Skipping image download...", str(image_url[(image_url.rfind('/')) + 1:]), image_url
+            return "success", "Skipping image download...", str(image_url[(image_url.rfind('/')) + 1:]), None, False
         if no_download:
-            return "success", "Printed url without downloading", None, image_url
+            return "success", "Printed url without downloading", None, None, False
+        if self.host_health.is_open(image_url):
+            return "fail", "Host failed too often, skipping it for now...trying next one...", '', None, False
+        started = time.time()
         try:
-            req = Request(image_url, headers={
-                "User-Agent": "Mozilla/5.0 (X11; Linux i686) AppleWebKit/537.17 (KHTML, like Gecko) Chrome/24.0.1312.27 Safari/537.17"})
             try:
                 # timeout time to download an image
                 if socket_timeout:
@@ -751,188 +2160,506 @@ class googleimagesdownload:
                 else:
                     timeout = 10
 
-                response = urlopen(req, None, timeout)
-                data = response.read()
-                info = response.info()
-                response.close()
-
-                qmark = image_url.rfind('?')
-                if qmark == -1:
-                    qmark = len(image_url)
-                slash = image_url.rfind('/', 0, qmark) + 1
-                image_name = str(image_url[slash:qmark]).lower()
-
-                type = info.get_content_type()
-                if type == "image/jpeg" or type == "image/jpg":
-                    if not image_name.endswith(".jpg") and not image_name.endswith(".jpeg"):
-                        image_name += ".jpg"
-                elif type == "image/png":
-                    if not image_name.endswith(".png"):
-                        image_name += ".png"
-                elif type == "image/webp":
-                    if not image_name.endswith(".webp"):
-                        image_name += ".webp"
-                elif type == "image/gif":
-                    if not image_name.endswith(".gif"):
-                        image_name += ".gif"
-                elif type == "image/bmp" or type == "image/x-windows-bmp":
-                    if not image_name.endswith(".bmp"):
-                        image_name += ".bmp"
-                elif type == "image/x-icon" or type == "image/vnd.microsoft.icon":
-                    if not image_name.endswith(".ico"):
-                        image_name += ".ico"
-                elif type == "image/svg+xml":
-                    if not image_name.endswith(".svg"):
-                        image_name += ".svg"
-                else:
-                    download_status = 'fail'
-                    download_message = "Invalid image format '" + type + "'. Skipping..."
-                    return_image_name = ''
-                    absolute_path = ''
-                    return download_status, download_message, return_image_name, absolute_path
-
-                # prefix name in image
-                if prefix:
-                    prefix = prefix + " "
-                else:
-                    prefix = ''
-
-                if no_numbering:
-                    path = main_directory + "/" + dir_name + "/" + prefix + image_name
-                else:
-                    path = main_directory + "/" + dir_name + "/" + prefix + str(count) + "." + image_name
-
+                response = self.pool.urlopen(image_url, {
+                    "User-Agent": "Mozilla/5.0 (X11; Linux i686) AppleWebKit/537.17 (KHTML, like Gecko) Chrome/24.0.1312.27 Safari/537.17"},
+                    timeout)
                 try:
-                    output_file = open(path, 'wb')
-                    output_file.write(data)
-                    output_file.close()
-                    if save_source:
-                        list_path = main_directory + "/" + save_source + ".txt"
-                        list_file = open(list_path, 'a')
-                        list_file.write(path + '\t' + img_src + '\n')
-                        list_file.close()
-                    absolute_path = os.path.abspath(path)
-                except OSError as e:
-                    download_status = 'fail'
-                    download_message = "OSError on an image...trying next one..." + " Error: " + str(e)
-                    return_image_name = ''
-                    absolute_path = ''
-
-                # return image name back to calling method to use it for thumbnail downloads
-                download_status = 'success'
-                download_message = "Completed Image ====> " + prefix + str(count) + "." + image_name
-                return_image_name = prefix + str(count) + "." + image_name
-
-                # image size parameter
-                if not silent_mode:
-                    if print_size:
-                        print("Image Size: " + str(self.file_size(path)))
+                    info = response.info()
+
+                    qmark = image_url.rfind('?')
+                    if qmark == -1:
+                        qmark = len(image_url)
+                    slash = image_url.rfind('/', 0, qmark) + 1
+                    image_name = str(image_url[slash:qmark]).lower()
+
+                    content_type = info.get_content_type()
+                    if content_type == "image/jpeg" or content_type == "image/jpg":
+                        if not image_name.endswith(".jpg") and not image_name.endswith(".jpeg"):
+                            image_name += ".jpg"
+                    elif content_type == "image/png":
+                        if not image_name.endswith(".png"):
+                            image_name += ".png"
+                    elif content_type == "image/webp":
+                        if not image_name.endswith(".webp"):
+                            image_name += ".webp"
+                    elif content_type == "image/gif":
+                        if not image_name.endswith(".gif"):
+                            image_name += ".gif"
+                    elif content_type == "image/bmp" or content_type == "image/x-windows-bmp":
+                        if not image_name.endswith(".bmp"):
+                            image_name += ".bmp"
+                    elif content_type == "image/x-icon" or content_type == "image/vnd.microsoft.icon":
+                        if not image_name.endswith(".ico"):
+                            image_name += ".ico"
+                    elif content_type == "image/svg+xml":
+                        if not image_name.endswith(".svg"):
+                            image_name += ".svg"
+                    else:
+                        # decided from the headers alone, the body is never read. Hotlink and consent pages come
+                        # back like this, so it counts against the host.
+                        self.host_health.record(image_url, False)
+                        return 'fail', "Invalid image format '" + content_type + "'. Skipping...", '', None, False
+
+                    content_length = info.get('Content-Length')
+                    if max_bytes and content_length and content_length.isdigit() and int(content_length) > max_bytes:
+                        self.host_health.record(image_url, True, time.time() - started)
+                        return 'fail', "Image is larger than " + str(max_bytes) + " bytes. Skipping...", '', None, False
+
+                    hasher = hashlib.sha256() if content_store else None
+                    temp_path = self._stream_to_temp_file(response, os.path.join(main_directory, dir_name), max_bytes,
+                                                          hasher, cancelled)
+                finally:
+                    response.close()
+                self.host_health.record(image_url, True, time.time() - started)
+                if temp_path is None:
+                    return 'fail', "Image is larger than " + str(max_bytes) + " bytes. Skipping...", '', None, False
+                if content_store:
+                    temp_path = self._store_blob(temp_path, hasher.hexdigest(), content_store)
+                return 'success', '', image_name, temp_path, bool(content_store)
+
+            except FetchCancelled as e:  # not the host's fault, nothing to record
+                with self._hedge_lock:
+                    self.hedge_stats['wasted_bytes'] += e.size
+                return 'fail', "Download cancelled, enough images downloaded", '', None, False
 
             except UnicodeEncodeError as e:
-                download_status = 'fail'
                 download_message = "UnicodeEncodeError on an image...trying next one..." + " Error: " + str(e)
-                return_image_name = ''
-                absolute_path = ''
+                error = e
 
             except URLError as e:
-                download_status = 'fail'
                 download_message = "URLError on an image...trying next one..." + " Error: " + str(e)
-                return_image_name = ''
-                absolute_path = ''
+                error = e
 
             except BadStatusLine as e:
-                download_status = 'fail'
                 download_message = "BadStatusLine on an image...trying next one..." + " Error: " + str(e)
-                return_image_name = ''
-                absolute_path = ''
+                error = e
 
         except HTTPError as e:  # If there is any HTTPError
-            download_status = 'fail'
             download_message = "HTTPError on an image...trying next one..." + " Error: " + str(e)
-            return_image_name = ''
-            absolute_path = ''
+            error = e
 
         except URLError as e:
-            download_status = 'fail'
             download_message = "URLError on an image...trying next one..." + " Error: " + str(e)
-            return_image_name = ''
-            absolute_path = ''
+            error = e
 
         except ssl.CertificateError as e:
-            download_status = 'fail'
             download_message = "CertificateError on an image...trying next one..." + " Error: " + str(e)
-            return_image_name = ''
-            absolute_path = ''
+            error = e
 
         except IOError as e:  # If there is any IOError
-            download_status = 'fail'
             download_message = "IOError on an image...trying next one..." + " Error: " + str(e)
-            return_image_name = ''
-            absolute_path = ''
+            error = e
 
         except IncompleteRead as e:
-            download_status = 'fail'
             download_message = "IncompleteReadError on an image...trying next one..." + " Error: " + str(e)
-            return_image_name = ''
-            absolute_path = ''
+            error = e
+
+        self.host_health.record(image_url, False)
+        self.metrics.add_error(type(error).__name__, dir_name)
+        return 'fail', download_message, '', None, False
+
+    # Write an image returned by fetch_image to its (numbered) path in the keyword directory
+    def save_image(self, fetched, image_url, main_directory, dir_name, count, prefix, print_size, no_numbering,
+                   save_source, img_src, silent_mode):
+        download_status, download_message, image_name, temp_path, stored = fetched
+        if temp_path is None:  # failed, or nothing to write (thumbnail_only / no_download)
+            return download_status, download_message, image_name, image_url if download_status == 'success' else ''
+
+        # prefix name in image
+        if prefix:
+            prefix = prefix + " "
+        else:
+            prefix = ''
+
+        if no_numbering:
+            path = main_directory + "/" + dir_name + "/" + prefix + image_name
+        else:
+            path = main_directory + "/" + dir_name + "/" + prefix + str(count) + "." + image_name
+
+        try:
+            if stored:
+                self._link_blob(temp_path, path)
+            else:
+                os.replace(temp_path, path)
+            if save_source:
+                list_path = main_directory + "/" + save_source + ".txt"
+                list_file = open(list_path, 'a')
+                list_file.write(path + '\t' + img_src + '\n')
+                list_file.close()
+            absolute_path = os.path.abspath(path)
+        except OSError as e:
+            self.discard_fetched(fetched)
+            download_status = 'fail'
+            download_message = "OSError on an image...trying next one..." + " Error: " + str(e)
+            return download_status, download_message, '', ''
+
+        # return image name back to calling method to use it for thumbnail downloads
+        download_status = 'success'
+        download_message = "Completed Image ====> " + prefix + str(count) + "." + image_name
+        return_image_name = prefix + str(count) + "." + image_name
+
+        # image size parameter
+        if not silent_mode:
+            if print_size:
+                log.info("Image Size: %s", self.file_size(path))
 
         return download_status, download_message, return_image_name, absolute_path
 
+    # Remove the temporary file of a fetched image that is not going to be saved. Blobs of the content store are kept.
+    def discard_fetched(self, fetched):
+        temp_path = fetched[3]
+        if temp_path is not None and not fetched[4]:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    # Let a fetch whose result is no longer wanted finish on its own and hand what it got to discard(fetched)
+    def _abandon_fetch(self, future, discard):
+        with self._resources_lock:
+            self._abandoned += 1
+
+        def finished(done):
+            try:
+                if not done.cancelled() and done.exception() is None:
+                    discard(done.result())
+            finally:
+                with self._resources_lock:
+                    self._abandoned -= 1
+                    self._abandoned_done.notify_all()
+        future.add_done_callback(finished)
+
+    # Wait until the abandoned fetches have finished and discarded what they downloaded
+    def wait_abandoned(self):
+        with self._resources_lock:
+            while self._abandoned:
+                self._abandoned_done.wait()
+
+    # Drop a fetched image that arrived after the limit was reached
+    def _discard_hedged(self, fetched):
+        temp_path = fetched[3]
+        if fetched[0] == 'success' and temp_path is not None and not fetched[4]:
+            try:
+                size = os.path.getsize(temp_path)
+            except OSError:
+                size = 0
+            with self._hedge_lock:
+                self.hedge_stats['wasted_bytes'] += size
+        self.discard_fetched(fetched)
+
+    # Download Images
+    def download_image(self, image_url, image_format, main_directory, dir_name, count, print_urls, socket_timeout,
+                       prefix, print_size, no_numbering, no_download, save_source, img_src, silent_mode, thumbnail_only,
+                       format, ignore_urls, max_bytes=None, content_store=None):
+        fetched = self.fetch_image(image_url, main_directory, dir_name, print_urls, socket_timeout, no_download,
+                                   silent_mode, thumbnail_only, ignore_urls, max_bytes, content_store)
+        return self.save_image(fetched, image_url, main_directory, dir_name, count, prefix, print_size, no_numbering,
+                               save_source, img_src, silent_mode)
+
+    # The size, format and aspect ratio filters given in the arguments, None when there are none
+    def _image_filters(self, arguments):
+        filters = {}
+        for name in ("min_width", "min_height", "max_width", "max_height"):
+            if arguments[name]:
+                filters[name] = int(arguments[name])
+        for name in ("min_aspect_ratio", "max_aspect_ratio"):
+            if arguments[name]:
+                filters[name] = float(arguments[name])
+        if arguments['allowed_formats']:
+            filters['formats'] = set(self._normalize_format(part) for part in arguments['allowed_formats'].split(','))
+        return filters or None
+
+    # 'jpg' for .../photo.JPEG?w=300 and the like, None when the format is not one we know
+    @staticmethod
+    def _normalize_format(image_format):
+        image_format = str(image_format or '').lower().split('?')[0].split('&')[0].strip()
+        if image_format == 'jpeg':
+            image_format = 'jpg'
+        return image_format if image_format in IMAGE_FORMATS else None
+
+    # True when the image passes the filters, False when it does not, None when its metadata cannot tell
+    def _check_image(self, object, filters):
+        width, height = object['image_width'], object['image_height']
+        image_format = self._normalize_format(object['image_format'])
+        unknown = False
+        if 'formats' in filters:
+            if image_format is None:
+                unknown = True
+            elif image_format not in filters['formats']:
+                return False
+        if any(name != 'formats' for name in filters):
+            if not width or not height:
+                return None
+            if width < filters.get('min_width', 0) or height < filters.get('min_height', 0):
+                return False
+            if width > filters.get('max_width', width) or height > filters.get('max_height', height):
+                return False
+            ratio = float(width) / height
+            if ratio < filters.get('min_aspect_ratio', ratio) or ratio > filters.get('max_aspect_ratio', ratio):
+                return False
+        return None if unknown else True
+
+    # Format, width and height of a remote image from a ranged read of its first bytes, None when they cannot be told
+    def probe_image(self, image_url, socket_timeout=None):
+        try:
+            response = self.pool.urlopen(image_url, {
+                "User-Agent": "Mozilla/5.0 (X11; Linux i686) AppleWebKit/537.17 (KHTML, like Gecko) Chrome/24.0.1312.27 Safari/537.17",
+                "Range": "bytes=0-" + str(PROBE_BYTES - 1)}, float(socket_timeout) if socket_timeout else 10)
+            try:
+                data = response.read(PROBE_BYTES)
+            finally:
+                response.close()
+        except Exception:
+            return None
+        return image_header_info(data)
+
+    # Fetch phase for one search result, safe to run on a worker thread
+    def _fetch_item(self, object, main_directory, dir_name, arguments, cancelled=None):
+        if object is None:
+            return "fail", "Could not read the image metadata...trying next one...", '', None, False
+        if arguments['metadata'] and not arguments['silent_mode']:
+            log.info("\nImage Metadata: %s", object)
+        filters = self._image_filters(arguments)
+        if filters and not (arguments['no_download'] or arguments['thumbnail_only']) and \
+                self._check_image(object, filters) is None:
+            info = self.probe_image(object['image_link'], arguments['socket_timeout'])
+            if info is not None:
+                object['image_format'], object['image_width'], object['image_height'] = info
+                if self._check_image(object, filters) is False:
+                    return "skipped", "Image outside the size and format filters. Skipping...", None, None, False
+        with self.metrics.timer('fetch', dir_name):
+            fetched = self.fetch_image(object['image_link'], main_directory, dir_name, arguments['print_urls'],
+                                       arguments['socket_timeout'], arguments['no_download'], arguments["silent_mode"],
+                                       arguments["thumbnail_only"], arguments['ignore_urls'],
+                                       int(arguments['max_bytes']) if arguments['max_bytes'] else None,
+                                       arguments['content_store'], cancelled)
+        # hashed here, on the fetch threads, and matched where the results are committed in order
+        if arguments['reject_duplicates'] and fetched[0] == 'success' and fetched[3] is not None:
+            with self.metrics.timer('hash', dir_name):
+                object['image_phash'] = image_phash(fetched[3])
+        return fetched
+
+    # Yields (object, fetched) for every candidate in search order. With concurrency > 1 up to that many fetches
+    # run ahead on a thread pool; whatever is still in flight when the caller stops is cancelled or discarded.
+    def _fetch_candidates(self, objects, main_directory, dir_name, arguments, concurrency):
+        if concurrency < 2:
+            for object in objects:
+                yield object, self._fetch_item(object, main_directory, dir_name, arguments)
+            return
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        pending = collections.deque()
+        try:
+            for object in objects:
+                pending.append((object, executor.submit(self._fetch_item, object, main_directory, dir_name,
+                                                        arguments)))
+                if len(pending) >= concurrency:
+                    object, future = pending.popleft()
+                    yield object, future.result()
+            while pending:
+                object, future = pending.popleft()
+                yield object, future.result()
+        finally:
+            for object, future in pending:
+                if not future.cancel():
+                    self._abandon_fetch(future, self.discard_fetched)
+            executor.shutdown(wait=False)
+
+    # Yields (object, fetched) in the order the fetches finish, keeping needed() + hedge of them in flight, where
+    # needed() is the number of images still missing. When the caller stops, fetches not started are cancelled,
+    # running ones stop at their next chunk and whatever they downloaded is deleted and counted as wasted. The time
+    # the cancelled fetches had been running is counted as saved: in search order the keyword would have waited for
+    # them at least that long.
+    def _fetch_hedged(self, objects, main_directory, dir_name, arguments, hedge, needed):
+        executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_IN_FLIGHT)
+        cancelled = threading.Event()
+        in_flight = {}
+        remaining = iter(objects)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(in_flight) < min(needed() + hedge, HEDGE_MAX_IN_FLIGHT):
+                    try:
+                        object = next(remaining)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    future = executor.submit(self._fetch_item, object, main_directory, dir_name, arguments, cancelled)
+                    in_flight[future] = (object, time.time())
+                if not in_flight:
+                    return
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                for future in done:
+                    object, started = in_flight.pop(future)
+                    yield object, future.result()
+        finally:
+            cancelled.set()
+            now = time.time()
+            saved = 0.0
+            stopped = 0
+            for future, (object, started) in in_flight.items():
+                if future.cancel():
+                    stopped += 1
+                    continue
+                if not future.done():
+                    stopped += 1
+                    saved = max(saved, now - started)
+                self._abandon_fetch(future, self._discard_hedged)
+            with self._hedge_lock:
+                self.hedge_stats['cancelled'] += stopped
+                self.hedge_stats['time_saved'] += saved
+            executor.shutdown(wait=False)
+
     def _get_all_items(self, image_objects, main_directory, dir_name, limit, arguments):
         items = []
         abs_path = []
         errorCount = 0
-        i = 0
         count = 1
-        while count < limit + 1 and i < len(image_objects):
-            if len(image_objects) == 0:
-                print("no_links")
-                break
-            #code added here to attempt to implement offset correctly
-            #was "count < int(arguments['offset'])" in hardikvasa code, this seems
-            # to be contrary to the implementation details. 
-            elif arguments['offset'] and count <= int(arguments['offset']):
-                    count += 1
-                    #page = page[end_content:]
-            else:
-                # format the item for readability
-                object = self.format_object(image_objects[i])
-                if arguments['metadata']:
-                    if not arguments["silent_mode"]:
-                        print("\nImage Metadata: " + str(object))
-
-                # download the images
-                download_status, download_message, return_image_name, absolute_path = self.download_image(
-                    object['image_link'], object['image_format'], main_directory, dir_name, count,
-                    arguments['print_urls'], arguments['socket_timeout'], arguments['prefix'], arguments['print_size'],
-                    arguments['no_numbering'], arguments['no_download'], arguments['save_source'],
-                    object['image_source'], arguments["silent_mode"], arguments["thumbnail_only"], arguments['format'],
-                    arguments['ignore_urls'])
-                if not arguments["silent_mode"]:
-                    print(download_message)
-                if download_status == "success":
+        #code added here to attempt to implement offset correctly
+        #was "count < int(arguments['offset'])" in hardikvasa code, this seems
+        # to be contrary to the implementation details.
+        # the first `offset` links are skipped and numbering continues after them
+        start = 0
+        if arguments['offset']:
+            start = min(int(arguments['offset']), limit, len(image_objects))
+            count += start
+
+        objects = [self.format_object(image_object) for image_object in image_objects[start:]]
+
+        # thumbnails and normalization run in worker processes and are waited for before returning
+        batch = next(self._batches)
+
+        def thumbnail(path):
+            name = os.path.basename(path)
+            self.submit_background(
+                arguments, batch, "Image Thumbnail ====> " + name, None, make_thumbnail, path,
+                os.path.join(main_directory, dir_name + " - thumbnail", name),
+                int(arguments['thumbnail_size'] or THUMBNAIL_SIZE))
+
+        # urls already in the manifest were downloaded (or failed) before, in this run or an earlier one
+        manifest = self.open_manifest(arguments['manifest']) if arguments['manifest'] else None
+        if manifest is not None:
+            known = manifest.known(object['image_link'] for object in objects if object)
+            unseen = []
+            for object in objects:
+                if object:
+                    if object['image_link'] in known:
+                        continue
+                    known.add(object['image_link'])
+                unseen.append(object)
+            if not arguments['silent_mode'] and len(unseen) < len(objects):
+                log.info("Skipping %d images already in the manifest", len(objects) - len(unseen))
+            objects = unseen
+
+        # candidates whose metadata already rules them out are never fetched; the rest are probed in _fetch_item
+        filters = self._image_filters(arguments)
+        if filters:
+            kept = [object for object in objects if not object or self._check_image(object, filters) is not False]
+            if not arguments['silent_mode'] and len(kept) < len(objects):
+                log.info("Skipping %d images outside the size and format filters", len(objects) - len(kept))
+            objects = kept
+
+        # slow hosts go after the others, hosts that mostly failed before after those, hosts the circuit breaker is
+        # skipping last
+        objects.sort(key=lambda object: self.host_health.rank(object['image_link']) if object else 0)
+
+        if arguments['concurrency']:
+            concurrency = int(arguments['concurrency'])
+        else:
+            concurrency = 1
+        distance = int(arguments['duplicate_distance']) if arguments['duplicate_distance'] is not None else \
+            DUPLICATE_DISTANCE
+
+        # results are committed in search order, so numbering is the same whatever the concurrency; hedged fetches
+        # are committed as they finish instead
+        if arguments['hedge']:
+            fetches = self._fetch_hedged(objects, main_directory, dir_name, arguments, int(arguments['hedge']),
+                                         lambda: limit + 1 - count)
+        else:
+            fetches = self._fetch_candidates(objects, main_directory, dir_name, arguments, concurrency)
+        try:
+            while count < limit + 1:
+                try:
+                    object, fetched = next(fetches)
+                except StopIteration:
+                    break
+
+                # near-duplicates of an image already in the directory are dropped without using up the limit
+                image_hash = object.pop('image_phash', None) if object else None
+                if image_hash is not None:
+                    original = self.duplicate_index(main_directory, dir_name).match(image_hash, distance)
+                    if original is not None:
+                        self.discard_fetched(fetched)
+                        self.metrics.add_duplicate(dir_name)
+                        if manifest is not None:
+                            manifest.record(object['image_link'], dir_name, "duplicate")
+                        if not arguments['silent_mode']:
+                            log.info("Image looks the same as " + original + ". Skipping...")
+                        continue
+
+                # write the image to disk
+                with self.metrics.timer('write', dir_name):
+                    download_status, download_message, return_image_name, absolute_path = self.save_image(
+                        fetched, object['image_link'] if object else '', main_directory, dir_name, count,
+                        arguments['prefix'], arguments['print_size'], arguments['no_numbering'],
+                        arguments['save_source'], object['image_source'] if object else '', arguments["silent_mode"])
+                if not arguments['silent_mode']:
+                    log.info(download_message)
+                downloaded = download_status == "success" and not (arguments['no_download'] or
+                                                                    arguments['thumbnail_only'])
+                size = os.path.getsize(absolute_path) if downloaded else 0
+
+                # images skipped by ignore_urls (return_image_name None) or not downloaded at all stay out of it
+                if manifest is not None and object and return_image_name is not None and not (
+                        arguments['no_download'] or arguments['thumbnail_only']):
+                    if download_status == "success":
+                        manifest.record(object['image_link'], dir_name, download_status, size,
+                                        object['image_width'], object['image_height'], absolute_path)
+                    else:
+                        manifest.record(object['image_link'], dir_name, download_status)
 
-                    # download image_thumbnails
-                    if arguments['thumbnail'] or arguments["thumbnail_only"]:
+                if download_status == "success":
+                    if image_hash is not None:
+                        self.duplicate_index(main_directory, dir_name).add(image_hash, return_image_name)
+
+                    # download image_thumbnails, or make them from the image in a worker process; normalized images get
+                    # theirs from the JPEG once it replaced the download
+                    local_thumbnail = downloaded and arguments['thumbnail'] and arguments['local_thumbnails']
+                    if local_thumbnail:
+                        if not arguments['normalize']:
+                            thumbnail(absolute_path)
+                    elif arguments['thumbnail'] or arguments["thumbnail_only"]:
                         download_status, download_message_thumbnail = self.download_image_thumbnail(
                             object['image_thumbnail_url'], main_directory, dir_name, return_image_name,
                             arguments['print_urls'], arguments['socket_timeout'], arguments['print_size'],
                             arguments['no_download'], arguments['save_source'], object['image_source'],
-                            arguments['ignore_urls'])
-                        if not arguments["silent_mode"]:
-                            print(download_message_thumbnail)
+                            arguments['ignore_urls'], arguments['silent_mode'])
+                        if not arguments['silent_mode']:
+                            log.info(download_message_thumbnail)
 
+                    if downloaded:
+                        self.metrics.add_image(size, dir_name)
                     count += 1
                     object['image_filename'] = return_image_name
                     items.append(object)  # Append all the links in the list named 'Links'
                     abs_path.append(absolute_path)
-                else:
+
+                    # verified and converted in a worker process
+                    if downloaded and arguments['normalize']:
+                        self.submit_background(
+                            arguments, batch, "Image Normalization ====> " + return_image_name,
+                            self._normalized(object, absolute_path, items, abs_path, manifest, dir_name,
+                                             thumbnail if local_thumbnail else None),
+                            normalize_image, absolute_path, int(arguments['normalize_size'] or 0))
+                elif download_status != "skipped":
                     errorCount += 1
 
                 # delay param
                 if arguments['delay']:
                     time.sleep(int(arguments['delay']))
-            i += 1
+        finally:
+            fetches.close()
+            # failed thumbnails and images that did not normalize count as errors of the keyword
+            errorCount += self.drain_background(batch)
         if count < limit:
             print("\n\nUnfortunately all " + str(
                 limit) + " could not be downloaded because some images were not downloadable. " + str(
@@ -984,6 +2711,73 @@ class googleimagesdownload:
                     print(paths.encode('raw_unicode_escape').decode('utf-8'))
         return paths_agg, errors
 
+    # Search and download one prefix + keyword + suffix combination; returns its paths and error count
+    def _download_keyword(self, number, pky, keyword, sky, arguments, main_directory, limit, time_range, exact_size):
+        iteration = "\n" + "Item no.: " + str(number) + " -->" + " Item name = " + (pky) + (keyword) + (sky)
+        if not arguments["silent_mode"]:
+            print(iteration.encode('raw_unicode_escape').decode('utf-8'))
+            print("Evaluating...")
+        else:
+            print("Downloading images for: " + (pky) + (keyword) + (sky) + " ...")
+        search_term = pky + keyword + sky
+
+        if arguments['image_directory']:
+            dir_name = arguments['image_directory']
+        elif arguments['no_directory']:
+            dir_name = ''
+        else:
+            dir_name = search_term + (
+                '-' + arguments['color'] if arguments['color'] else '')  # sub-directory
+
+        if not arguments["no_download"]:
+            self.create_directories(main_directory, dir_name, arguments['thumbnail'],
+                                    arguments['thumbnail_only'])  # create directories in OS
+
+        params = self.build_url_parameters(arguments)  # building URL with params
+
+        search_term += time_range + exact_size
+        url = self.build_search_url(search_term, params, arguments['url'], arguments['similar_images'],
+                                    arguments['specific_site'],
+                                    arguments['safe_search'])  # building main search url
+
+        with self.metrics.keyword_timer(dir_name):
+            images, tabs = self.search(url, limit, arguments)
+
+            if not arguments["silent_mode"]:
+                if arguments['no_download']:
+                    print("Getting URLs without downloading images...")
+                else:
+                    print("Starting Download...")
+            items, errorCount, abs_path = self._get_all_items(images, main_directory, dir_name, limit,
+                                                              arguments)  # get all image items and download images
+
+        # dumps into a json file
+        if arguments['extract_metadata']:
+            try:
+                if not os.path.exists("logs"):
+                    os.makedirs("logs")
+            except OSError as e:
+                print(e)
+            json_file = open("logs/" + keyword + ".json", "w")
+            json.dump(items, json_file, indent=4, sort_keys=True)
+            json_file.close()
+
+        # Related images
+        if arguments['related_images']:
+            print("\nGetting list of related keywords...this may take a few moments")
+            for key, value in tabs.items():
+                final_search_term = (search_term + " - " + key)
+                print("\nNow Downloading - " + final_search_term)
+                with self.metrics.keyword_timer(final_search_term):
+                    images, _ = self.search(value, limit, arguments)
+                    self.create_directories(main_directory, final_search_term, arguments['thumbnail'],
+                                            arguments['thumbnail_only'])
+                    self._get_all_items(images, main_directory, final_search_term, limit, arguments)
+
+        if not arguments["silent_mode"]:
+            print("\nErrors: " + str(errorCount) + "\n")
+        return abs_path, errorCount
+
     def download_executor(self, arguments):
         paths = {}
         errorCount = None
@@ -1059,6 +2853,17 @@ class googleimagesdownload:
             os.environ["http_proxy"] = arguments['proxy']
             os.environ["https_proxy"] = arguments['proxy']
 
+        # Host record and circuit breaker shared by all keywords run by this instance
+        if arguments['host_health']:
+            self.host_health.load(arguments['host_health'])
+        if arguments['host_failure_limit']:
+            self.host_health.failure_limit = int(arguments['host_failure_limit'])
+
+        # Pace the search requests of all keywords run by this instance
+        if arguments['search_rate']:
+            self.rate_limiter.configure(float(arguments['search_rate']),
+                                        int(arguments['search_burst']) if arguments['search_burst'] else 1)
+
         # Add time range to keywords if asked
         time_range = ''
         if arguments['time_range']:
@@ -1072,87 +2877,39 @@ class googleimagesdownload:
             exact_size = " imagesize:" + str(size_array[0]) + "x" + str(size_array[1])
 
             ######Initialization Complete
-        total_errors = 0
-        for pky in prefix_keywords:  # 1.for every prefix keywords
-            for sky in suffix_keywords:  # 2.for every suffix keywords
-                i = 0
-                while i < len(search_keyword):  # 3.for every main keyword
-                    iteration = "\n" + "Item no.: " + str(i + 1) + " -->" + " Item name = " + (pky) + (
-                    search_keyword[i]) + (sky)
-                    if not arguments["silent_mode"]:
-                        print(iteration.encode('raw_unicode_escape').decode('utf-8'))
-                        print("Evaluating...")
-                    else:
-                        print("Downloading images for: " + (pky) + (search_keyword[i]) + (sky) + " ...")
-                    search_term = pky + search_keyword[i] + sky
-
-                    if arguments['image_directory']:
-                        dir_name = arguments['image_directory']
-                    elif arguments['no_directory']:
-                        dir_name = ''
-                    else:
-                        dir_name = search_term + (
-                            '-' + arguments['color'] if arguments['color'] else '')  # sub-directory
-
-                    if not arguments["no_download"]:
-                        self.create_directories(main_directory, dir_name, arguments['thumbnail'],
-                                                arguments['thumbnail_only'])  # create directories in OS
-
-                    params = self.build_url_parameters(arguments)  # building URL with params
-
-                    search_term += time_range + exact_size
-                    url = self.build_search_url(search_term, params, arguments['url'], arguments['similar_images'],
-                                                arguments['specific_site'],
-                                                arguments['safe_search'])  # building main search url
-
-                    if limit < 101:
-                        images, tabs = self.download_page(url)  # download page
-                    else:
-                        images, tabs = self.download_extended_page(url, arguments['chromedriver'], arguments['browser'])
-
-                    if not arguments["silent_mode"]:
-                        if arguments['no_download']:
-                            print("Getting URLs without downloading images...")
-                        else:
-                            print("Starting Download...")
-                    items, errorCount, abs_path = self._get_all_items(images, main_directory, dir_name, limit,
-                                                                      arguments)  # get all image items and download images
-                    paths[pky + search_keyword[i] + sky] = abs_path
-
-                    # dumps into a json file
-                    if arguments['extract_metadata']:
-                        try:
-                            if not os.path.exists("logs"):
-                                os.makedirs("logs")
-                        except OSError as e:
-                            print(e)
-                        json_file = open("logs/" + search_keyword[i] + ".json", "w")
-                        json.dump(items, json_file, indent=4, sort_keys=True)
-                        json_file.close()
-
-                    # Related images
-                    if arguments['related_images']:
-                        print("\nGetting list of related keywords...this may take a few moments")
-                        for key, value in tabs.items():
-                            final_search_term = (search_term + " - " + key)
-                            print("\nNow Downloading - " + final_search_term)
-                            if limit < 101:
-                                images, _ = self.download_page(value)  # download page
-                            else:
-                                images, _ = self.download_extended_page(value, arguments['chromedriver'], arguments['browser'])
-                            self.create_directories(main_directory, final_search_term, arguments['thumbnail'],
-                                                    arguments['thumbnail_only'])
-                            self._get_all_items(images, main_directory, search_term + " - " + key, limit, arguments)
+        # Run every prefix + keyword + suffix combination. Workers share this instance, so connections, caches
+        # and the manifest are shared as well; results are collected in job order whatever the finishing order.
+        jobs = [(i + 1, pky, keyword, sky) for pky in prefix_keywords  # 1.for every prefix keywords
+                for sky in suffix_keywords  # 2.for every suffix keywords
+                for i, keyword in enumerate(search_keyword)]  # 3.for every main keyword
+
+        def run(job):
+            return self._download_keyword(job[0], job[1], job[2], job[3], arguments, main_directory, limit,
+                                          time_range, exact_size)
+
+        workers = int(arguments['keyword_workers']) if arguments['keyword_workers'] else 1
+        if workers > 1 and len(jobs) > 1:
+            self.get_browser_pool(arguments['chromedriver'], arguments['browser']).grow(workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(run, jobs))
+        else:
+            results = [run(job) for job in jobs]
 
-                    i += 1
-                    total_errors = total_errors + errorCount
-                    if not arguments["silent_mode"]:
-                        print("\nErrors: " + str(errorCount) + "\n")
+        total_errors = 0
+        for (_, pky, keyword, sky), (abs_path, errorCount) in zip(jobs, results):
+            paths[pky + keyword + sky] = abs_path
+            total_errors = total_errors + errorCount
+        self.host_health.save()
+        if arguments['metrics_file']:
+            self.metrics.write_json(arguments['metrics_file'])
+        if arguments['prometheus_file']:
+            self.metrics.write_prometheus(arguments['prometheus_file'])
         return paths, total_errors
 
 
 # ------------- Main Program -------------#
 def main():
+    configure_log()
     records = user_input()
     total_errors = 0
     t0 = time.time()  # start the timer
@@ -1160,18 +2917,45 @@ def main():
 
         if arguments['single_image']:  # Download Single Image using a URL
             response = googleimagesdownload()
-            response.single_image(arguments['single_image'])
+            response.single_image(arguments['single_image'], arguments['max_bytes'], arguments['silent_mode'])
         else:  # or download multiple images based on keywords/keyphrase search
             response = googleimagesdownload()
-            paths, errors = response.download(arguments)  # wrapping response in a variable just for consistency
+            try:
+                paths, errors = response.download(arguments)  # wrapping response in a variable just for consistency
+            except BrowserUnavailable as e:
+                response.close()
+                print(e)
+                sys.exit()
             total_errors = total_errors + errors
 
         t1 = time.time()  # stop the timer
         total_time = t1 - t0  # Calculating the total time required to crawl, find and download all the links of 60,000 images
+        response.close()
         if not arguments["silent_mode"]:
             print("\nEverything downloaded!")
             print("Total errors: " + str(total_errors))
             print("Total time taken: " + str(total_time) + " Seconds")
+            summary = response.metrics.summary()
+            print("Images per second: " + str(round(summary['images_per_second'], 2)) + " (" +
+                  str(summary['images']) + " images, " + str(summary['bytes']) + " bytes)")
+            print("Connection reuse ratio: " + str(round(response.pool.reuse_ratio() * 100, 1)) + "%")
+            limiter = response.rate_limiter
+            print("Search requests: " + str(limiter.requests) + ", waited " + str(round(limiter.waited, 1)) +
+                  " seconds for the rate limit, throttled " + str(limiter.throttled) + " times")
+            if arguments['hedge']:
+                stats = response.hedge_stats
+                print("Hedging: " + str(stats['cancelled']) + " downloads cancelled, " + str(stats['wasted_bytes']) +
+                      " bytes wasted, at least " + str(round(stats['time_saved'], 1)) + " seconds saved")
+            if summary['duplicates']:
+                print("Near-duplicates dropped: " + str(summary['duplicates']))
+            if response.host_health.skipped:
+                print("Downloads skipped on failing hosts: " + str(response.host_health.skipped))
+            for cache in response.search_caches.values():
+                print("Search cache: " + str(cache.hits) + " hits, " + str(cache.misses) + " misses")
+            if arguments['content_store']:
+                stats = response.store_stats
+                print("Content store: " + str(stats['blobs']) + " new images, " + str(stats['duplicates']) +
+                      " duplicates linked, " + str(stats['bytes_saved']) + " bytes saved")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,876 @@
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+import selenium.common.exceptions
+
+from google_images_download import google_images_download
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import fixtures
+
+IMAGE_BODY = b"\xff\xd8 not really a jpeg"
+
+
+def make_image_object(url, width=800, height=600):
+    # mirrors the layout read by googleimagesdownload.format_object
+    info = [None] * 18
+    info[2] = "https://source.example/" + url
+    info[3] = "description"
+    info[17] = "source.example"
+    data = [None] * 26
+    data[2] = ["https://thumbs.example/" + url, 150, 150]
+    data[3] = [url, width, height]
+    data[25] = {"2003": info}
+    return [None, data]
+
+
+def make_arguments(**overrides):
+    arguments = {arg: None for arg in google_images_download.args_list}
+    arguments.update(overrides)
+    return arguments
+
+
+def fake_fetch(failing):
+    def fetch_image(image_url, main_directory, dir_name, *args, **kwargs):
+        time.sleep(random.uniform(0, 0.02))
+        if image_url in failing:
+            return "fail", "HTTPError on an image...trying next one...", '', None, False
+        temp_path = os.path.join(main_directory, dir_name, "." + image_url.rsplit('/', 1)[-1] + ".part")
+        with open(temp_path, 'wb') as temp_file:
+            temp_file.write(image_url.encode())
+        return "success", '', image_url.rsplit('/', 1)[-1], temp_path, False
+    return fetch_image
+
+
+def run_get_all_items(tmp_path, concurrency, limit=5):
+    urls = ["https://img.example/%d.jpg" % n for n in range(12)]
+    failing = {urls[1], urls[4]}
+    response = google_images_download.googleimagesdownload()
+    response.fetch_image = fake_fetch(failing)
+    directory = os.path.join(str(tmp_path), "kw")
+    os.makedirs(directory)
+    arguments = make_arguments(concurrency=concurrency, silent_mode=True)
+    items, errors, paths = response._get_all_items([make_image_object(url) for url in urls], str(tmp_path), "kw",
+                                                   limit, arguments)
+    response.wait_abandoned()  # fetches still in flight finish and clean up after themselves
+    names = [os.path.basename(path) for path in paths]
+    assert sorted(os.listdir(directory)) == sorted(names)
+    return items, errors, names
+
+
+def test_concurrent_download_matches_sequential(tmp_path):
+    sequential = run_get_all_items(tmp_path / "seq", concurrency=None)
+    concurrent = run_get_all_items(tmp_path / "conc", concurrency=4)
+    assert sequential == concurrent
+    items, errors, names = concurrent
+    assert names == ["1.0.jpg", "2.2.jpg", "3.3.jpg", "4.5.jpg", "5.6.jpg"]
+    assert errors == 2
+    assert len(items) == 5
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/image.jpg")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(IMAGE_BODY)))
+        self.end_headers()
+        self.wfile.write(IMAGE_BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    server = HTTPServer(("127.0.0.1", 0), ImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+def test_connection_pool_reuses_connections():
+    server = start_server()
+    pool = google_images_download.ConnectionPool()
+    try:
+        base = "http://127.0.0.1:%d" % server.server_port
+        for path in ("/image.jpg", "/redirect", "/image.jpg"):
+            response = pool.urlopen(base + path, {"User-Agent": "test"}, 5)
+            assert response.read() == IMAGE_BODY
+            assert response.info().get_content_type() == "image/jpeg"
+            response.close()
+        assert pool.requests == 4
+        assert pool.connections_opened == 1
+        assert pool.reuse_ratio() == 0.75
+    finally:
+        pool.close()
+        stop_server(server)
+
+
+def test_download_image_streams_and_caps_size(tmp_path):
+    server = start_server()
+    response = google_images_download.googleimagesdownload()
+    directory = os.path.join(str(tmp_path), "kw")
+    os.makedirs(directory)
+    url = "http://127.0.0.1:%d/image.jpg" % server.server_port
+    try:
+        status, message, name, path = response.download_image(
+            url, "jpg", str(tmp_path), "kw", 1, False, 5, None, False, False, False, None, "", True, False, None, None,
+            max_bytes=8)
+        assert status == "fail"
+        assert os.listdir(directory) == []
+
+        status, message, name, path = response.download_image(
+            url, "jpg", str(tmp_path), "kw", 1, False, 5, None, False, False, False, None, "", True, False, None, None,
+            max_bytes=1024)
+        assert status == "success"
+        assert name == "1.image.jpg"
+        with open(path, 'rb') as image_file:
+            assert image_file.read() == IMAGE_BODY
+        assert os.listdir(directory) == ["1.image.jpg"]
+    finally:
+        response.pool.close()
+        stop_server(server)
+
+
+def test_content_store_links_duplicates(tmp_path):
+    server = start_server()
+    response = google_images_download.googleimagesdownload()
+    store = os.path.join(str(tmp_path), "store")
+    url = "http://127.0.0.1:%d/image.jpg" % server.server_port
+    paths = []
+    try:
+        for dir_name in ("species a", "species b"):
+            os.makedirs(os.path.join(str(tmp_path), dir_name))
+            status, message, name, path = response.download_image(
+                url, "jpg", str(tmp_path), dir_name, 1, False, 5, None, False, False, False, None, "", True, False,
+                None, None, content_store=store)
+            assert status == "success"
+            paths.append(path)
+    finally:
+        response.pool.close()
+        stop_server(server)
+    assert os.path.samefile(paths[0], paths[1])
+    assert response.store_stats == {'blobs': 1, 'bytes_stored': len(IMAGE_BODY), 'duplicates': 1,
+                                    'bytes_saved': len(IMAGE_BODY)}
+
+
+def test_discarding_keeps_content_store_blobs(tmp_path):
+    response = google_images_download.googleimagesdownload()
+    # named like a temporary file, it is the flag that tells them apart
+    blob = tmp_path / "store" / "ab" / "abcdef.part"
+    temp = tmp_path / ".download.part"
+    blob.parent.mkdir(parents=True)
+    blob.write_bytes(IMAGE_BODY)
+    temp.write_bytes(IMAGE_BODY)
+    response.discard_fetched(("success", '', "image.jpg", str(blob), True))
+    response.discard_fetched(("success", '', "image.jpg", str(temp), False))
+    assert blob.exists() and not temp.exists()
+
+
+def test_manifest_skips_known_urls(tmp_path):
+    urls = ["https://img.example/%d.jpg" % n for n in range(6)]
+    response = google_images_download.googleimagesdownload()
+    response.fetch_image = fake_fetch({urls[0]})
+    os.makedirs(os.path.join(str(tmp_path), "kw"))
+    arguments = make_arguments(silent_mode=True, manifest=os.path.join(str(tmp_path), "manifest.sqlite3"))
+    objects = [make_image_object(url) for url in urls]
+
+    items, errors, paths = response._get_all_items(objects, str(tmp_path), "kw", 2, arguments)
+    assert [item['image_link'] for item in items] == urls[1:3]
+    assert errors == 1
+
+    # a second pass only tries urls it has not seen, duplicates within the results count once
+    items, errors, paths = response._get_all_items(objects + objects, str(tmp_path), "kw", 10, arguments)
+    assert [item['image_link'] for item in items] == urls[3:]
+    assert errors == 0
+    response.close()
+
+
+def test_manifest_retries_failed_urls(tmp_path):
+    manifest = google_images_download.UrlManifest(str(tmp_path / "manifest.sqlite3"), retry_after=60, max_attempts=2)
+    manifest.record("https://img.example/ok.jpg", "kw", "success")
+    manifest.record("https://img.example/failed.jpg", "kw", "fail")
+    urls = ["https://img.example/ok.jpg", "https://img.example/failed.jpg"]
+    assert manifest.known(urls) == set(urls)
+
+    manifest.retry_after = 0  # as if a minute had passed
+    assert manifest.known(urls) == {"https://img.example/ok.jpg"}
+    manifest.record("https://img.example/failed.jpg", "kw", "fail")
+    assert manifest.known(urls) == set(urls)  # failed twice, given up on
+    manifest.close()
+
+
+def test_search_cache_expires_and_evicts(tmp_path):
+    cache = google_images_download.SearchCache(str(tmp_path), ttl=60, max_entries=2)
+    cache.put("https://www.google.com/search?q=a", [["a"]], {"tab": "url"})
+    assert cache.get("https://www.google.com/search?q=a") == ([["a"]], {"tab": "url"})
+    assert cache.get("https://www.google.com/search?q=b") is None
+
+    cache.put("https://www.google.com/search?q=b", [["b"]], {})
+    cache.get("https://www.google.com/search?q=a")  # a is now more recently used than b
+    cache.put("https://www.google.com/search?q=c", [["c"]], {})
+    assert cache.get("https://www.google.com/search?q=b") is None
+    assert cache.get("https://www.google.com/search?q=a") is not None
+    assert (cache.hits, cache.misses) == (3, 2)
+
+    cache.ttl = -1
+    assert cache.get("https://www.google.com/search?q=a") is None
+
+
+def make_pack(urls, cursor):
+    grid = [[[{"444383007": make_image_object(url)}]] for url in urls]
+    pack = [None] * 57
+    pack[56] = [[[[[grid, cursor]]]]]
+    return json.dumps(pack)
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    # three result pages of 100 images, chained by their cursors
+    protocol_version = "HTTP/1.1"
+    cursors = {None: "page-2", "page-2": "page-3", "page-3": None}
+    batch_requests = []
+
+    def urls(self, cursor):
+        first = {None: 0, "page-2": 100, "page-3": 200}[cursor]
+        return ["https://img.example/%d.jpg" % n for n in range(first, first + 100)]
+
+    def reply(self, body):
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply("<html><body><script>AF_initDataCallback({key: 'ds:1', hash: '2', data:" +
+                   make_pack(self.urls(None), self.cursors[None]) + ", sideChannel: {}});</script></body></html>")
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode('utf-8'))
+        rpc = json.loads(form["f.req"][0])[0][0]
+        cursor = json.loads(rpc[1])[1]
+        self.batch_requests.append((self.path.split('?')[0], cursor))
+        payload = json.dumps([["wrb.fr", rpc[0], make_pack(self.urls(cursor), self.cursors[cursor]), None, None,
+                               None, "generic"]])
+        self.reply(")]}'\n\n%d\n%s\n" % (len(payload), payload))
+
+    def log_message(self, *args):
+        pass
+
+
+def test_http_pagination_follows_cursors(tmp_path, caplog):
+    server = HTTPServer(("127.0.0.1", 0), SearchHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    response = google_images_download.googleimagesdownload()
+    url = "http://127.0.0.1:%d/search?q=agaricus&tbm=isch" % server.server_port
+    try:
+        images, tabs = response.search(url, 150, make_arguments(pagination_backend='http'))
+        assert len(images) == 200
+        assert SearchHandler.batch_requests == [("/_/VisualFrontendUi/data/batchexecute", "page-2")]
+        assert not caplog.records
+
+        del SearchHandler.batch_requests[:]
+        images, tabs = response.search(url, 1000, make_arguments(pagination_backend='http'))
+        assert [obj[1][3][0] for obj in images] == ["https://img.example/%d.jpg" % n for n in range(300)]
+        assert [cursor for path, cursor in SearchHandler.batch_requests] == ["page-2", "page-3"]
+        # running out of cursors before the limit is not silent
+        assert [record.levelname for record in caplog.records] == ["WARNING"]
+        assert "no cursor" in caplog.records[0].getMessage()
+    finally:
+        response.close()
+        stop_server(server)
+
+
+def run_download_executor(tmp_path, keyword_workers):
+    urls = ["https://img.example/%d.jpg" % n for n in range(8)]
+    response = google_images_download.googleimagesdownload()
+    response.fetch_image = fake_fetch({urls[2], urls[5]})
+    response.search = lambda url, limit, arguments: ([make_image_object(url) for url in urls], {})
+    arguments = make_arguments(keywords="amanita,boletus,cantharellus,morchella", suffix_keywords="cap,gills",
+                               limit=4, silent_mode=True, output_directory=str(tmp_path),
+                               keyword_workers=keyword_workers)
+    paths, errors = response.download_executor(arguments)
+    response.wait_abandoned()
+    return [(keyword, [os.path.relpath(path, str(tmp_path)) for path in keyword_paths])
+            for keyword, keyword_paths in paths.items()], errors
+
+
+def test_keyword_workers_match_sequential(tmp_path):
+    sequential = run_download_executor(tmp_path / "seq", None)
+    parallel = run_download_executor(tmp_path / "par", 3)
+    assert parallel == sequential
+    paths, errors = parallel
+    assert [keyword for keyword, _ in paths][:2] == ["amanita cap", "boletus cap"]
+    assert len(paths) == 8
+    assert errors == 8  # the limit is reached before the second failing url
+
+
+def test_rate_limiter_paces_after_burst():
+    limiter = google_images_download.RateLimiter(rate=20, burst=2)
+    start = time.time()
+    for _ in range(6):
+        limiter.wait()
+    # two requests go out at once, the other four wait 1/20 s each
+    assert 0.18 <= time.time() - start < 0.5
+    assert 0.18 <= limiter.waited < 0.5
+    assert limiter.requests == 6
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    throttle = 2
+
+    def do_GET(self):
+        if ThrottlingHandler.throttle:
+            ThrottlingHandler.throttle -= 1
+            self.send_response(429)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        SearchHandler.do_GET(self)
+
+    reply = SearchHandler.reply
+    urls = SearchHandler.urls
+    cursors = SearchHandler.cursors
+
+    def log_message(self, *args):
+        pass
+
+
+def test_throttled_search_backs_off_and_retries():
+    server = HTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    response = google_images_download.googleimagesdownload()
+    response.rate_limiter = google_images_download.RateLimiter(base_backoff=0.05)
+    try:
+        images, tabs = response.download_page("http://127.0.0.1:%d/search?q=agaricus" % server.server_port)
+        assert len(images) == 100
+        assert response.rate_limiter.throttled == 2
+        assert response.rate_limiter.waited >= 0.05
+
+        # once the attempts run out the search comes back empty instead of exiting
+        ThrottlingHandler.throttle = google_images_download.SEARCH_ATTEMPTS
+        assert response.download_page("http://127.0.0.1:%d/search?q=agaricus" % server.server_port) == ([], {})
+    finally:
+        response.close()
+        stop_server(server)
+
+
+def test_silent_mode_prints_nothing_for_throttled_searches_and_thumbnails(tmp_path, capsys):
+    search_server = HTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    threading.Thread(target=search_server.serve_forever, daemon=True).start()
+    image_server = HTTPServer(("127.0.0.1", 0), SlowImageHandler)
+    threading.Thread(target=image_server.serve_forever, daemon=True).start()
+    response = google_images_download.googleimagesdownload()
+    response.rate_limiter = google_images_download.RateLimiter(base_backoff=0.01)
+    response.create_directories(str(tmp_path), "kw", True, False)
+    # what main() sets up, so anything logged reaches stdout
+    handler = logging.StreamHandler(sys.stdout)
+    google_images_download.log.addHandler(handler)
+    level = google_images_download.log.level
+    google_images_download.log.setLevel(logging.INFO)
+
+    def throttled_search_and_thumbnail(silent_mode):
+        ThrottlingHandler.throttle = 1
+        images, _ = response.search("http://127.0.0.1:%d/search?q=agaricus" % search_server.server_port, 10,
+                                    make_arguments(silent_mode=silent_mode))
+        assert len(images) == 100
+        status, _ = response.download_image_thumbnail(
+            "http://127.0.0.1:%d/thumb.jpg" % image_server.server_port, str(tmp_path), "kw", "1.thumb.jpg", True, 5,
+            True, False, None, "", None, silent_mode)
+        assert status == "success"
+        return capsys.readouterr().out
+
+    try:
+        assert throttled_search_and_thumbnail(True) == ""
+        out = throttled_search_and_thumbnail(False)
+        assert "Google is throttling searches" in out
+        assert "Image URL: " in out and "Image Size: " in out
+    finally:
+        google_images_download.log.removeHandler(handler)
+        google_images_download.log.setLevel(level)
+        response.close()
+        stop_server(search_server)
+        stop_server(image_server)
+
+
+def test_host_health_ranks_and_breaks_circuit(tmp_path):
+    path = os.path.join(str(tmp_path), "hosts.json")
+    health = google_images_download.HostHealth(path, failure_limit=3)
+    for latency in (0.2, 0.1, 0.3):
+        health.record("https://good.example/a.jpg", True, latency)
+    for _ in range(3):
+        health.record("https://dead.example/a.jpg", False)
+    assert health.median_latency("good.example") == 0.2
+    assert health.success_rate("dead.example") == 0.0
+    assert health.is_open("https://dead.example/b.jpg")
+    assert not health.is_open("https://good.example/b.jpg")
+    assert health.rank("https://dead.example/b.jpg") == 3
+
+    health.save()
+    # the record survives, the breaker does not
+    reloaded = google_images_download.HostHealth(path, failure_limit=3)
+    assert not reloaded.is_open("https://dead.example/b.jpg")
+    assert reloaded.rank("https://dead.example/b.jpg") == 2
+    assert reloaded.rank("https://good.example/b.jpg") == 0
+    assert reloaded.rank("https://new.example/b.jpg") == 0
+    for latency in (6.0, 8.0, 0.5):
+        reloaded.record("https://slow.example/a.jpg", True, latency)
+    assert reloaded.rank("https://slow.example/b.jpg") == 1  # median of 6 s
+
+    assert reloaded.is_blocked("https://ads.example/x.jpg", "tracker.,ads.example")
+    assert not reloaded.is_blocked("https://good.example/x.jpg", "tracker.,ads.example")
+
+
+class HotlinkPageHandler(BaseHTTPRequestHandler):
+    # answers every image with an HTML page, as hotlink protection and consent walls do
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b"<html>Please visit our site</html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_hosts_answering_with_pages_count_as_failing(tmp_path):
+    server = HTTPServer(("127.0.0.1", 0), HotlinkPageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    response = google_images_download.googleimagesdownload()
+    response.host_health = google_images_download.HostHealth(failure_limit=3)
+    os.makedirs(os.path.join(str(tmp_path), "kw"))
+    url = "http://127.0.0.1:%d/%%d.jpg" % server.server_port
+    try:
+        for n in range(3):
+            status, message = response.fetch_image(url % n, str(tmp_path), "kw", False, 5, False, True, False,
+                                                   None)[:2]
+            assert status == "fail" and message.startswith("Invalid image format 'text/html'")
+        assert response.host_health.success_rate(response.host_health.host(url)) == 0.0
+        assert response.host_health.is_open(url % 3)
+        assert response.host_health.rank(url % 3) == 3
+        status, message = response.fetch_image(url % 3, str(tmp_path), "kw", False, 5, False, True, False, None)[:2]
+        assert message.startswith("Host failed too often")
+    finally:
+        response.close()
+        stop_server(server)
+
+
+class SlowImageHandler(BaseHTTPRequestHandler):
+    # /slow/... sends the start of its body, and the rest only once `release` is set; everything else is served at
+    # once
+    protocol_version = "HTTP/1.1"
+    release = threading.Event()
+
+    def do_GET(self):
+        slow = self.path.startswith("/slow/")
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(IMAGE_BODY) * (30 if slow else 1)))
+        self.end_headers()
+        try:
+            for n in range(30 if slow else 1):
+                self.wfile.write(IMAGE_BODY)
+                self.wfile.flush()
+                if slow and n == 0:
+                    self.release.wait()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def test_hedged_fetching_cancels_slow_downloads(tmp_path):
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowImageHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:%d/" % server.server_port
+    urls = [base + "slow/0.jpg", base + "1.jpg", base + "slow/2.jpg", base + "3.jpg", base + "4.jpg", base + "5.jpg"]
+    response = google_images_download.googleimagesdownload()
+    directory = os.path.join(str(tmp_path), "kw")
+    os.makedirs(directory)
+    SlowImageHandler.release.clear()
+    try:
+        # the slow downloads cannot finish before the limit is reached
+        items, errors, paths = response._get_all_items([make_image_object(url) for url in urls], str(tmp_path), "kw",
+                                                       3, make_arguments(hedge=2, silent_mode=True))
+        assert len(items) == 3 and errors == 0
+        assert all("slow" not in item['image_link'] for item in items)
+        SlowImageHandler.release.set()
+        response.wait_abandoned()  # cancelled downloads notice at their next chunk
+        assert sorted(os.listdir(directory)) == sorted(os.path.basename(path) for path in paths)
+        assert response.hedge_stats['cancelled'] >= 2
+        assert response.hedge_stats['wasted_bytes'] > 0
+    finally:
+        SlowImageHandler.release.set()
+        response.close()
+        stop_server(server)
+
+
+def test_filters_skip_candidates_before_fetching(tmp_path):
+    objects = [make_image_object("https://img.example/small.jpg", 320, 240),
+               make_image_object("https://img.example/big.jpg", 1600, 1200),
+               make_image_object("https://img.example/wide.jpg", 3000, 700),
+               make_image_object("https://img.example/icon.gif", 800, 800),
+               make_image_object("https://img.example/unknown-small", None, None),
+               make_image_object("https://img.example/unknown-big", None, None)]
+    response = google_images_download.googleimagesdownload()
+    fetched = []
+    fetch = fake_fetch(set())
+    response.fetch_image = lambda image_url, *args, **kwargs: fetched.append(image_url) or fetch(image_url, *args)
+    probes = {"https://img.example/unknown-small": ('jpg', 500, 400),
+              "https://img.example/unknown-big": ('png', 900, 700)}
+    response.probe_image = lambda url, timeout=None: probes[url]
+    os.makedirs(os.path.join(str(tmp_path), "kw"))
+    arguments = make_arguments(silent_mode=True, min_width=640, max_aspect_ratio=2, allowed_formats="jpg,jpeg,png")
+    items, errors, paths = response._get_all_items(objects, str(tmp_path), "kw", 10, arguments)
+    assert [item['image_link'] for item in items] == ["https://img.example/big.jpg", "https://img.example/unknown-big"]
+    assert fetched == ["https://img.example/big.jpg", "https://img.example/unknown-big"]
+    assert items[1]['image_width'] == 900
+    assert errors == 0
+
+
+def test_metrics_count_stages_images_and_errors(tmp_path):
+    urls = ["https://img.example/%d.jpg" % n for n in range(5)]
+    response = google_images_download.googleimagesdownload()
+    response.fetch_image = fake_fetch({urls[1]})
+    os.makedirs(os.path.join(str(tmp_path), "kw"))
+    with response.metrics.keyword_timer("kw"):
+        response._get_all_items([make_image_object(url) for url in urls], str(tmp_path), "kw", 3,
+                                make_arguments(silent_mode=True))
+    response.metrics.add_error("timeout", "kw")
+
+    summary = response.metrics.summary()
+    keyword = summary['keywords']['kw']
+    assert keyword['images'] == summary['images'] == 3
+    assert keyword['bytes'] == sum(len(url) for url in (urls[0], urls[2], urls[3]))
+    assert keyword['stages']['fetch']['count'] == 4
+    assert keyword['stages']['write']['count'] == 4
+    assert keyword['errors'] == {"timeout": 1}
+    assert keyword['images_per_second'] > 0
+
+    prometheus = os.path.join(str(tmp_path), "metrics.prom")
+    response.metrics.write_prometheus(prometheus)
+    with open(prometheus) as prometheus_file:
+        lines = prometheus_file.read().splitlines()
+    assert 'gid_images_total{keyword="kw"} 3.0' in lines
+    assert 'gid_errors_total{keyword="kw",error="timeout"} 1.0' in lines
+
+
+def test_messages_reach_the_application_logging_unless_silent(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    urls = ["https://img.example/%d.jpg" % n for n in range(2)]
+    response = google_images_download.googleimagesdownload()
+    response.fetch_image = fake_fetch(set())
+    os.makedirs(os.path.join(str(tmp_path), "kw"))
+    response._get_all_items([make_image_object(url) for url in urls], str(tmp_path), "kw", 1,
+                            make_arguments(silent_mode=True))
+    assert not caplog.records
+    response._get_all_items([make_image_object(url) for url in urls], str(tmp_path), "kw", 1, make_arguments())
+    assert [record.name for record in caplog.records] == ["google_images_download"]
+    response.close()
+
+
+def test_failed_download_is_counted_by_exception_class(tmp_path):
+    response = google_images_download.googleimagesdownload()
+    os.makedirs(os.path.join(str(tmp_path), "kw"))
+    status, message, name, path = response.download_image(
+        "http://127.0.0.1:1/image.jpg", "jpg", str(tmp_path), "kw", 1, False, 5, None, False, False, False, None, "",
+        True, False, None, None)
+    assert status == "fail"
+    assert response.metrics.summary()['keywords']['kw']['errors'] == {"URLError": 1}
+    response.close()
+
+
+def test_local_thumbnails_are_made_from_downloaded_images(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    sizes = {"https://img.example/0.png": (800, 600), "https://img.example/1.png": (300, 900),
+             "https://img.example/2.png": None}  # not an image
+
+    def fetch_image(image_url, main_directory, dir_name, *args, **kwargs):
+        temp_path = os.path.join(main_directory, dir_name, "." + image_url.rsplit('/', 1)[-1] + ".part")
+        if sizes[image_url]:
+            Image.new("RGB", sizes[image_url], (120, 80, 40)).save(temp_path, format="PNG")
+        else:
+            with open(temp_path, 'wb') as temp_file:
+                temp_file.write(b'<html></html>')
+        return "success", '', image_url.rsplit('/', 1)[-1], temp_path, False
+
+    def download_image_thumbnail(*args):
+        raise AssertionError("thumbnail fetched over the network")
+
+    response = google_images_download.googleimagesdownload()
+    response.fetch_image = fetch_image
+    response.download_image_thumbnail = download_image_thumbnail
+    response.create_directories(str(tmp_path), "kw", True, False)
+    arguments = make_arguments(thumbnail=True, local_thumbnails=True, thumbnail_size=100, process_workers=2,
+                               silent_mode=True)
+    try:
+        items, errors, paths = response._get_all_items([make_image_object(url) for url in sorted(sizes)],
+                                                       str(tmp_path), "kw", 5, arguments)
+        # the thumbnail that failed counts as an error of the keyword; the image itself stays
+        assert errors == 1 and len(paths) == 3
+    finally:
+        response.close()
+    thumbnails = tmp_path / "kw - thumbnail"
+    assert sorted(os.listdir(str(thumbnails))) == ["1.0.png", "2.1.png"]
+    assert Image.open(str(thumbnails / "1.0.png")).size == (100, 75)
+    assert Image.open(str(thumbnails / "2.1.png")).size == (33, 100)
+
+
+def test_normalize_converts_images_and_drops_broken_ones(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    exif = Image.Exif()
+    exif[0x010f] = "Camera maker"
+
+    def fetch_image(image_url, main_directory, dir_name, *args, **kwargs):
+        temp_path = os.path.join(main_directory, dir_name, "." + image_url.rsplit('/', 1)[-1] + ".part")
+        if image_url.endswith(".png"):
+            Image.new("RGBA", (1000, 500), (0, 0, 0, 0)).save(temp_path, format="PNG")
+        else:
+            Image.new("RGB", (200, 100), (10, 200, 30)).save(temp_path, format="JPEG", exif=exif)
+            if "broken" in image_url:
+                with open(temp_path, 'r+b') as temp_file:
+                    temp_file.truncate(300)
+        return "success", '', image_url.rsplit('/', 1)[-1], temp_path, False
+
+    urls = ["https://img.example/wide.png", "https://img.example/small.jpg", "https://img.example/broken.jpg"]
+    response = google_images_download.googleimagesdownload()
+    response.fetch_image = fetch_image
+    directory = tmp_path / "kw"
+    directory.mkdir()
+    arguments = make_arguments(normalize=True, normalize_size=400, process_workers=2,
+                               manifest=str(tmp_path / "manifest.sqlite"), silent_mode=True)
+    try:
+        items, errors, paths = response._get_all_items([make_image_object(url) for url in urls], str(tmp_path),
+                                                       "kw", 5, arguments)
+        # normalization is done by the time the keyword returns
+        assert errors == 1 and len(paths) == 2
+        rows = response.open_manifest(arguments['manifest'])._db.execute(
+            'SELECT url, status, width, height, path FROM images ORDER BY url').fetchall()
+    finally:
+        response.close()
+    assert sorted(os.listdir(str(directory))) == ["1.wide.jpg", "2.small.jpg"]
+    assert paths == [str(directory / "1.wide.jpg"), str(directory / "2.small.jpg")]
+    assert [item['image_filename'] for item in items] == ["1.wide.jpg", "2.small.jpg"]
+    wide = Image.open(paths[0])
+    assert (wide.format, wide.size, wide.getpixel((10, 10))) == ("JPEG", (400, 200), (255, 255, 255))
+    small = Image.open(paths[1])
+    assert small.size == (200, 100) and not small.getexif()
+    assert rows == [(urls[2], "fail", None, None, None), (urls[1], "success", 200, 100, paths[1]),
+                    (urls[0], "success", 400, 200, paths[0])]
+    assert response.metrics.summary()['keywords']['kw']['errors'] == {'OSError': 1}
+
+
+def test_normalized_images_get_thumbnails_of_the_jpeg(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+
+    def fetch_image(image_url, main_directory, dir_name, *args, **kwargs):
+        temp_path = os.path.join(main_directory, dir_name, "." + image_url.rsplit('/', 1)[-1] + ".part")
+        Image.new("RGBA", (800, 400), (0, 0, 0, 0)).save(temp_path, format="PNG")
+        return "success", '', image_url.rsplit('/', 1)[-1], temp_path, False
+
+    response = google_images_download.googleimagesdownload()
+    response.fetch_image = fetch_image
+    response.create_directories(str(tmp_path), "kw", True, False)
+    arguments = make_arguments(normalize=True, thumbnail=True, local_thumbnails=True, thumbnail_size=100,
+                               process_workers=2, silent_mode=True)
+    try:
+        items, errors, paths = response._get_all_items([make_image_object("https://img.example/wide.png")],
+                                                       str(tmp_path), "kw", 5, arguments)
+    finally:
+        response.close()
+    assert errors == 0 and paths == [str(tmp_path / "kw" / "1.wide.jpg")]
+    thumbnails = tmp_path / "kw - thumbnail"
+    assert os.listdir(str(thumbnails)) == ["1.wide.jpg"]
+    thumbnail = Image.open(str(thumbnails / "1.wide.jpg"))
+    assert (thumbnail.format, thumbnail.size, thumbnail.getpixel((10, 10))) == ("JPEG", (100, 50), (255, 255, 255))
+
+
+def test_near_duplicates_are_dropped_without_using_the_limit(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+
+    def blocks(seed, size=256):
+        rng = random.Random(seed)
+        small = Image.new("L", (8, 8))
+        small.putdata([rng.randrange(256) for _ in range(64)])
+        return small.resize((size, size), Image.NEAREST).convert("RGB")
+
+    images = {"https://img.example/a.png": blocks(1), "https://img.example/a-small.jpg": blocks(1, 180),
+              "https://img.example/seeded-copy.png": blocks(2), "https://img.example/b.png": blocks(3),
+              "https://img.example/c.png": blocks(4)}
+    urls = list(images)
+
+    def fetch_image(image_url, main_directory, dir_name, *args, **kwargs):
+        name = image_url.rsplit('/', 1)[-1]
+        temp_path = os.path.join(main_directory, dir_name, "." + name + ".part")
+        images[image_url].save(temp_path, format="JPEG" if name.endswith(".jpg") else "PNG")
+        return "success", '', name, temp_path, False
+
+    directory = tmp_path / "kw"
+    directory.mkdir()
+    blocks(2).save(str(directory / "0.already-here.png"))
+    response = google_images_download.googleimagesdownload()
+    response.fetch_image = fetch_image
+    arguments = make_arguments(reject_duplicates=True, concurrency=3, silent_mode=True)
+    items, errors, paths = response._get_all_items([make_image_object(url) for url in urls], str(tmp_path), "kw", 3,
+                                                   arguments)
+    assert errors == 0
+    assert [item['image_link'] for item in items] == [urls[0], urls[3], urls[4]]
+    assert sorted(os.listdir(str(directory))) == ["0.already-here.png", "1.a.png", "2.b.png", "3.c.png"]
+    summary = response.metrics.summary()['keywords']['kw']
+    assert summary['duplicates'] == 2
+    # one per download, and one for the images already in the directory
+    assert summary['stages']['hash']['count'] == len(urls) + 1
+
+    hash_a = google_images_download.image_phash(str(directory / "1.a.png"))
+    assert 0 <= hash_a < 1 << 64
+    assert bin(hash_a ^ google_images_download.image_phash(str(directory / "2.b.png"))).count('1') > 10
+
+
+def test_image_phash_matches_imagededup(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    rng = random.Random(5)
+    half = Image.new("L", (20, 40))
+    half.putdata([rng.randrange(256) for _ in range(800)])
+    mirrored = Image.new("L", (40, 40))
+    mirrored.paste(half, (0, 0))
+    mirrored.paste(half.transpose(Image.FLIP_LEFT_RIGHT), (20, 0))
+    small = Image.new("RGB", (8, 8))
+    small.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(64)])
+    # hashes PHash.encode_image gives for the same files
+    references = {"flat.png": (Image.new("RGB", (60, 40), (90, 140, 200)), "ffffffffffffffff"),
+                  "mirrored.png": (mirrored, "d5dff75d5d7f5fd7"),
+                  "natural.jpg": (small.resize((120, 90), Image.BICUBIC), "ad4d28b729166ae7")}
+    for name, (image, reference) in references.items():
+        image.save(str(tmp_path / name))
+        assert "%016x" % google_images_download.image_phash(str(tmp_path / name)) == reference, name
+    (tmp_path / "page.html").write_bytes(b"<html></html>")
+    assert google_images_download.image_phash(str(tmp_path / "page.html")) is None
+
+
+class FakeDriver(object):
+    # just enough of a selenium driver for download_extended_page
+    current_url = "https://www.google.com/search?q=agaricus"
+
+    def __init__(self, page="", batches=()):
+        self.page_source = page
+        self.batches = list(batches)
+        self.presses = 0
+        self.quit_calls = 0
+
+    def get(self, url):
+        pass
+
+    def execute_script(self, script):
+        if script.startswith("return"):
+            return [self.batches.pop(0)] if self.batches else []
+
+    def find_element(self, by, value):
+        if value == "body":
+            return self
+        raise selenium.common.exceptions.NoSuchElementException(value)
+
+    def send_keys(self, keys):
+        self.presses += 1
+
+    def quit(self):
+        self.quit_calls += 1
+
+
+class FakeBrowserPool(google_images_download.BrowserPool):
+    def __init__(self, drivers, size=1):
+        google_images_download.BrowserPool.__init__(self, size=size)
+        self.drivers = list(drivers)
+
+    def _launch(self):
+        if not self.drivers:
+            raise RuntimeError("no chromedriver")
+        return self.drivers.pop(0)
+
+
+def test_browser_pool_reuses_sessions_and_grows():
+    first, second = FakeDriver(), FakeDriver()
+    pool = FakeBrowserPool([first, second])
+    assert pool.acquire() is first
+    waiter = threading.Thread(target=lambda: pool.release(pool.acquire()))
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive()  # the only session is taken
+    pool.release(first)
+    waiter.join()
+    assert pool.acquire() is first  # reused, not launched again
+
+    pool.grow(2)
+    assert pool.acquire() is second  # a second session next to the first
+    pool.discard(second)
+    assert second.quit_calls == 1
+    with pytest.raises(RuntimeError):
+        pool.acquire()  # the discarded session frees its slot, launching a third fails
+    pool.release(first)
+    pool.close()
+    assert first.quit_calls == 1
+
+
+def test_browser_that_does_not_start_raises():
+    response = google_images_download.googleimagesdownload()
+    response.browser_pools[(None, None)] = FakeBrowserPool([])
+    with pytest.raises(google_images_download.BrowserUnavailable):
+        response.download_extended_page("https://www.google.com/search?q=agaricus", None, None, 200)
+
+
+def batch_response(image_urls):
+    # a batchexecute response as the capture script keeps it, the data pack on its fourth line
+    pack = json.dumps(fixtures.data_pack(image_urls))
+    return ")]}'\n\n123\n" + json.dumps([["wrb.fr", "HoAMBc", pack]]) + "\n"
+
+
+def run_extended_page(monkeypatch, batches, limit, idle_timeout):
+    monkeypatch.setattr(google_images_download, "SCROLL_PAUSE", 0)
+    monkeypatch.setattr(google_images_download, "SCROLL_IDLE_TIMEOUT", idle_timeout)
+    page = fixtures.search_page(n_images=100, n_tabs=2, filler_kb=1).decode('utf-8')
+    driver = FakeDriver(page, [batch_response(["https://img.example/%d/%d.jpg" % (b, n) for n in range(100)])
+                               for b in range(batches)])
+    response = google_images_download.googleimagesdownload()
+    response.browser_pools[(None, None)] = FakeBrowserPool([driver])
+    images, tabs = response.download_extended_page("https://www.google.com/search?q=agaricus", None, None, limit)
+    return driver, images, tabs
+
+
+def test_scrolling_stops_once_enough_images_arrived(monkeypatch):
+    # without waiting for the idle timeout: the page is not exhausted, there are enough images
+    driver, images, tabs = run_extended_page(monkeypatch, 2, 250, 60)
+    assert len(images) == 300
+    assert driver.presses == 3  # the press after the second batch finds no new one
+    assert len(tabs) == 2
+
+
+def test_scrolling_stops_when_the_page_is_exhausted(monkeypatch):
+    driver, images, tabs = run_extended_page(monkeypatch, 1, 1000, 0)
+    assert len(images) == 200
+    assert driver.presses == 2  # no new batch and no "Show more results" button
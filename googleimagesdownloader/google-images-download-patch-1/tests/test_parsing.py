@@ -0,0 +1,97 @@
+import json
+import os
+import struct
+import sys
+
+from google_images_download import google_images_download
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import fixtures
+
+
+def make_page(image_urls, tabs=''):
+    grid = []
+    for url in image_urls:
+        data = [None] * 26
+        data[2] = ["https://thumbs.example/t", 150, 150]
+        data[3] = [url, 800, 600]
+        data[25] = {"2003": [None, None, "https://source.example/", "café \"quoted\"", None, None, None, None,
+                             None, None, None, None, None, None, None, None, None, "source.example"]}
+        grid.append([[{"444383007": [1, data]}]])
+    grid.append([[{"1": None}]])
+    pack = [None] * 57
+    pack[56] = [[[[[grid]]]]]
+    return ("<html><head><script>var a = {'b': \"c\"};</script></head><body>" + tabs +
+            "<script>AF_initDataCallback({key: 'ds:1', hash: '2', data:" + json.dumps(pack, ensure_ascii=False) +
+            ", sideChannel: {}});</script></body></html>").encode('utf-8')
+
+
+def test_bytes_parser_matches_string_parser():
+    response = google_images_download.googleimagesdownload()
+    page = make_page(["https://img.example/%d.jpg" % n for n in range(3)])
+    old = response._image_objects_from_pack(response._extract_data_pack(str(page)))
+    new = response._image_objects_from_pack(response._extract_data_pack_bytes(page))
+    assert [obj[1][3][0] for obj in new] == [obj[1][3][0] for obj in old]
+    assert len(new) == 3
+    # the bytes parser decodes utf-8 instead of mangling it
+    assert response.format_object(new[0])['image_description'] == "café \"quoted\""
+
+
+def old_get_all_tabs(response, page):
+    # the loop get_all_tabs used to run, without its sleep
+    tabs = {}
+    while True:
+        item, item_name, end_content = response.get_next_tab(page)
+        if item == "no_tabs" or len(item_name) > 100 or item_name == "background-color":
+            break
+        tabs[item_name] = item
+        page = page[end_content:]
+    return tabs
+
+
+def test_get_all_tabs_matches_get_next_tab_loop():
+    response = google_images_download.googleimagesdownload()
+    anchors = ''.join('<a class="dtviD" href="/search?q=agaricus&amp;tbm=isch&amp;chips=q:agaricus,g_1:%s:Ab%d'
+                      '&amp;usg=AI4_%d"><span>x</span></a>' % (name, n, n)
+                      for n, name in enumerate(["field+mushroom", "bisporus", "horse+mushroom"]))
+    page = make_page(["https://img.example/0.jpg"], '<div>' + anchors + '</div>')
+    tabs = response.get_all_tabs(page)
+    assert tabs == old_get_all_tabs(response, page.decode('utf-8'))
+    assert tabs == response.get_all_tabs(page.decode('utf-8'))
+    assert list(tabs) == ["field mushroom", "bisporus", "horse mushroom"]
+    assert tabs["bisporus"] == ("https://www.google.com/search?q=agaricus&tbm=isch&chips=q:agaricus,g_1:bisporus:Ab1"
+                                "&usg=AI4_1")
+
+
+def test_get_all_tabs_matches_get_next_tab_loop_on_fixture_page():
+    response = google_images_download.googleimagesdownload()
+    page = fixtures.search_page(n_images=5, n_tabs=40, filler_kb=20)
+    tabs = response.get_all_tabs(page)
+    assert len(tabs) == 40
+    assert tabs == old_get_all_tabs(response, page.decode('utf-8'))
+
+
+def test_get_all_tabs_reads_names_from_the_href():
+    # get_next_tab would start the name at the ':' of the style attribute
+    anchor = ('<a class="dtviD" style="color:red" href="/search?q=agaricus&amp;chips=q:agaricus,g_1:bisporus:Ab1'
+              '&amp;usg=AI4_1"><span>x</span></a>')
+    response = google_images_download.googleimagesdownload()
+    assert list(response.get_all_tabs(make_page(["https://img.example/0.jpg"], anchor))) == ["bisporus"]
+
+
+def test_image_header_info_reads_dimensions():
+    png = b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + struct.pack('>II', 640, 480) + b'\x08\x02'
+    gif = b'GIF89a' + struct.pack('<HH', 320, 200) + b'\x00' * 4
+    bmp = b'BM' + b'\x00' * 16 + struct.pack('<ii', 1024, -768) + b'\x00' * 8
+    webp = b'RIFF\x00\x00\x00\x00WEBPVP8 ' + b'\x00' * 10 + struct.pack('<HH', 800, 600)
+    # APP0 segment first, then a baseline start of frame
+    jpeg = (b'\xff\xd8' + b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00' + b'\x00' * 9 +
+            b'\xff\xc0' + struct.pack('>HBHH', 17, 8, 1080, 1920) + b'\x03')
+    info = google_images_download.image_header_info
+    assert info(png) == ('png', 640, 480)
+    assert info(gif) == ('gif', 320, 200)
+    assert info(bmp) == ('bmp', 1024, 768)
+    assert info(webp) == ('webp', 800, 600)
+    assert info(jpeg) == ('jpg', 1920, 1080)
+    assert info(jpeg[:20]) is None  # cut before the start of frame
+    assert info(b'<html>not an image</html>') is None
@@ -1,4 +1,5 @@
 import csv
+import logging
 import os
 import string
 import time
@@ -7,13 +8,14 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 MAX_IMAGES_PER_FOLDER = 500
+SPECIES_WORKERS = 4  # species searched and downloaded at once
 
 def sanitize_filename(name):
     valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
     sanitized_name = ''.join(c for c in name if c in valid_chars)
     return sanitized_name.strip()
 
-def download_images(family, species):
+def download_images(response, family, species):
     try:
         family = sanitize_filename(family)
         species = sanitize_filename(species)
@@ -30,7 +32,6 @@ def download_images(family, species):
                 print(f"Skipping {query}, {len(images)} images already present.")
                 return
 
-        response = google_images_download.googleimagesdownload()
         arguments = {
             "keywords": query,
             "format": "jpg",
@@ -38,7 +39,11 @@ def download_images(family, species):
             "print_urls": True,
             "size": "large",
             "output_directory": output_directory,
-            "image_directory": image_directory
+            "image_directory": image_directory,
+            # shared by every species: an image found under several species is only downloaded for the first
+            "manifest": os.path.join(output_directory, "manifest.sqlite3"),
+            "search_cache": os.path.join(output_directory, ".search_cache"),
+            "search_rate": 0.2  # one search every 5 seconds across all species
         }
 
         paths = response.download(arguments)
@@ -48,38 +53,29 @@ def download_images(family, species):
         print(f"Error for {family} {species}: {e}")
 
 def main():
-    RATE_LIMIT = 1  # requests per second
-    INTERVAL = 5 / RATE_LIMIT  # interval between requests in seconds
-
-    # This loop will continue indefinitely
-    while True:
-        with open('mushrooms.csv', newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-
-            with ThreadPoolExecutor() as executor:
-                futures = []
-                start_time = time.time()  # Remember the start time
-
-                for row in reader:
-                    family = row['Family']
-                    species = row['Species']
-
-                    futures.append(executor.submit(download_images, family, species))
+    # Print the downloader's per-image messages
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('google_images_download').setLevel(logging.INFO)
+    # One downloader for every species, so they share its connections, caches and manifest
+    response = google_images_download.googleimagesdownload()
+    try:
+        # This loop will continue indefinitely
+        while True:
+            with open('mushrooms.csv', newline='') as csvfile:
+                rows = list(csv.DictReader(csvfile))
 
-                    # Rate limiting
-                    if len(futures) >= RATE_LIMIT:
-                        # If we've reached the max number of requests per second, we wait
-                        time.sleep(max(0, INTERVAL - (time.time() - start_time)))
-                        # Then reset the start time for the next interval
-                        start_time = time.time()
+            with ThreadPoolExecutor(max_workers=SPECIES_WORKERS) as executor:
+                futures = [executor.submit(download_images, response, row['Family'], row['Species']) for row in rows]
 
                 # Wait for all the scheduled tasks to finish
                 for future in as_completed(futures):
                     future.result()  # You can handle task results/errors here if needed
 
-        print("Finished processing the CSV file. Restarting...")
-        # Optional: sleep for a while before starting over with the CSV to prevent hammering the server
-        time.sleep(10)
+            print("Finished processing the CSV file. Restarting...")
+            # Optional: sleep for a while before starting over with the CSV to prevent hammering the server
+            time.sleep(10)
+    finally:
+        response.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,255 @@
+import csv
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("imagededup.methods")
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import dedupe_images
+from imagededup.methods import PHash
+
+
+def make_image(path, seed, quality=95):
+    # a smooth random picture; the same seed saved at another quality is a near-duplicate
+    cells = np.random.default_rng(seed).integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    image = Image.fromarray(cells).resize((96, 96), Image.BICUBIC)
+    image.save(path, format="JPEG", quality=quality)
+    return path
+
+
+def make_tree(root, folders):
+    # folders: {folder name: [(file name, seed), ...]}
+    for folder, images in folders.items():
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+        for filename, seed in images:
+            make_image(os.path.join(root, folder, filename), seed)
+
+
+def test_hash_cache_encodes_only_new_and_changed_images(tmp_path):
+    root = str(tmp_path)
+    make_tree(root, {"a": [("1.jpg", 1), ("2.jpg", 2)]})
+    folder = os.path.join(root, "a")
+    phasher = PHash(verbose=False)
+    expected = phasher.encode_images(image_dir=folder)
+
+    cache = dedupe_images.HashCache(root)
+    assert cache.encode_folder(phasher, folder) == expected
+    assert (cache.hits, cache.misses) == (0, 2)
+    cache.save()
+
+    cache = dedupe_images.HashCache(root)
+    assert cache.encode_folder(phasher, folder) == expected
+    assert (cache.hits, cache.misses) == (2, 0)
+
+    # same size, new content and mtime: encoded again
+    path = make_image(os.path.join(folder, "2.jpg"), 3)
+    info = os.stat(path)
+    os.utime(path, ns=(info.st_atime_ns, info.st_mtime_ns + 10 ** 9))
+    cache = dedupe_images.HashCache(root)
+    encodings = cache.encode_folder(phasher, folder)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert encodings == {"1.jpg": expected["1.jpg"], "2.jpg": phasher.encode_image(image_file=path)}
+
+
+def test_hash_cache_caches_files_that_do_not_decode(tmp_path):
+    root = str(tmp_path)
+    make_tree(root, {"a": [("1.jpg", 1)]})
+    with open(os.path.join(root, "a", "broken.jpg"), "wb") as broken:
+        broken.write(b"<html></html>")
+    phasher = PHash(verbose=False)
+    cache = dedupe_images.HashCache(root)
+    assert list(cache.encode_folder(phasher, os.path.join(root, "a"))) == ["1.jpg"]
+    cache.save()
+    cache = dedupe_images.HashCache(root)
+    assert list(cache.encode_folder(phasher, os.path.join(root, "a"))) == ["1.jpg"]
+    assert (cache.hits, cache.misses) == (2, 0)
+
+
+def test_hash_cache_prunes_files_not_seen_when_saved(tmp_path):
+    root = str(tmp_path)
+    make_tree(root, {"a": [("1.jpg", 1), ("2.jpg", 2)], "b": [("1.jpg", 3)]})
+    phasher = PHash(verbose=False)
+    cache = dedupe_images.HashCache(root)
+    for folder in ("a", "b"):
+        cache.encode_folder(phasher, os.path.join(root, folder))
+    cache.save()
+
+    os.remove(os.path.join(root, "a", "2.jpg"))
+    cache = dedupe_images.HashCache(root)
+    cache.encode_folder(phasher, os.path.join(root, "a"))
+    cache.save()
+    with open(cache.path) as cache_file:
+        assert sorted(json.load(cache_file)) == ["a/1.jpg"]
+
+
+def test_interrupted_run_keeps_the_hashes_it_did_not_get_to(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    make_tree(root, {"a": [("1.jpg", 1)], "b": [("1.jpg", 2)], "c": [("1.jpg", 3)], "d": [("1.jpg", 4)],
+                     "e": [("1.jpg", 5)]})
+    monkeypatch.setattr(sys, "argv", ["dedupe_images.py", root, "--workers", "1"])
+    dedupe_images.main()
+    with open(os.path.join(root, dedupe_images.HASH_CACHE_NAME)) as cache_file:
+        entries = json.load(cache_file)
+    assert len(entries) == 5
+
+    deduplicate = dedupe_images.find_and_remove_duplicates
+
+    def interrupted(image_directory, *args, **kwargs):
+        deduplicate(image_directory, *args, **kwargs)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(dedupe_images, "find_and_remove_duplicates", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        dedupe_images.main()
+    with open(os.path.join(root, dedupe_images.HASH_CACHE_NAME)) as cache_file:
+        assert json.load(cache_file) == entries
+
+
+def brute_force(hashes, image_hash, threshold):
+    return sorted((value, dedupe_images.hamming_distance(image_hash, other)) for value, other in enumerate(hashes)
+                  if dedupe_images.hamming_distance(image_hash, other) <= threshold)
+
+
+def flip(image_hash, bits):
+    for bit in bits:
+        image_hash ^= 1 << bit
+    return image_hash
+
+
+@pytest.mark.parametrize("threshold", [0, 3, dedupe_images.MAX_DISTANCE, 17])
+def test_hash_index_finds_what_a_full_scan_finds(threshold):
+    rng = np.random.default_rng(threshold)
+    base = [int(value) for value in rng.integers(0, 1 << 63, 50, dtype=np.uint64)]
+    hashes = list(base)
+    for image_hash in base[:10]:
+        # the differing bits spread over the blocks as evenly as possible, the case multi-index hashing is built on
+        hashes.append(flip(image_hash, [0, 1, 2, 16, 17, 18, 32, 33, 48, 49]))
+        # bits on both sides of each block boundary
+        hashes.append(flip(image_hash, [15, 16, 31, 32, 47, 48]))
+        hashes.append(flip(image_hash, [15, 16, 31]))
+        hashes.append(flip(image_hash, rng.choice(64, threshold + 1, replace=False)))
+    hashes.append(hashes[0])  # the same hash twice
+    index = dedupe_images.HashIndex()
+    for value, image_hash in enumerate(hashes):
+        index.insert(image_hash, value)
+    assert index.size == len(hashes)
+    for image_hash in hashes:
+        assert sorted(index.query(image_hash, threshold)) == brute_force(hashes, image_hash, threshold)
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+def test_duplicates_are_removed_keeping_the_first(tmp_path, use_index):
+    folder = str(tmp_path)
+    make_image(os.path.join(folder, "1.jpg"), 1, quality=60)
+    make_image(os.path.join(folder, "2.jpg"), 2)
+    make_image(os.path.join(folder, "3.jpg"), 1)
+    make_image(os.path.join(folder, "4.jpg"), 1, quality=80)
+    index = dedupe_images.HashIndex() if use_index else None
+    dedupe_images.find_and_remove_duplicates(folder, index=index)
+    assert sorted(os.listdir(folder)) == ["1.jpg", "2.jpg"]
+    if use_index:
+        assert sorted(value for values in index.values.values() for value in values) == [(folder, "1.jpg"),
+                                                                                         (folder, "2.jpg")]
+
+
+def test_images_matching_another_folder_are_reported_and_kept(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    make_tree(root, {"a": [("1.jpg", 1), ("2.jpg", 2)], "b": [("1.jpg", 3)]})
+    make_image(os.path.join(root, "b", "2.jpg"), 1, quality=70)
+    report = os.path.join(root, "collisions.csv")
+    monkeypatch.setattr(sys, "argv", ["dedupe_images.py", root, "--workers", "1", "--no-cache", "--collisions",
+                                      report])
+    dedupe_images.main()
+    assert sorted(os.listdir(os.path.join(root, "b"))) == ["1.jpg", "2.jpg"]
+    phasher = PHash(verbose=False)
+    distance = dedupe_images.hamming_distance(
+        int(phasher.encode_image(image_file=os.path.join(root, "a", "1.jpg")), 16),
+        int(phasher.encode_image(image_file=os.path.join(root, "b", "2.jpg")), 16))
+    # the image kept is the one in the folder the walk reached first
+    with open(report, newline="") as report_file:
+        header, *rows = csv.reader(report_file)
+    assert header == ["image", "duplicate", "distance"]
+    assert len(rows) == 1 and rows[0][2] == str(distance)
+    assert sorted(rows[0][:2]) == [os.path.join("a", "1.jpg"), os.path.join("b", "2.jpg")]
+
+
+def dedupe_result(root, workers):
+    collisions = []
+    dedupe_images.run_dedupe(root, dedupe_images.HashCache(root), dedupe_images.HashIndex(), collisions,
+                             workers=workers, contents=dedupe_images.ContentIndex())
+    remaining = sorted(os.path.relpath(os.path.join(folder, filename), root)
+                       for folder, _, filenames in os.walk(root) for filename in filenames
+                       if not filename.startswith("."))
+    return remaining, [(os.path.relpath(kept, root), os.path.relpath(other, root), distance)
+                       for kept, other, distance in collisions]
+
+
+def test_hashing_processes_give_the_same_result_as_one_process(tmp_path):
+    roots = [str(tmp_path / "one"), str(tmp_path / "two")]
+    for root in roots:
+        # near-duplicates in a folder and across folders, more folders than the pool keeps ahead
+        make_tree(root, {str(folder): [("1.jpg", folder), ("2.jpg", folder + 100), ("3.jpg", folder % 3)]
+                         for folder in range(8)})
+        make_image(os.path.join(root, "0", "4.jpg"), 0, quality=60)
+    remaining, collisions = dedupe_result(roots[0], 1)
+    assert (remaining, collisions) == dedupe_result(roots[1], 2)
+    assert len(remaining) < 8 * 3 + 1 and collisions
+
+
+def test_byte_identical_copies_take_the_hash_of_their_original(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    make_tree(root, {"a": [("1.jpg", 1)], "b": [("1.jpg", 2)]})
+    original = os.path.join(root, "a", "1.jpg")
+    shutil.copyfile(original, os.path.join(root, "b", "2.jpg"))
+    with open(original, "rb") as original_file:
+        data = bytearray(original_file.read())
+    data[-100] ^= 0xff  # same size, other content
+    with open(os.path.join(root, "b", "3.jpg"), "wb") as changed:
+        changed.write(data)
+
+    encoded = []
+    encode_files = dedupe_images.encode_files
+
+    def recording(paths, backend):
+        encoded.extend(os.path.relpath(path, root) for path in paths)
+        return encode_files(paths, backend)
+
+    monkeypatch.setattr(dedupe_images, "encode_files", recording)
+    cache = dedupe_images.HashCache(root)
+    contents = dedupe_images.ContentIndex()
+    dedupe_images.run_dedupe(root, cache, dedupe_images.HashIndex(), [], workers=1, contents=contents)
+    # whichever of the two the walk reaches second is not decoded
+    assert len({os.path.join("a", "1.jpg"), os.path.join("b", "2.jpg")} & set(encoded)) == 1
+    assert os.path.join("b", "3.jpg") in encoded
+    assert contents.copies == 1
+    # the copy matches an image in another folder, so it stays, with the same hash cached
+    assert os.path.exists(os.path.join(root, "b", "2.jpg"))
+    assert cache.entries["b/2.jpg"][2] == cache.entries["a/1.jpg"][2] == PHash(verbose=False).encode_image(
+        image_file=original)
+
+
+def test_numpy_backend_gives_the_hashes_of_phash(tmp_path):
+    rng = np.random.default_rng(7)
+    half = rng.integers(0, 256, (40, 20), dtype=np.uint8)
+    mirrored = np.hstack([half, half[:, ::-1]])
+    images = {"flat-gray.png": np.full((30, 50), 128, dtype=np.uint8),
+              "flat-color.png": np.full((30, 50, 3), (200, 60, 20), dtype=np.uint8),
+              "black.png": np.zeros((16, 16), dtype=np.uint8),
+              "mirrored.png": mirrored, "flipped.png": mirrored.T, "both.png": np.vstack([mirrored, mirrored[::-1]]),
+              "stripes.png": np.tile(rng.integers(0, 256, (1, 64), dtype=np.uint8), (64, 1))}
+    paths = []
+    for name, pixels in images.items():
+        paths.append(str(tmp_path / name))
+        Image.fromarray(pixels).save(paths[-1])
+    paths += [make_image(str(tmp_path / "natural-{}.jpg".format(seed)), seed) for seed in range(5)]
+    (tmp_path / "page.jpg").write_bytes(b"<html></html>")
+    paths.append(str(tmp_path / "page.jpg"))
+
+    phasher = PHash(verbose=False)
+    assert dedupe_images.encode_files(paths, "numpy") == [phasher.encode_image(image_file=path) for path in paths]